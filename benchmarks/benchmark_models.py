@@ -0,0 +1,221 @@
+"""
+Inference benchmark of the video models on synthetic clips.
+
+The models are built from the shipped configs with random weights and run on random
+clips, so no dataset or checkpoint is needed. For each config it reports the latency of
+every stage, as recorded by the stage profiler of the model (MODEL.PROFILER), the
+throughput and the peak memory, e.g.
+
+    python benchmarks/benchmark_models.py --num-frames 30 --height 360 --width 640 --device cpu
+    python benchmarks/benchmark_models.py --config-files configs/ovis/CAVIS_Offline_R50.yaml \
+        --output benchmark.json --opts MODEL.MASK_FORMER.TEST.WINDOW_SIZE 10
+
+Random weights do not produce the number of confident instances of a trained model, so
+the cost of post-processing and evaluation may differ from real runs; compare results of
+this benchmark with each other, not with real inference.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import tempfile
+import time
+
+# fmt: off
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+import numpy as np
+import torch
+from torch.cuda.amp import autocast
+
+from detectron2.config import get_cfg
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+from mask2former import add_maskformer2_config
+from mask2former_video import add_maskformer2_video_config
+from cavis import add_minvis_config, add_dvis_config, add_cavis_config
+from cavis.data_video.ytvis_eval import instances_to_coco_json_video
+
+DEFAULT_CONFIGS = [
+    "configs/ytvis19/MinVIS_R50.yaml",
+    "configs/ytvis19/CAVIS_Segmenter_R50.yaml",
+    "configs/ytvis19/CAVIS_Online_R50.yaml",
+    "configs/ytvis19/CAVIS_Offline_R50.yaml",
+]
+
+
+def setup_cfg(config_file, opts, device, profile_file):
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_maskformer2_config(cfg)
+    add_maskformer2_video_config(cfg)
+    add_minvis_config(cfg)
+    add_dvis_config(cfg)
+    add_cavis_config(cfg)
+    cfg.merge_from_file(config_file)
+    cfg.merge_from_list(opts)
+    cfg.MODEL.DEVICE = device
+    cfg.MODEL.PROFILER.ENABLED = True
+    cfg.MODEL.PROFILER.SYNCHRONIZE = True
+    cfg.MODEL.PROFILER.LOG_FILE = profile_file
+    cfg.freeze()
+    return cfg
+
+
+def pop_profiles(profile_file):
+    """
+    Read and remove the stage profiles the model wrote to `profile_file`, one per forward.
+
+    Returns:
+        list[dict]: the total wall time in seconds of every stage of each forward, without
+            the nested stages (e.g. "tracker.layer0" of "tracker") already counted in their parent.
+    """
+    if not os.path.exists(profile_file):
+        return []
+    with open(profile_file) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    os.remove(profile_file)
+    return [
+        {stage: total["wall_ms"] / 1000 for stage, total in line["total"].items() if "." not in stage}
+        for line in lines
+    ]
+
+
+def synthetic_clip(num_frames, height, width, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    frames = torch.randint(0, 256, (num_frames, 3, height, width), generator=generator, dtype=torch.uint8)
+    return [
+        {
+            "image": [frame.float() for frame in frames],
+            "height": height,
+            "width": width,
+            "video_id": 0,
+            "length": num_frames,
+        }
+    ]
+
+
+def peak_memory_mb(device):
+    if torch.device(device).type == "cuda":
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    # peak resident memory of the process since it started, ru_maxrss is in KB on Linux, so
+    # on CPU the peak of a config includes the ones benchmarked before it
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def benchmark(config_file, cfg, args):
+    device = cfg.MODEL.DEVICE
+    cuda = torch.device(device).type == "cuda"
+    use_amp = cuda and not args.no_amp
+    model = build_model(cfg)
+    model.eval()
+    task = getattr(model, "task", "vis")
+    inputs = synthetic_clip(args.num_frames, args.height, args.width)
+    profile_file = cfg.MODEL.PROFILER.LOG_FILE
+
+    def run():
+        start = time.perf_counter()
+        with torch.no_grad(), autocast(enabled=use_amp):
+            outputs = model(inputs)
+        if cuda:
+            torch.cuda.synchronize()
+        forward_time = time.perf_counter() - start
+        evaluator_time = None
+        if task == "vis":
+            # the per-video work of YTVISEvaluator.process, the other evaluators need ground truth
+            start = time.perf_counter()
+            instances_to_coco_json_video(inputs, outputs)
+            evaluator_time = time.perf_counter() - start
+        return forward_time, evaluator_time
+
+    for _ in range(args.warmup):
+        run()
+    pop_profiles(profile_file)
+    if cuda:
+        torch.cuda.reset_peak_memory_stats()
+    forward_times, evaluator_times = zip(*[run() for _ in range(args.repeats)])
+    profiles = pop_profiles(profile_file)
+
+    forward_time = float(np.mean(forward_times))
+    # mean time per clip of the stages recorded by the profiler of the model, in pipeline order
+    stages = {}
+    for profile in profiles:
+        for stage, seconds in profile.items():
+            stages[stage] = stages.get(stage, 0.0) + seconds / len(profiles)
+    stages["other"] = max(forward_time - sum(stages.values()), 0.0)
+    if task == "vis":
+        stages["evaluator"] = float(np.mean(evaluator_times))
+    return {
+        "config_file": config_file,
+        "meta_architecture": cfg.MODEL.META_ARCHITECTURE,
+        "task": task,
+        "device": device,
+        "amp": use_amp,
+        "num_frames": args.num_frames,
+        "resolution": [args.height, args.width],
+        "forward_ms": forward_time * 1000,
+        "fps": args.num_frames / forward_time,
+        "stages_ms": {k: v * 1000 for k, v in stages.items()},
+        "peak_memory_mb": peak_memory_mb(device),
+    }
+
+
+def format_result(result):
+    lines = [
+        "{} ({}, {} frames at {}x{} on {}{}): {:.1f} ms/clip, {:.2f} frames/s, peak memory {:.0f} MB".format(
+            result["meta_architecture"], result["config_file"], result["num_frames"],
+            result["resolution"][0], result["resolution"][1], result["device"],
+            ", amp" if result["amp"] else "", result["forward_ms"], result["fps"], result["peak_memory_mb"],
+        )
+    ]
+    for stage, ms in result["stages_ms"].items():
+        share = ms / result["forward_ms"] * 100 if stage != "evaluator" else float("nan")
+        lines.append("  {:<20} {:>10.1f} ms {:>8.2f} ms/frame {:>6.1f}%".format(
+            stage, ms, ms / result["num_frames"], share
+        ))
+    return "\n".join(lines)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="inference benchmark of the video models on synthetic clips")
+    parser.add_argument("--config-files", nargs="+", default=DEFAULT_CONFIGS, metavar="FILE")
+    parser.add_argument("--num-frames", type=int, default=30, help="length of the synthetic clip")
+    parser.add_argument("--height", type=int, default=360, help="height of the frames given to the model")
+    parser.add_argument("--width", type=int, default=640, help="width of the frames given to the model")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--no-amp", action="store_true", help="run in float32 on CUDA, as on CPU")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", help="a json file to write the results to")
+    parser.add_argument(
+        "--opts",
+        help="Modify config options of all configs using the command-line 'KEY VALUE' pairs",
+        default=[],
+        nargs=argparse.REMAINDER,
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    setup_logger(name="fvcore")
+    logger = setup_logger()
+    logger.setLevel(logging.WARNING)
+    torch.manual_seed(0)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        profile_file = os.path.join(tmp_dir, "profile.jsonl")
+        for config_file in args.config_files:
+            result = benchmark(config_file, setup_cfg(config_file, args.opts, args.device, profile_file), args)
+            print(format_result(result))
+            results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -26,4 +26,6 @@ from .data_video import (
     build_detection_train_loader,
     build_detection_test_loader,
     get_detection_dataset_dicts,
+    LoaderTelemetry,
+    DataTelemetryHook,
 )
\ No newline at end of file
@@ -22,6 +22,29 @@ from mask2former_video.utils.memory import retry_if_cuda_oom
 from scipy.optimize import linear_sum_assignment
 
 from .video_cavis_modules import TemporalRefiner, CAVIS_Tracker
+from .inference_utils import (
+    panoptic_merge, semantic_fusion, video_instance_masks, crop_to_image, upsample_ids,
+    match_consecutive_frames, apply_frame_permutations, MaskFeatureStore,
+    store_mask_logits, load_mask_logits, WindowSizeTuner, is_cuda_oom,
+)
+from .profiling import StageProfiler
+
+
+def build_window_tuner(cfg):
+    if not cfg.MODEL.MASK_FORMER.TEST.WINDOW_AUTOTUNE:
+        return None
+    return WindowSizeTuner(
+        memory_budget_mb=cfg.MODEL.MASK_FORMER.TEST.WINDOW_MEMORY_BUDGET_MB,
+        max_window_size=cfg.MODEL.MASK_FORMER.TEST.MAX_WINDOW_SIZE,
+    )
+
+
+def build_profiler(cfg):
+    return StageProfiler(
+        enabled=cfg.MODEL.PROFILER.ENABLED,
+        synchronize=cfg.MODEL.PROFILER.SYNCHRONIZE,
+        log_file=cfg.MODEL.PROFILER.LOG_FILE,
+    )
 
 
 @META_ARCH_REGISTRY.register()
@@ -48,6 +71,9 @@ class MinVIS(nn.Module):
         # video
         num_frames,
         window_inference,
+        window_size=3,
+        profiler=None,
+        window_tuner=None,
     ):
         """
         Args:
@@ -72,6 +98,10 @@ class MinVIS(nn.Module):
             instance_on: bool, whether to output instance segmentation prediction
             panoptic_on: bool, whether to output panoptic segmentation prediction
             test_topk_per_image: int, instance segmentation parameter, keep topk instances per image
+            window_size: the number of images processed by the segmenter at a time
+            profiler: a StageProfiler timing the stages of the forward, disabled if None
+            window_tuner: a WindowSizeTuner picking the window size of window inference from
+                the memory budget, window_size is used if None
         """
         super().__init__()
         self.backbone = backbone
@@ -91,6 +121,9 @@ class MinVIS(nn.Module):
 
         self.num_frames = num_frames
         self.window_inference = window_inference
+        self.window_size = window_size
+        self.window_tuner = window_tuner
+        self.profiler = profiler if profiler is not None else StageProfiler()
 
     @classmethod
     def from_config(cls, cfg):
@@ -150,13 +183,84 @@ class MinVIS(nn.Module):
             "pixel_std": cfg.MODEL.PIXEL_STD,
             # video
             "num_frames": cfg.INPUT.SAMPLING_FRAME_NUM,
-            "window_inference": cfg.MODEL.MASK_FORMER.TEST.WINDOW_INFERENCE
+            "window_inference": cfg.MODEL.MASK_FORMER.TEST.WINDOW_INFERENCE,
+            "window_size": cfg.MODEL.MASK_FORMER.TEST.WINDOW_SIZE,
+            "profiler": build_profiler(cfg),
+            "window_tuner": build_window_tuner(cfg),
         }
 
     @property
     def device(self):
         return self.pixel_mean.device
 
+    def preprocess_image(self, batched_inputs):
+        """
+        Normalize, pad and batch the frames of the input videos.
+
+        The frames of a video are a list of (C, H, W) tensors, or a single (T, C, H, W)
+        tensor of frames resized to a common size, which is normalized and padded at once.
+        """
+        if len(batched_inputs) == 1 and isinstance(batched_inputs[0]["image"], torch.Tensor):
+            images = batched_inputs[0]["image"].to(self.device, non_blocking=True)
+            images = (images - self.pixel_mean) / self.pixel_std
+            h, w = images.shape[-2:]
+            if self.size_divisibility > 1:
+                stride = self.size_divisibility
+                pad_h, pad_w = (stride - h % stride) % stride, (stride - w % stride) % stride
+                images = F.pad(images, (0, pad_w, 0, pad_h), value=0.0)
+            return ImageList(images.contiguous(), [(h, w)] * images.shape[0])
+
+        images = []
+        for video in batched_inputs:
+            for frame in video["image"]:
+                images.append(frame.to(self.device))
+        images = [(x - self.pixel_mean) / self.pixel_std for x in images]
+        return ImageList.from_tensors(images, self.size_divisibility)
+
+    def run_windows(self, images_tensor, window_size, run_window, stage, tracker=None):
+        """
+        Call `run_window(i, frames)` on consecutive windows of `window_size` frames of a video.
+
+        With a window tuner at inference, the size of every window is picked by the tuner for
+        the stage and the resolution instead. A window that runs out of CUDA memory is run
+        again with fewer frames, after restoring the state of `tracker` from before it and
+        dropping its profiler records, so `run_window` must only keep its results once the
+        window is complete. With a tracker, the first window keeps at least 2 frames.
+        """
+        tuner = None if self.training else self.window_tuner
+        key = (stage,) + tuple(images_tensor.shape[-2:])
+        i, start_idx = 0, 0
+        while start_idx < len(images_tensor):
+            if tuner is None:
+                run_window(i, images_tensor[start_idx:start_idx + window_size])
+                i, start_idx = i + 1, start_idx + window_size
+                continue
+
+            # the tracker starts a video from its first 2 frames
+            min_size = min(2, len(images_tensor)) if tracker is not None and start_idx == 0 else 1
+            size = max(tuner.window_size(key, self.device, window_size), min_size)
+            if tracker is not None:
+                memory = {
+                    k: v.clone() if isinstance(v, torch.Tensor) else v for k, v in tracker.get_memory().items()
+                }
+            allocated = tuner.start_window(self.device)
+            try:
+                run_window(i, images_tensor[start_idx:start_idx + size])
+                oom = False
+            except RuntimeError as e:
+                if not is_cuda_oom(e) or size <= min_size or not tuner.out_of_memory(key, size):
+                    raise
+                oom = True
+            if oom:
+                # retry the window with fewer frames once the failed one is released
+                self.profiler.discard_window(i)
+                torch.cuda.empty_cache()
+                if tracker is not None:
+                    tracker.set_memory(memory)
+                continue
+            tuner.end_window(key, self.device, size, allocated)
+            i, start_idx = i + 1, start_idx + size
+
     def forward(self, batched_inputs):
         """
         Args:
@@ -183,18 +287,15 @@ class MinVIS(nn.Module):
                     segments_info (list[dict]): Describe each segment in `panoptic_seg`.
                         Each dict contains keys "id", "category_id", "isthing".
         """
-        images = []
-        for video in batched_inputs:
-            for frame in video["image"]:
-                images.append(frame.to(self.device))
-        images = [(x - self.pixel_mean) / self.pixel_std for x in images]
-        images = ImageList.from_tensors(images, self.size_divisibility)
+        images = self.preprocess_image(batched_inputs)
 
         if not self.training and self.window_inference:
-            outputs = self.run_window_inference(images.tensor, window_size=3)
+            outputs = self.run_window_inference(images.tensor, window_size=self.window_size)
         else:
-            features = self.backbone(images.tensor)
-            outputs = self.sem_seg_head(features)
+            with self.profiler.stage("backbone"):
+                features = self.backbone(images.tensor)
+            with self.profiler.stage("sem_seg_head"):
+                outputs = self.sem_seg_head(features)
 
         if self.training:
             # mask classification target
@@ -202,7 +303,8 @@ class MinVIS(nn.Module):
             outputs, targets = self.frame_decoder_loss_reshape(outputs, targets)
 
             # bipartite matching-based loss
-            losses = self.criterion(outputs, targets)
+            with self.profiler.stage("criterion"):
+                losses = self.criterion(outputs, targets)
 
             for k in list(losses.keys()):
                 if k in self.criterion.weight_dict:
@@ -210,9 +312,11 @@ class MinVIS(nn.Module):
                 else:
                     # remove this loss if not specified in `weight_dict`
                     losses.pop(k)
+            self.profiler.flush(training=True)
             return losses
         else:
-            outputs = self.post_processing(outputs)
+            with self.profiler.stage("post_processing"):
+                outputs = self.post_processing(outputs)
 
             mask_cls_results = outputs["pred_logits"]
             mask_pred_results = outputs["pred_masks"]
@@ -227,13 +331,18 @@ class MinVIS(nn.Module):
             height = input_per_image.get("height", image_size[0])  # raw image size before data augmentation
             width = input_per_image.get("width", image_size[1])
 
-            return retry_if_cuda_oom(self.inference_video)(
-                mask_cls_result,
-                mask_pred_result,
-                image_size,
-                height,
-                width,
-                first_resize_size)
+            with self.profiler.stage("inference_video"):
+                video_output = retry_if_cuda_oom(self.inference_video)(
+                    mask_cls_result,
+                    mask_pred_result,
+                    image_size,
+                    height,
+                    width,
+                    first_resize_size)
+            self.profiler.flush(
+                training=False, video_id=input_per_image.get("video_id"), num_frames=len(images.tensor)
+            )
+            return video_output
 
     def frame_decoder_loss_reshape(self, outputs, targets):
         outputs['pred_masks'] = einops.rearrange(outputs['pred_masks'], 'b q t h w -> (b t) q () h w')
@@ -271,30 +380,11 @@ class MinVIS(nn.Module):
         pred_logits, pred_masks, pred_embds = outputs['pred_logits'], outputs['pred_masks'], outputs['pred_embds']
 
         pred_logits = pred_logits[0]
-        pred_masks = einops.rearrange(pred_masks[0], 'q t h w -> t q h w')
         pred_embds = einops.rearrange(pred_embds[0], 'c t q -> t q c')
 
-        pred_logits = list(torch.unbind(pred_logits))
-        pred_masks = list(torch.unbind(pred_masks))
-        pred_embds = list(torch.unbind(pred_embds))
-
-        out_logits = []
-        out_masks = []
-        out_embds = []
-        out_logits.append(pred_logits[0])
-        out_masks.append(pred_masks[0])
-        out_embds.append(pred_embds[0])
-
-        # match the instances frame by frame
-        for i in range(1, len(pred_logits)):
-            indices = self.match_from_embds(out_embds[-1], pred_embds[i])
-
-            out_logits.append(pred_logits[i][indices, :])
-            out_masks.append(pred_masks[i][indices, :, :])
-            out_embds.append(pred_embds[i][indices, :])
-
-        out_logits = sum(out_logits)/len(out_logits)
-        out_masks = torch.stack(out_masks, dim=1)  # q h w -> q t h w
+        # match the instances of all the frames at once
+        perms = match_consecutive_frames(pred_embds)
+        out_logits, out_masks = apply_frame_permutations(perms, pred_logits, pred_masks[0])
 
         out_logits = out_logits.unsqueeze(0)
         out_masks = out_masks.unsqueeze(0)
@@ -305,22 +395,23 @@ class MinVIS(nn.Module):
         return outputs
 
     def run_window_inference(self, images_tensor, window_size=30):
-        iters = len(images_tensor) // window_size
-        if len(images_tensor) % window_size != 0:
-            iters += 1
         out_list = []
-        for i in range(iters):
-            start_idx = i * window_size
-            end_idx = (i+1) * window_size
 
-            features = self.backbone(images_tensor[start_idx:end_idx])
-            out = self.sem_seg_head(features)
+        def run_window(i, frames):
+            self.profiler.set_window(i)
+            with self.profiler.stage("backbone"):
+                features = self.backbone(frames)
+            with self.profiler.stage("sem_seg_head"):
+                out = self.sem_seg_head(features)
             del features['res2'], features['res3'], features['res4'], features['res5']
             for j in range(len(out['aux_outputs'])):
                 del out['aux_outputs'][j]['pred_masks'], out['aux_outputs'][j]['pred_logits']
             out['pred_masks'] = out['pred_masks'].detach().cpu().to(torch.float32)
             out_list.append(out)
 
+        self.run_windows(images_tensor, window_size, run_window, "segmenter")
+        self.profiler.set_window(None)
+
         # merge outputs
         outputs = {}
         outputs['pred_logits'] = torch.cat([x['pred_logits'] for x in out_list], dim=1).detach()
@@ -430,6 +521,12 @@ class CAVIS_segmenter(MinVIS):
         max_iter_num,
         window_size,
         task,
+        low_res_merge=False,
+        frame_chunk_size=0,
+        mask_format="bitmask",
+        mask_storage_dtype="float32",
+        profiler=None,
+        window_tuner=None,
     ):
         """
         Args:
@@ -460,6 +557,16 @@ class CAVIS_segmenter(MinVIS):
             max_iter_num: the iter nums
             window_size: the number of images processed by the segmenter at a time
             task: VIS, VSS or VPS
+            low_res_merge: for VPS and VSS, merge the masks at mask resolution and upsample
+                the id map with nearest interpolation
+            frame_chunk_size: for VIS and VSS, the number of frames upsampled at a time,
+                all frames at once if 0
+            mask_format: for VIS, the format of the output masks, "bitmask", "packed" or "rle"
+            mask_storage_dtype: the dtype of the mask logits of the video kept on the host,
+                "float32", "float16", "bfloat16" or "uint8" (quantized probabilities)
+            profiler: a StageProfiler timing the stages of the forward, disabled if None
+            window_tuner: a WindowSizeTuner picking the window size of window inference from
+                the memory budget, window_size is used if None
         """
         super().__init__(
             backbone=backbone,
@@ -476,13 +583,19 @@ class CAVIS_segmenter(MinVIS):
             # video
             num_frames=num_frames,
             window_inference=window_inference,
+            window_size=window_size,
+            profiler=profiler,
+            window_tuner=window_tuner,
         )
         self.max_num = max_num
         self.iter = 0
         self.max_iter_num = max_iter_num
 
-        self.window_size = window_size
         self.task = task
+        self.low_res_merge = low_res_merge
+        self.frame_chunk_size = frame_chunk_size
+        self.mask_format = mask_format
+        self.mask_storage_dtype = mask_storage_dtype
         assert self.task in ['vis', 'vss', 'vps'], "Only support vis, vss and vps !"
         inference_dict = {
             'vis': self.inference_video_vis,
@@ -569,6 +682,12 @@ class CAVIS_segmenter(MinVIS):
             "max_iter_num": max_iter_num,
             "window_size": cfg.MODEL.MASK_FORMER.TEST.WINDOW_SIZE,
             "task": cfg.MODEL.MASK_FORMER.TEST.TASK,
+            "low_res_merge": cfg.MODEL.MASK_FORMER.TEST.LOW_RES_MERGE,
+            "frame_chunk_size": cfg.MODEL.MASK_FORMER.TEST.FRAME_CHUNK_SIZE,
+            "mask_format": cfg.MODEL.MASK_FORMER.TEST.VIS_MASK_FORMAT,
+            "mask_storage_dtype": cfg.MODEL.MASK_FORMER.TEST.MASK_STORAGE_DTYPE,
+            "profiler": build_profiler(cfg),
+            "window_tuner": build_window_tuner(cfg),
         }
 
     def forward(self, batched_inputs):
@@ -609,18 +728,15 @@ class CAVIS_segmenter(MinVIS):
                     "task": "vps".
         """
 
-        images = []
-        for video in batched_inputs:
-            for frame in video["image"]:
-                images.append(frame.to(self.device))
-        images = [(x - self.pixel_mean) / self.pixel_std for x in images]
-        images = ImageList.from_tensors(images, self.size_divisibility)
+        images = self.preprocess_image(batched_inputs)
 
         if not self.training and self.window_inference:
             outputs = self.run_window_inference(images.tensor, window_size=self.window_size)
         else:
-            features = self.backbone(images.tensor)
-            outputs = self.sem_seg_head(features)
+            with self.profiler.stage("backbone"):
+                features = self.backbone(images.tensor)
+            with self.profiler.stage("sem_seg_head"):
+                outputs = self.sem_seg_head(features)
                 
         if self.training:
             targets = self.prepare_targets(batched_inputs, images)
@@ -630,7 +746,8 @@ class CAVIS_segmenter(MinVIS):
             outputs, targets = self.frame_decoder_loss_reshape(outputs, targets)
             
             # It contains L_ctx (See Eq. (8) in Sec. 4.1.1)
-            losses = self.criterion(outputs, targets)
+            with self.profiler.stage("criterion"):
+                losses = self.criterion(outputs, targets)
             
             losses.update(prototypical_loss)
 
@@ -640,10 +757,11 @@ class CAVIS_segmenter(MinVIS):
                 else:
                     # remove this loss if not specified in `weight_dict`
                     losses.pop(k)
-                                
+            self.profiler.flush(training=True)
             return losses
         else:
-            outputs = self.post_processing(outputs)
+            with self.profiler.stage("post_processing"):
+                outputs = self.post_processing(outputs)
 
             mask_cls_results = outputs["pred_logits"]
             mask_pred_results = outputs["pred_masks"]
@@ -660,9 +778,14 @@ class CAVIS_segmenter(MinVIS):
             height = input_per_image.get("height", image_size[0])  # raw image size before data augmentation
             width = input_per_image.get("width", image_size[1])
 
-            return retry_if_cuda_oom(self.inference_video_task)(
-                mask_cls_result, mask_pred_result, image_size, height, width, first_resize_size, pred_id
-            )   
+            with self.profiler.stage("inference_video_{}".format(self.task)):
+                video_output = retry_if_cuda_oom(self.inference_video_task)(
+                    mask_cls_result, mask_pred_result, image_size, height, width, first_resize_size, pred_id
+                )
+            self.profiler.flush(
+                training=False, video_id=input_per_image.get("video_id"), num_frames=len(images.tensor)
+            )
+            return video_output
 
     def get_prototypical_contrastive_loss(self, outputs, targets):
         contrastive_items = []
@@ -728,30 +851,11 @@ class CAVIS_segmenter(MinVIS):
         pred_logits, pred_masks, pred_embds = outputs['pred_logits'], outputs['pred_masks'], outputs['pred_embds']
 
         pred_logits = pred_logits[0]
-        pred_masks = einops.rearrange(pred_masks[0], 'q t h w -> t q h w')
         pred_embds = einops.rearrange(pred_embds[0], 'c t q -> t q c')
 
-        pred_logits = list(torch.unbind(pred_logits))
-        pred_masks = list(torch.unbind(pred_masks))
-        pred_embds = list(torch.unbind(pred_embds))
-
-        out_logits = []
-        out_masks = []
-        out_embds = []
-        out_logits.append(pred_logits[0])
-        out_masks.append(pred_masks[0])
-        out_embds.append(pred_embds[0])
-
-        # match the instances frame by frame
-        for i in range(1, len(pred_logits)):
-            indices = self.match_from_embds(out_embds[-1], pred_embds[i])
-
-            out_logits.append(pred_logits[i][indices, :])
-            out_masks.append(pred_masks[i][indices, :, :])
-            out_embds.append(pred_embds[i][indices, :])
-
-        out_logits = sum(out_logits)/len(out_logits)
-        out_masks = torch.stack(out_masks, dim=1)  # q h w -> q t h w
+        # match the instances of all the frames at once
+        perms = match_consecutive_frames(pred_embds)
+        out_logits, out_masks = apply_frame_permutations(perms, pred_logits, pred_masks[0])
 
         out_logits = out_logits.unsqueeze(0)
         out_masks = out_masks.unsqueeze(0)
@@ -763,23 +867,24 @@ class CAVIS_segmenter(MinVIS):
         return outputs
 
     def run_window_inference(self, images_tensor, window_size=30):
-        iters = len(images_tensor) // window_size
-        if len(images_tensor) % window_size != 0:
-            iters += 1
         out_list = []
-        for i in range(iters):
-            start_idx = i * window_size
-            end_idx = (i+1) * window_size
 
-            features = self.backbone(images_tensor[start_idx:end_idx])
-            out = self.sem_seg_head(features)
+        def run_window(i, frames):
+            self.profiler.set_window(i)
+            with self.profiler.stage("backbone"):
+                features = self.backbone(frames)
+            with self.profiler.stage("sem_seg_head"):
+                out = self.sem_seg_head(features)
             del features['res2'], features['res3'], features['res4'], features['res5']
             for j in range(len(out['aux_outputs'])):
                 del out['aux_outputs'][j]['pred_masks'], out['aux_outputs'][j]['pred_logits']
             del out['pred_reid_embed'], out['mask_features'], out['pred_embds_without_norm']
-            out['pred_masks'] = out['pred_masks'].detach().cpu().to(torch.float32)
+            out['pred_masks'] = store_mask_logits(out['pred_masks'], self.mask_storage_dtype)
             out_list.append(out)
 
+        self.run_windows(images_tensor, window_size, run_window, "segmenter")
+        self.profiler.set_window(None)
+
         # merge outputs
         outputs = {}
         outputs['pred_logits'] = torch.cat([x['pred_logits'] for x in out_list], dim=1).detach()
@@ -807,21 +912,14 @@ class CAVIS_segmenter(MinVIS):
             pred_masks = pred_masks[topk_indices]
             pred_ids = pred_id[topk_indices]
 
-            # interpolation to original image size
-            pred_masks = F.interpolate(
-                pred_masks, size=first_resize_size, mode="bilinear", align_corners=False
+            out_masks = video_instance_masks(
+                pred_masks, img_size, first_resize_size, (output_height, output_width),
+                frame_chunk_size=self.frame_chunk_size, mask_format=self.mask_format,
             )
-            pred_masks = pred_masks[:, :, : img_size[0], : img_size[1]]
-            pred_masks = F.interpolate(
-                pred_masks, size=(output_height, output_width), mode="bilinear", align_corners=False
-            )
-            masks = pred_masks > 0.
-            del pred_masks
 
             out_scores = scores_per_image.tolist()
             out_labels = labels_per_image.tolist()
             out_ids = pred_ids.tolist()
-            out_masks = [m for m in masks.cpu()]
         else:
             out_scores = []
             out_labels = []
@@ -833,6 +931,7 @@ class CAVIS_segmenter(MinVIS):
             "pred_scores": out_scores,
             "pred_labels": out_labels,
             "pred_masks": out_masks,
+            "mask_format": self.mask_format,
             "pred_ids": out_ids,
             "task": "vis",
         }
@@ -855,74 +954,48 @@ class CAVIS_segmenter(MinVIS):
         cur_scores = scores[keep]
         cur_classes = labels[keep]
         cur_ids = pred_id[keep]
-        cur_masks = mask_pred[keep]
-
-        # interpolation to original image size
-        cur_masks = F.interpolate(
-            cur_masks, size=first_resize_size, mode="bilinear", align_corners=False
-        )
-        cur_masks = cur_masks[:, :, :img_size[0], :img_size[1]].sigmoid()
-        cur_masks = F.interpolate(
-            cur_masks, size=(output_height, output_width), mode="bilinear", align_corners=False
-        )
-        cur_prob_masks = cur_scores.view(-1, 1, 1, 1).to(cur_masks.device) * cur_masks
-
-        # initial panoptic_seg and segments infos
-        h, w = cur_masks.shape[-2:]
-        panoptic_seg = torch.zeros((cur_masks.size(1), h, w), dtype=torch.int32, device=cur_masks.device)
-        segments_infos = []
-        out_ids = []
-        current_segment_id = 0
+        cur_masks = load_mask_logits(mask_pred[keep])
 
         if cur_masks.shape[0] == 0:
             # We didn't detect any mask
+            panoptic_seg = torch.zeros(
+                (cur_masks.size(1), output_height, output_width), dtype=torch.int32, device=cur_masks.device
+            )
             return {
                 "image_size": (output_height, output_width),
                 "pred_masks": panoptic_seg.cpu(),
-                "segments_infos": segments_infos,
-                "pred_ids": out_ids,
+                "segments_infos": [],
+                "pred_ids": [],
                 "task": "vps",
             }
+
+        if self.low_res_merge:
+            # merge at mask resolution and upsample the id map
+            cur_masks = crop_to_image(cur_masks, img_size, first_resize_size).sigmoid()
         else:
-            # take argmax
-            cur_mask_ids = cur_prob_masks.argmax(0)  # (t, h, w)
-            stuff_memory_list = {}
-            for k in range(cur_classes.shape[0]):
-                pred_class = cur_classes[k].item()
-                isthing = pred_class < len(self.metadata.thing_dataset_id_to_contiguous_id)
-                # filter out the unstable segmentation results
-                mask_area = (cur_mask_ids == k).sum().item()
-                original_area = (cur_masks[k] >= 0.5).sum().item()
-                mask = (cur_mask_ids == k) & (cur_masks[k] >= 0.5)
-                if mask_area > 0 and original_area > 0 and mask.sum().item() > 0:
-                    if mask_area / original_area < self.overlap_threshold:
-                        continue
-                    # merge stuff regions
-                    if not isthing:
-                        if int(pred_class) in stuff_memory_list.keys():
-                            panoptic_seg[mask] = stuff_memory_list[int(pred_class)]
-                            continue
-                        else:
-                            stuff_memory_list[int(pred_class)] = current_segment_id + 1
-                    current_segment_id += 1
-                    panoptic_seg[mask] = current_segment_id
-
-                    segments_infos.append(
-                        {
-                            "id": current_segment_id,
-                            "isthing": bool(isthing),
-                            "category_id": int(pred_class),
-                        }
-                    )
-                    out_ids.append(cur_ids[k])
+            # interpolation to original image size
+            cur_masks = F.interpolate(
+                cur_masks, size=first_resize_size, mode="bilinear", align_corners=False
+            )
+            cur_masks = cur_masks[:, :, :img_size[0], :img_size[1]].sigmoid()
+            cur_masks = F.interpolate(
+                cur_masks, size=(output_height, output_width), mode="bilinear", align_corners=False
+            )
 
-            return {
-                "image_size": (output_height, output_width),
-                "pred_masks": panoptic_seg.cpu(),
-                "segments_infos": segments_infos,
-                "pred_ids": out_ids,
-                "task": "vps",
-            }
+        panoptic_seg, segments_infos, segment_queries = panoptic_merge(
+            cur_masks, cur_scores, cur_classes,
+            len(self.metadata.thing_dataset_id_to_contiguous_id), self.overlap_threshold,
+        )
+        if self.low_res_merge:
+            panoptic_seg = upsample_ids(panoptic_seg, (output_height, output_width))
+
+        return {
+            "image_size": (output_height, output_width),
+            "pred_masks": panoptic_seg.cpu(),
+            "segments_infos": segments_infos,
+            "pred_ids": [cur_ids[k] for k in segment_queries],
+            "task": "vps",
+        }
 
     def inference_video_vss(
         self, pred_cls, pred_masks, img_size, output_height, output_width,
@@ -932,22 +1005,13 @@ class CAVIS_segmenter(MinVIS):
         if aux_pred_cls is not None:
             aux_pred_cls = F.softmax(aux_pred_cls, dim=-1)[:, :-1]
             mask_cls = torch.maximum(mask_cls, aux_pred_cls.to(mask_cls))
-        mask_pred = pred_masks
-        # interpolation to original image size
-        cur_masks = F.interpolate(
-            mask_pred, size=first_resize_size, mode="bilinear", align_corners=False
-        )
-        cur_masks = cur_masks[:, :, :img_size[0], :img_size[1]].sigmoid()
-        cur_masks = F.interpolate(
-            cur_masks, size=(output_height, output_width), mode="bilinear", align_corners=False
+        sem_mask = semantic_fusion(
+            mask_cls, pred_masks, img_size, first_resize_size, (output_height, output_width),
+            frame_chunk_size=self.frame_chunk_size, low_res=self.low_res_merge,
         )
-
-        semseg = torch.einsum("qc,qthw->cthw", mask_cls, cur_masks)
-        sem_score, sem_mask = semseg.max(0)
-        sem_mask = sem_mask
         return {
                 "image_size": (output_height, output_width),
-                "pred_masks": sem_mask.cpu(),
+                "pred_masks": sem_mask,
                 "task": "vss",
             }
 
@@ -983,6 +1047,12 @@ class CAVIS_online(MinVIS):
         window_size,
         task,
         use_cl,
+        low_res_merge=False,
+        frame_chunk_size=0,
+        mask_format="bitmask",
+        mask_storage_dtype="float32",
+        profiler=None,
+        window_tuner=None,
     ):
         """
         Args:
@@ -1013,6 +1083,16 @@ class CAVIS_online(MinVIS):
             max_iter_num: the iter nums
             window_size: the number of images processed by the segmenter at a time
             task: VIS, VSS or VPS
+            low_res_merge: for VPS and VSS, merge the masks at mask resolution and upsample
+                the id map with nearest interpolation
+            frame_chunk_size: for VIS and VSS, the number of frames upsampled at a time,
+                all frames at once if 0
+            mask_format: for VIS, the format of the output masks, "bitmask", "packed" or "rle"
+            mask_storage_dtype: the dtype of the mask logits of the video kept on the host,
+                "float32", "float16", "bfloat16" or "uint8" (quantized probabilities)
+            profiler: a StageProfiler shared with the tracker, disabled if None
+            window_tuner: a WindowSizeTuner picking the window size of window inference from
+                the memory budget, window_size is used if None
         """
         super().__init__(
             backbone=backbone,
@@ -1029,6 +1109,9 @@ class CAVIS_online(MinVIS):
             # video
             num_frames=num_frames,
             window_inference=window_inference,
+            window_size=window_size,
+            profiler=profiler,
+            window_tuner=window_tuner,
         )
         # freeze the segmenter
         for p in self.backbone.parameters():
@@ -1041,8 +1124,11 @@ class CAVIS_online(MinVIS):
         self.iter = 0
         self.max_iter_num = max_iter_num
 
-        self.window_size = window_size
         self.task = task
+        self.low_res_merge = low_res_merge
+        self.frame_chunk_size = frame_chunk_size
+        self.mask_format = mask_format
+        self.mask_storage_dtype = mask_storage_dtype
         assert self.task in ['vis', 'vss', 'vps'], "Only support vis, vss and vps !"
         inference_dict = {
             'vis': self.inference_video_vis,
@@ -1109,6 +1195,7 @@ class CAVIS_online(MinVIS):
             importance_sample_ratio=cfg.MODEL.MASK_FORMER.IMPORTANCE_SAMPLE_RATIO,
         )
 
+        profiler = build_profiler(cfg)
         tracker = CAVIS_Tracker(
             hidden_channel=cfg.MODEL.MASK_FORMER.HIDDEN_DIM,
             feedforward_channel=cfg.MODEL.MASK_FORMER.DIM_FEEDFORWARD,
@@ -1116,6 +1203,10 @@ class CAVIS_online(MinVIS):
             decoder_layer_num=cfg.MODEL.TRACKER.DECODER_LAYERS,
             mask_dim=cfg.MODEL.MASK_FORMER.HIDDEN_DIM,
             class_num=cfg.MODEL.SEM_SEG_HEAD.NUM_CLASSES,
+            prune_queries=cfg.MODEL.TRACKER.QUERY_PRUNING,
+            prune_threshold=cfg.MODEL.TRACKER.PRUNE_THRESHOLD,
+            prune_decay=cfg.MODEL.TRACKER.PRUNE_DECAY,
+            profiler=profiler,
         )
 
         max_iter_num = cfg.SOLVER.MAX_ITER
@@ -1140,7 +1231,13 @@ class CAVIS_online(MinVIS):
             "max_iter_num": max_iter_num,
             "window_size": cfg.MODEL.MASK_FORMER.TEST.WINDOW_SIZE,
             "task": cfg.MODEL.MASK_FORMER.TEST.TASK,
+            "low_res_merge": cfg.MODEL.MASK_FORMER.TEST.LOW_RES_MERGE,
+            "frame_chunk_size": cfg.MODEL.MASK_FORMER.TEST.FRAME_CHUNK_SIZE,
+            "mask_format": cfg.MODEL.MASK_FORMER.TEST.VIS_MASK_FORMAT,
+            "mask_storage_dtype": cfg.MODEL.MASK_FORMER.TEST.MASK_STORAGE_DTYPE,
             "use_cl": cfg.MODEL.TRACKER.USE_CL,
+            "profiler": profiler,
+            "window_tuner": build_window_tuner(cfg),
         }
 
     def forward(self, batched_inputs):
@@ -1186,12 +1283,7 @@ class CAVIS_online(MinVIS):
         else:
             self.keep = False
 
-        images = []
-        for video in batched_inputs:
-            for frame in video["image"]:
-                images.append(frame.to(self.device))
-        images = [(x - self.pixel_mean) / self.pixel_std for x in images]
-        images = ImageList.from_tensors(images, self.size_divisibility)
+        images = self.preprocess_image(batched_inputs)
 
         if not self.training and self.window_inference:
             outputs = self.run_window_inference(images.tensor, window_size=self.window_size)
@@ -1199,16 +1291,19 @@ class CAVIS_online(MinVIS):
             self.backbone.eval()
             self.sem_seg_head.eval()
             with torch.no_grad():
-                features = self.backbone(images.tensor)
-                image_outputs = self.sem_seg_head(features)
+                with self.profiler.stage("backbone"):
+                    features = self.backbone(images.tensor)
+                with self.profiler.stage("sem_seg_head"):
+                    image_outputs = self.sem_seg_head(features)
                 
                 frame_embds = image_outputs['pred_embds'].clone().detach()  # (b, c, t, q)
                 frame_embds_no_norm = image_outputs['pred_embds_without_norm'].clone().detach()
                 mask_features = image_outputs['mask_features'].clone().detach().unsqueeze(0)
                 del image_outputs['mask_features'], image_outputs['pred_reid_embed']
                 torch.cuda.empty_cache()
-            outputs, indices = self.tracker(frame_embds, mask_features, return_indices=True, resume=self.keep,
-                                            frame_embeds_no_norm=frame_embds_no_norm)
+            with self.profiler.stage("tracker"):
+                outputs, indices = self.tracker(frame_embds, mask_features, return_indices=True, resume=self.keep,
+                                                frame_embeds_no_norm=frame_embds_no_norm)
             image_outputs = self.reset_image_output_order(image_outputs, indices)
 
         if self.training:
@@ -1217,14 +1312,15 @@ class CAVIS_online(MinVIS):
             image_outputs, outputs, targets = self.frame_decoder_loss_reshape(
                 outputs, targets, image_outputs=image_outputs
             )
-            if self.iter < self.max_iter_num // 2:
-                losses, reference_match_result = self.criterion(outputs, targets,
-                                                                matcher_outputs=image_outputs,
-                                                                ret_match_result=True)
-            else:
-                losses, reference_match_result = self.criterion(outputs, targets,
-                                                                matcher_outputs=None,
-                                                                ret_match_result=True)
+            with self.profiler.stage("criterion"):
+                if self.iter < self.max_iter_num // 2:
+                    losses, reference_match_result = self.criterion(outputs, targets,
+                                                                    matcher_outputs=image_outputs,
+                                                                    ret_match_result=True)
+                else:
+                    losses, reference_match_result = self.criterion(outputs, targets,
+                                                                    matcher_outputs=None,
+                                                                    ret_match_result=True)
             if self.use_cl:
                 losses_cl = self.get_cl_loss_ref(outputs, reference_match_result)
                 losses.update(losses_cl)
@@ -1237,9 +1333,11 @@ class CAVIS_online(MinVIS):
                 else:
                     # remove this loss if not specified in `weight_dict`
                     losses.pop(k)
+            self.profiler.flush(training=True)
             return losses
         else:
-            outputs = self.post_processing(outputs)
+            with self.profiler.stage("post_processing"):
+                outputs = self.post_processing(outputs)
             mask_cls_results = outputs["pred_logits"]
             mask_pred_results = outputs["pred_masks"]
             pred_ids = outputs["ids"]
@@ -1255,9 +1353,14 @@ class CAVIS_online(MinVIS):
             height = input_per_image.get("height", image_size[0])  # raw image size before data augmentation
             width = input_per_image.get("width", image_size[1])
 
-            return retry_if_cuda_oom(self.inference_video_task)(
-                mask_cls_result, mask_pred_result, image_size, height, width, first_resize_size, pred_id
+            with self.profiler.stage("inference_video_{}".format(self.task)):
+                video_output = retry_if_cuda_oom(self.inference_video_task)(
+                    mask_cls_result, mask_pred_result, image_size, height, width, first_resize_size, pred_id
+                )
+            self.profiler.flush(
+                training=False, video_id=input_per_image.get("video_id"), num_frames=len(images.tensor)
             )
+            return video_output
 
     def frame_decoder_loss_reshape(self, outputs, targets, image_outputs=None):
         outputs['pred_masks'] = einops.rearrange(outputs['pred_masks'], 'b q t h w -> (b t) q () h w')
@@ -1316,16 +1419,15 @@ class CAVIS_online(MinVIS):
         return outputs
 
     def run_window_inference(self, images_tensor, window_size=30):
-        iters = len(images_tensor) // window_size
-        if len(images_tensor) % window_size != 0:
-            iters += 1
         out_list = []
-        for i in range(iters):
-            start_idx = i * window_size
-            end_idx = (i+1) * window_size
+
+        def run_window(i, frames):
             # segmeter inference
-            features = self.backbone(images_tensor[start_idx:end_idx])
-            out = self.sem_seg_head(features)
+            self.profiler.set_window(i)
+            with self.profiler.stage("backbone"):
+                features = self.backbone(frames)
+            with self.profiler.stage("sem_seg_head"):
+                out = self.sem_seg_head(features)
             
             # remove unnecessary variables to save GPU memory
             del features['res2'], features['res3'], features['res4'], features['res5']
@@ -1336,24 +1438,30 @@ class CAVIS_online(MinVIS):
             frame_embds = out['pred_embds']  # (b, c, t, q)
             frame_embds_no_norm = out['pred_embds_without_norm']
             mask_features = out['mask_features'].unsqueeze(0)
-            if i != 0 or self.keep:
-                track_out = self.tracker(frame_embds, mask_features, resume=True, 
-                                         frame_embeds_no_norm=frame_embds_no_norm)
-            else:
-                track_out = self.tracker(frame_embds, mask_features,
-                                         frame_embeds_no_norm=frame_embds_no_norm)
+            with self.profiler.stage("tracker"):
+                if i != 0 or self.keep:
+                    track_out = self.tracker(frame_embds, mask_features, resume=True,
+                                             frame_embeds_no_norm=frame_embds_no_norm,
+                                             frame_logits=out['pred_logits'])
+                else:
+                    track_out = self.tracker(frame_embds, mask_features,
+                                             frame_embeds_no_norm=frame_embds_no_norm,
+                                             frame_logits=out['pred_logits'])
             # remove unnecessary variables to save GPU memory
             del mask_features
             for j in range(len(track_out['aux_outputs'])):
                 del track_out['aux_outputs'][j]['pred_masks'], track_out['aux_outputs'][j]['pred_logits']
             track_out['pred_logits'] = track_out['pred_logits'].to(torch.float32).detach().cpu()
-            track_out['pred_masks'] = track_out['pred_masks'].to(torch.float32).detach().cpu()
+            track_out['pred_masks'] = store_mask_logits(track_out['pred_masks'], self.mask_storage_dtype)
             track_out['pred_embds'] = track_out['pred_embds'].to(torch.float32).detach().cpu()
             # track_out['pred_logits'] = track_out['pred_logits'].detach()
             # track_out['pred_masks'] = track_out['pred_masks'].detach()
             # track_out['pred_embds'] = track_out['pred_embds'].detach()
             out_list.append(track_out)
 
+        self.run_windows(images_tensor, window_size, run_window, "online", tracker=self.tracker)
+        self.profiler.set_window(None)
+
         # merge outputs
         outputs = {}
         outputs['pred_logits'] = torch.cat([x['pred_logits'] for x in out_list], dim=1)
@@ -1381,21 +1489,14 @@ class CAVIS_online(MinVIS):
             pred_masks = pred_masks[topk_indices]
             pred_ids = pred_id[topk_indices]
 
-            # interpolation to original image size
-            pred_masks = F.interpolate(
-                pred_masks, size=first_resize_size, mode="bilinear", align_corners=False
-            )
-            pred_masks = pred_masks[:, :, : img_size[0], : img_size[1]]
-            pred_masks = F.interpolate(
-                pred_masks, size=(output_height, output_width), mode="bilinear", align_corners=False
+            out_masks = video_instance_masks(
+                pred_masks, img_size, first_resize_size, (output_height, output_width),
+                frame_chunk_size=self.frame_chunk_size, mask_format=self.mask_format,
             )
-            masks = pred_masks > 0.
-            del pred_masks
 
             out_scores = scores_per_image.tolist()
             out_labels = labels_per_image.tolist()
             out_ids = pred_ids.tolist()
-            out_masks = [m for m in masks.cpu()]
         else:
             out_scores = []
             out_labels = []
@@ -1407,6 +1508,7 @@ class CAVIS_online(MinVIS):
             "pred_scores": out_scores,
             "pred_labels": out_labels,
             "pred_masks": out_masks,
+            "mask_format": self.mask_format,
             "pred_ids": out_ids,
             "task": "vis",
         }
@@ -1429,74 +1531,48 @@ class CAVIS_online(MinVIS):
         cur_scores = scores[keep]
         cur_classes = labels[keep]
         cur_ids = pred_id[keep]
-        cur_masks = mask_pred[keep]
-
-        # interpolation to original image size
-        cur_masks = F.interpolate(
-            cur_masks, size=first_resize_size, mode="bilinear", align_corners=False
-        )
-        cur_masks = cur_masks[:, :, :img_size[0], :img_size[1]].sigmoid()
-        cur_masks = F.interpolate(
-            cur_masks, size=(output_height, output_width), mode="bilinear", align_corners=False
-        )
-        cur_prob_masks = cur_scores.view(-1, 1, 1, 1).to(cur_masks.device) * cur_masks
-
-        # initial panoptic_seg and segments infos
-        h, w = cur_masks.shape[-2:]
-        panoptic_seg = torch.zeros((cur_masks.size(1), h, w), dtype=torch.int32, device=cur_masks.device)
-        segments_infos = []
-        out_ids = []
-        current_segment_id = 0
+        cur_masks = load_mask_logits(mask_pred[keep])
 
         if cur_masks.shape[0] == 0:
             # We didn't detect any mask
+            panoptic_seg = torch.zeros(
+                (cur_masks.size(1), output_height, output_width), dtype=torch.int32, device=cur_masks.device
+            )
             return {
                 "image_size": (output_height, output_width),
                 "pred_masks": panoptic_seg.cpu(),
-                "segments_infos": segments_infos,
-                "pred_ids": out_ids,
+                "segments_infos": [],
+                "pred_ids": [],
                 "task": "vps",
             }
+
+        if self.low_res_merge:
+            # merge at mask resolution and upsample the id map
+            cur_masks = crop_to_image(cur_masks, img_size, first_resize_size).sigmoid()
         else:
-            # take argmax
-            cur_mask_ids = cur_prob_masks.argmax(0)  # (t, h, w)
-            stuff_memory_list = {}
-            for k in range(cur_classes.shape[0]):
-                pred_class = cur_classes[k].item()
-                isthing = pred_class < len(self.metadata.thing_dataset_id_to_contiguous_id)
-                # filter out the unstable segmentation results
-                mask_area = (cur_mask_ids == k).sum().item()
-                original_area = (cur_masks[k] >= 0.5).sum().item()
-                mask = (cur_mask_ids == k) & (cur_masks[k] >= 0.5)
-                if mask_area > 0 and original_area > 0 and mask.sum().item() > 0:
-                    if mask_area / original_area < self.overlap_threshold:
-                        continue
-                    # merge stuff regions
-                    if not isthing:
-                        if int(pred_class) in stuff_memory_list.keys():
-                            panoptic_seg[mask] = stuff_memory_list[int(pred_class)]
-                            continue
-                        else:
-                            stuff_memory_list[int(pred_class)] = current_segment_id + 1
-                    current_segment_id += 1
-                    panoptic_seg[mask] = current_segment_id
-
-                    segments_infos.append(
-                        {
-                            "id": current_segment_id,
-                            "isthing": bool(isthing),
-                            "category_id": int(pred_class),
-                        }
-                    )
-                    out_ids.append(cur_ids[k])
+            # interpolation to original image size
+            cur_masks = F.interpolate(
+                cur_masks, size=first_resize_size, mode="bilinear", align_corners=False
+            )
+            cur_masks = cur_masks[:, :, :img_size[0], :img_size[1]].sigmoid()
+            cur_masks = F.interpolate(
+                cur_masks, size=(output_height, output_width), mode="bilinear", align_corners=False
+            )
 
-            return {
-                "image_size": (output_height, output_width),
-                "pred_masks": panoptic_seg.cpu(),
-                "segments_infos": segments_infos,
-                "pred_ids": out_ids,
-                "task": "vps",
-            }
+        panoptic_seg, segments_infos, segment_queries = panoptic_merge(
+            cur_masks, cur_scores, cur_classes,
+            len(self.metadata.thing_dataset_id_to_contiguous_id), self.overlap_threshold,
+        )
+        if self.low_res_merge:
+            panoptic_seg = upsample_ids(panoptic_seg, (output_height, output_width))
+
+        return {
+            "image_size": (output_height, output_width),
+            "pred_masks": panoptic_seg.cpu(),
+            "segments_infos": segments_infos,
+            "pred_ids": [cur_ids[k] for k in segment_queries],
+            "task": "vps",
+        }
 
     def inference_video_vss(
         self, pred_cls, pred_masks, img_size, output_height, output_width,
@@ -1506,22 +1582,13 @@ class CAVIS_online(MinVIS):
         if aux_pred_cls is not None:
             aux_pred_cls = F.softmax(aux_pred_cls, dim=-1)[:, :-1]
             mask_cls = torch.maximum(mask_cls, aux_pred_cls.to(mask_cls))
-        mask_pred = pred_masks
-        # interpolation to original image size
-        cur_masks = F.interpolate(
-            mask_pred, size=first_resize_size, mode="bilinear", align_corners=False
-        )
-        cur_masks = cur_masks[:, :, :img_size[0], :img_size[1]].sigmoid()
-        cur_masks = F.interpolate(
-            cur_masks, size=(output_height, output_width), mode="bilinear", align_corners=False
+        sem_mask = semantic_fusion(
+            mask_cls, pred_masks, img_size, first_resize_size, (output_height, output_width),
+            frame_chunk_size=self.frame_chunk_size, low_res=self.low_res_merge,
         )
-
-        semseg = torch.einsum("qc,qthw->cthw", mask_cls, cur_masks)
-        sem_score, sem_mask = semseg.max(0)
-        sem_mask = sem_mask
         return {
                 "image_size": (output_height, output_width),
-                "pred_masks": sem_mask.cpu(),
+                "pred_masks": sem_mask,
                 "task": "vss",
             }
         
@@ -1641,6 +1708,14 @@ class CAVIS_offline(CAVIS_online):
         max_iter_num,
         window_size,
         task,
+        low_res_merge=False,
+        frame_chunk_size=0,
+        mask_format="bitmask",
+        mask_storage_dtype="float32",
+        mask_feature_store_dir="",
+        segmenter_window_size=21,
+        profiler=None,
+        window_tuner=None,
     ):
         """
         Args:
@@ -1672,6 +1747,20 @@ class CAVIS_offline(CAVIS_online):
             max_iter_num: the iter nums
             window_size: the number of images processed by the segmenter at a time
             task: VIS, VSS or VPS
+            low_res_merge: for VPS and VSS, merge the masks at mask resolution and upsample
+                the id map with nearest interpolation
+            frame_chunk_size: for VIS and VSS, the number of frames upsampled at a time,
+                all frames at once if 0
+            mask_format: for VIS, the format of the output masks, "bitmask", "packed" or "rle"
+            mask_storage_dtype: the dtype of the mask logits of the video kept on the host,
+                "float32", "float16", "bfloat16" or "uint8" (quantized probabilities)
+            mask_feature_store_dir: if not empty, the mask features of the video are spilled to a
+                memory-mapped fp16 file in this directory instead of being kept in host memory
+            segmenter_window_size: the number of images processed by the segmenter at a time
+                during training, and at inference without window_inference
+            profiler: a StageProfiler shared with the tracker, disabled if None
+            window_tuner: a WindowSizeTuner picking the window size of the segmenter and of window
+                inference from the memory budget, the given window sizes are used if None
         """
         super().__init__(
             backbone=backbone,
@@ -1693,6 +1782,12 @@ class CAVIS_offline(CAVIS_online):
             max_iter_num=max_iter_num,
             window_size=window_size,
             task=task,
+            low_res_merge=low_res_merge,
+            frame_chunk_size=frame_chunk_size,
+            mask_format=mask_format,
+            mask_storage_dtype=mask_storage_dtype,
+            profiler=profiler,
+            window_tuner=window_tuner,
         )
 
         # frozen the referring tracker
@@ -1700,6 +1795,8 @@ class CAVIS_offline(CAVIS_online):
             p.requires_grad_(False)
 
         self.refiner = refiner
+        self.mask_feature_store_dir = mask_feature_store_dir
+        self.segmenter_window_size = segmenter_window_size
 
     @classmethod
     def from_config(cls, cfg):
@@ -1751,6 +1848,7 @@ class CAVIS_offline(CAVIS_online):
             importance_sample_ratio=cfg.MODEL.MASK_FORMER.IMPORTANCE_SAMPLE_RATIO,
         )
 
+        profiler = build_profiler(cfg)
         tracker = CAVIS_Tracker(
             hidden_channel=cfg.MODEL.MASK_FORMER.HIDDEN_DIM,
             feedforward_channel=cfg.MODEL.MASK_FORMER.DIM_FEEDFORWARD,
@@ -1758,6 +1856,10 @@ class CAVIS_offline(CAVIS_online):
             decoder_layer_num=cfg.MODEL.TRACKER.DECODER_LAYERS,
             mask_dim=cfg.MODEL.MASK_FORMER.HIDDEN_DIM,
             class_num=cfg.MODEL.SEM_SEG_HEAD.NUM_CLASSES,
+            prune_queries=cfg.MODEL.TRACKER.QUERY_PRUNING,
+            prune_threshold=cfg.MODEL.TRACKER.PRUNE_THRESHOLD,
+            prune_decay=cfg.MODEL.TRACKER.PRUNE_DECAY,
+            profiler=profiler,
         )
 
         refiner = TemporalRefiner(
@@ -1768,6 +1870,9 @@ class CAVIS_offline(CAVIS_online):
             mask_dim=cfg.MODEL.MASK_FORMER.HIDDEN_DIM,
             class_num=cfg.MODEL.SEM_SEG_HEAD.NUM_CLASSES,
             windows=cfg.MODEL.MASK_FORMER.TEST.WINDOW_SIZE,
+            chunk_size=cfg.MODEL.REFINER.CHUNK_SIZE,
+            chunk_overlap=cfg.MODEL.REFINER.CHUNK_OVERLAP,
+            mask_storage_dtype=cfg.MODEL.MASK_FORMER.TEST.MASK_STORAGE_DTYPE,
         )
 
         max_iter_num = cfg.SOLVER.MAX_ITER
@@ -1793,6 +1898,14 @@ class CAVIS_offline(CAVIS_online):
             "max_iter_num": max_iter_num,
             "window_size": cfg.MODEL.MASK_FORMER.TEST.WINDOW_SIZE,
             "task": cfg.MODEL.MASK_FORMER.TEST.TASK,
+            "low_res_merge": cfg.MODEL.MASK_FORMER.TEST.LOW_RES_MERGE,
+            "frame_chunk_size": cfg.MODEL.MASK_FORMER.TEST.FRAME_CHUNK_SIZE,
+            "mask_format": cfg.MODEL.MASK_FORMER.TEST.VIS_MASK_FORMAT,
+            "mask_storage_dtype": cfg.MODEL.MASK_FORMER.TEST.MASK_STORAGE_DTYPE,
+            "mask_feature_store_dir": cfg.MODEL.MASK_FORMER.TEST.MASK_FEATURE_STORE_DIR,
+            "segmenter_window_size": cfg.MODEL.REFINER.SEGMENTER_WINDOW_SIZE,
+            "profiler": profiler,
+            "window_tuner": build_window_tuner(cfg),
         }
 
     def forward(self, batched_inputs):
@@ -1837,12 +1950,7 @@ class CAVIS_offline(CAVIS_online):
         else:
             self.keep = False
 
-        images = []
-        for video in batched_inputs:
-            for frame in video["image"]:
-                images.append(frame.to(self.device))
-        images = [(x - self.pixel_mean) / self.pixel_std for x in images]
-        images = ImageList.from_tensors(images, self.size_divisibility)
+        images = self.preprocess_image(batched_inputs)
         self.backbone.eval()
         self.sem_seg_head.eval()
         self.tracker.eval()
@@ -1852,7 +1960,9 @@ class CAVIS_offline(CAVIS_online):
         else:
             with torch.no_grad():
                 # due to GPU memory limitations, the segmenter processes the video clip by clip.
-                image_outputs = self.segmentor_windows_inference(images.tensor, window_size=21)
+                image_outputs = self.segmentor_windows_inference(
+                    images.tensor, window_size=self.segmenter_window_size
+                )
                 frame_embds = image_outputs['pred_embds'].clone().detach()  # (b, c, t, q)
                 frame_embds_no_norm = image_outputs['pred_embds_without_norm'].clone().detach()  # (b, c, t, q)
                 mask_features = image_outputs['mask_features'].clone().detach().unsqueeze(0)
@@ -1860,11 +1970,12 @@ class CAVIS_offline(CAVIS_online):
                     image_outputs['pred_logits'], image_outputs['pred_embds']
 
                 # perform tracker/alignment
-                image_outputs = self.tracker(
-                    frame_embds, mask_features,
-                    resume=self.keep,
-                    frame_embeds_no_norm=frame_embds_no_norm
-                )
+                with self.profiler.stage("tracker"):
+                    image_outputs = self.tracker(
+                        frame_embds, mask_features,
+                        resume=self.keep,
+                        frame_embeds_no_norm=frame_embds_no_norm
+                    )
                 online_pred_logits = image_outputs['pred_logits']  # (b, t, q, c)
                 frame_embds_ = frame_embds_no_norm.clone().detach()
                 instance_embeds = image_outputs['pred_embds'].clone().detach()
@@ -1875,7 +1986,8 @@ class CAVIS_offline(CAVIS_online):
                     del image_outputs['aux_outputs'][j]['pred_masks'], image_outputs['aux_outputs'][j]['pred_logits']
                 torch.cuda.empty_cache()
             # do temporal refine
-            outputs = self.refiner(instance_embeds, frame_embds_, mask_features)
+            with self.profiler.stage("refiner"):
+                outputs = self.refiner(instance_embeds, frame_embds_, mask_features)
 
         if self.training:
             # mask classification target
@@ -1892,9 +2004,10 @@ class CAVIS_offline(CAVIS_online):
             self.iter += 1
 
             # bipartite matching-based loss
-            losses, _ = self.criterion(outputs, targets,
-                                            matcher_outputs=image_outputs,
-                                            ret_match_result=True)
+            with self.profiler.stage("criterion"):
+                losses, _ = self.criterion(outputs, targets,
+                                           matcher_outputs=image_outputs,
+                                           ret_match_result=True)
 
             for k in list(losses.keys()):
                 if k in self.criterion.weight_dict:
@@ -1902,9 +2015,11 @@ class CAVIS_offline(CAVIS_online):
                 else:
                     # remove this loss if not specified in `weight_dict`
                     losses.pop(k)
+            self.profiler.flush(training=True)
             return losses
         else:
-            outputs, aux_pred_logits = self.post_processing(outputs, aux_logits=online_pred_logits)
+            with self.profiler.stage("post_processing"):
+                outputs, aux_pred_logits = self.post_processing(outputs, aux_logits=online_pred_logits)
             mask_cls_results = outputs["pred_logits"]
             mask_pred_results = outputs["pred_masks"]
             pred_ids = outputs["ids"]
@@ -1920,24 +2035,26 @@ class CAVIS_offline(CAVIS_online):
             height = input_per_image.get("height", image_size[0])  # raw image size before data augmentation
             width = input_per_image.get("width", image_size[1])
 
-            return retry_if_cuda_oom(self.inference_video_task)(
-                mask_cls_result, mask_pred_result, image_size, height, width,
-                first_resize_size, pred_id, aux_pred_cls=aux_pred_logits,
+            with self.profiler.stage("inference_video_{}".format(self.task)):
+                video_output = retry_if_cuda_oom(self.inference_video_task)(
+                    mask_cls_result, mask_pred_result, image_size, height, width,
+                    first_resize_size, pred_id, aux_pred_cls=aux_pred_logits,
+                )
+            self.profiler.flush(
+                training=False, video_id=input_per_image.get("video_id"), num_frames=len(images.tensor)
             )
+            return video_output
 
-    def segmentor_windows_inference(self, images_tensor, window_size=5):
+    def segmentor_windows_inference(self, images_tensor, window_size):
         image_outputs = {}
-        iters = len(images_tensor) // window_size
-        if len(images_tensor) % window_size != 0:
-            iters += 1
-
         outs_list = []
-        for i in range(iters):
-            start_idx = i * window_size
-            end_idx = (i + 1) * window_size
 
-            features = self.backbone(images_tensor[start_idx:end_idx])
-            out = self.sem_seg_head(features)
+        def run_window(i, frames):
+            self.profiler.set_window(i)
+            with self.profiler.stage("backbone"):
+                features = self.backbone(frames)
+            with self.profiler.stage("sem_seg_head"):
+                out = self.sem_seg_head(features)
 
             del features['res2'], features['res3'], features['res4'], features['res5']
             del out['pred_masks'], out['pred_reid_embed']
@@ -1945,6 +2062,9 @@ class CAVIS_offline(CAVIS_online):
                 del out['aux_outputs'][j]['pred_masks'], out['aux_outputs'][j]['pred_logits']
             outs_list.append(out)
 
+        self.run_windows(images_tensor, window_size, run_window, "segmenter")
+        self.profiler.set_window(None)
+
         image_outputs['pred_embds'] = torch.cat([x['pred_embds'] for x in outs_list], dim=2).detach()
         image_outputs['mask_features'] = torch.cat([x['mask_features'] for x in outs_list], dim=0).detach()
         image_outputs['pred_logits'] = torch.cat([x['pred_logits'] for x in outs_list], dim=1).detach()
@@ -1974,22 +2094,21 @@ class CAVIS_offline(CAVIS_online):
         return image_outputs, outputs, gt_instances
 
     def run_window_inference(self, images_tensor, window_size=30):
-        iters = len(images_tensor) // window_size
-        if len(images_tensor) % window_size != 0:
-            iters += 1
-
-        overall_mask_features = []
+        if self.mask_feature_store_dir:
+            overall_mask_features = MaskFeatureStore(self.mask_feature_store_dir)
+        else:
+            overall_mask_features = []
         overall_frame_embds = []
         overall_instance_embds = []
         online_pred_logits = []
 
-        for i in range(iters):
-            start_idx = i * window_size
-            end_idx = (i+1) * window_size
-
+        def run_window(i, frames):
             # sementer inference
-            features = self.backbone(images_tensor[start_idx:end_idx])
-            out = self.sem_seg_head(features)
+            self.profiler.set_window(i)
+            with self.profiler.stage("backbone"):
+                features = self.backbone(frames)
+            with self.profiler.stage("sem_seg_head"):
+                out = self.sem_seg_head(features)
 
             del features['res2'], features['res3'], features['res4'], features['res5']
             del out['pred_masks'], out['pred_reid_embed']
@@ -1999,31 +2118,42 @@ class CAVIS_offline(CAVIS_online):
             frame_embds = out['pred_embds']  # (b, c, t, q)
             frame_embds_no_norm = out['pred_embds_without_norm']
             mask_features = out['mask_features'].unsqueeze(0)
-            overall_mask_features.append(mask_features.cpu())
-            overall_frame_embds.append(frame_embds_no_norm)
 
             # referring tracker inference
-            if i != 0:
-                track_out = self.tracker(frame_embds, mask_features, resume=True,
-                                         frame_embeds_no_norm=frame_embds_no_norm)
-            else:
-                track_out = self.tracker(frame_embds, mask_features,
-                                         frame_embeds_no_norm=frame_embds_no_norm)
-            online_pred_logits.append(track_out['pred_logits'].clone())
+            with self.profiler.stage("tracker"):
+                if i != 0:
+                    track_out = self.tracker(frame_embds, mask_features, resume=True,
+                                             frame_embeds_no_norm=frame_embds_no_norm,
+                                             frame_logits=out['pred_logits'])
+                else:
+                    track_out = self.tracker(frame_embds, mask_features,
+                                             frame_embeds_no_norm=frame_embds_no_norm,
+                                             frame_logits=out['pred_logits'])
+            pred_logits = track_out['pred_logits'].clone()
 
             del track_out['pred_masks'], track_out['pred_logits']
             for j in range(len(track_out['aux_outputs'])):
                 del track_out['aux_outputs'][j]['pred_masks'], track_out['aux_outputs'][j]['pred_logits']
 
-            instance_embds = track_out['pred_embds']
-            overall_instance_embds.append(instance_embds)
+            # keep the results once the whole window succeeded
+            overall_mask_features.append(mask_features.cpu())
+            overall_frame_embds.append(frame_embds_no_norm)
+            online_pred_logits.append(pred_logits)
+            overall_instance_embds.append(track_out['pred_embds'])
+
+        self.run_windows(images_tensor, window_size, run_window, "offline", tracker=self.tracker)
+        self.profiler.set_window(None)
 
         overall_frame_embds = torch.cat(overall_frame_embds, dim=2)
         overall_instance_embds = torch.cat(overall_instance_embds, dim=2)
-        overall_mask_features = torch.cat(overall_mask_features, dim=1)
+        if isinstance(overall_mask_features, list):
+            overall_mask_features = torch.cat(overall_mask_features, dim=1)
         online_pred_logits = torch.cat(online_pred_logits, dim=1)
 
         # temporal refiner inference
-        outputs = self.refiner(overall_instance_embds, overall_frame_embds, overall_mask_features)
+        with self.profiler.stage("refiner"):
+            outputs = self.refiner(overall_instance_embds, overall_frame_embds, overall_mask_features)
+        if isinstance(overall_mask_features, MaskFeatureStore):
+            overall_mask_features.close()
         return outputs, online_pred_logits
 
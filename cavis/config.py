@@ -24,13 +24,51 @@ def add_dvis_config(cfg):
     cfg.MODEL.TRACKER = CN()
     cfg.MODEL.TRACKER.DECODER_LAYERS = 6
     cfg.MODEL.TRACKER.USE_CL = True
+    # at inference, skip the tracker layers for the queries whose foreground probability,
+    # decayed by PRUNE_DECAY per frame, stays below PRUNE_THRESHOLD
+    cfg.MODEL.TRACKER.QUERY_PRUNING = False
+    cfg.MODEL.TRACKER.PRUNE_THRESHOLD = 0.1
+    cfg.MODEL.TRACKER.PRUNE_DECAY = 0.9
     cfg.MODEL.REFINER = CN()
     cfg.MODEL.REFINER.DECODER_LAYERS = 6
+    # at inference, refine videos longer than CHUNK_SIZE frames in chunks overlapping
+    # by CHUNK_OVERLAP frames, 0 refines the whole video at once
+    cfg.MODEL.REFINER.CHUNK_SIZE = 0
+    cfg.MODEL.REFINER.CHUNK_OVERLAP = 16
+    # number of frames the segmenter of CAVIS_offline runs on at a time during training
+    # (and at inference without WINDOW_INFERENCE)
+    cfg.MODEL.REFINER.SEGMENTER_WINDOW_SIZE = 21
 
     cfg.MODEL.MASK_FORMER.TEST.WINDOW_SIZE = 3
     cfg.MODEL.MASK_FORMER.TEST.TASK = 'vis'
 
     cfg.MODEL.MASK_FORMER.TEST.MAX_NUM = 20
+    # VPS/VSS: merge the masks at mask resolution, then upsample the id map
+    cfg.MODEL.MASK_FORMER.TEST.LOW_RES_MERGE = False
+    # VIS/VSS: number of frames upsampled at a time, all frames if 0
+    cfg.MODEL.MASK_FORMER.TEST.FRAME_CHUNK_SIZE = 4
+    # VIS: format of the output masks, "bitmask", "packed" (8 pixels per byte) or "rle"
+    cfg.MODEL.MASK_FORMER.TEST.VIS_MASK_FORMAT = "bitmask"
+    # dtype of the mask logits of the video kept on the host until they are upsampled:
+    # "float32", "float16", "bfloat16" or "uint8" (sigmoid probabilities in 256 levels)
+    cfg.MODEL.MASK_FORMER.TEST.MASK_STORAGE_DTYPE = "float32"
+    # offline: spill the mask features of the video to a memory-mapped fp16 file in this
+    # directory instead of host memory, disabled if empty
+    cfg.MODEL.MASK_FORMER.TEST.MASK_FEATURE_STORE_DIR = ""
+    # window inference: pick the largest window whose activations fit in WINDOW_MEMORY_BUDGET_MB
+    # of CUDA memory (90% of the device if 0), up to MAX_WINDOW_SIZE frames, from the memory
+    # measured per frame and resolution, and retry with smaller windows on OOM
+    cfg.MODEL.MASK_FORMER.TEST.WINDOW_AUTOTUNE = False
+    cfg.MODEL.MASK_FORMER.TEST.WINDOW_MEMORY_BUDGET_MB = 0
+    cfg.MODEL.MASK_FORMER.TEST.MAX_WINDOW_SIZE = 64
+
+    # opt-in timers around the stages of the video models (wall time, CUDA
+    # sync time and allocated memory per window), written to the EventStorage during training
+    # and as one JSON line per video to LOG_FILE (or the log if empty) at inference
+    cfg.MODEL.PROFILER = CN()
+    cfg.MODEL.PROFILER.ENABLED = False
+    cfg.MODEL.PROFILER.SYNCHRONIZE = True
+    cfg.MODEL.PROFILER.LOG_FILE = ""
 
     cfg.DATASETS.DATASET_RATIO = [1.0, ]
     # Whether category ID mapping is needed
@@ -40,6 +78,16 @@ def add_dvis_config(cfg):
     cfg.DATASETS.DATASET_TYPE = ['video_instance', ]
     cfg.DATASETS.DATASET_TYPE_TEST = ['video_instance', ]
 
+    # evaluators: YTVIS computes the video IoUs in NUM_EVAL_WORKERS processes if > 1, and with
+    # SHARDED_EVAL every rank evaluates its own videos; VPS/VSS encode their PNG predictions
+    # in NUM_WRITER_THREADS threads (synchronously if 0) with at most MAX_PENDING_WRITES
+    # frames queued, and VSS only saves them with SAVE_PRED_PNG
+    cfg.TEST.NUM_EVAL_WORKERS = 0
+    cfg.TEST.SHARDED_EVAL = False
+    cfg.TEST.NUM_WRITER_THREADS = 4
+    cfg.TEST.MAX_PENDING_WRITES = 32
+    cfg.TEST.SAVE_PRED_PNG = True
+
     # Pseudo Data Use
     cfg.INPUT.PSEUDO = CN()
     cfg.INPUT.PSEUDO.AUGMENTATIONS = ['rotation']
@@ -60,3 +108,9 @@ def add_dvis_config(cfg):
 
     cfg.SEED = 42
     cfg.DATALOADER.NUM_WORKERS = 4
+    # training telemetry: time spent waiting for data, copying it to the device and computing
+    # each step, and the stage times of one in MAPPER_SAMPLE_PERIOD clips mapped by each
+    # worker, written to the metrics JSON
+    cfg.DATALOADER.TELEMETRY = CN()
+    cfg.DATALOADER.TELEMETRY.ENABLED = False
+    cfg.DATALOADER.TELEMETRY.MAPPER_SAMPLE_PERIOD = 10
@@ -5,6 +5,7 @@ from .dataset_mapper import YTVISDatasetMapper, CocoClipDatasetMapper
 from .dataset_mapper_vps import PanopticDatasetVideoMapper
 from .dataset_mapper_vss import SemanticDatasetVideoMapper
 from .build import *
+from .telemetry import LoaderTelemetry, DataTelemetryHook
 
 from .datasets import *
 from .ytvis_eval import YTVISEvaluator
@@ -0,0 +1,89 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+def _save_png(array, file_path):
+    Image.fromarray(np.ascontiguousarray(array)).save(file_path)
+
+
+class AsyncImageWriter:
+    """
+    A bounded pool of background threads that encode numpy frames to PNG files.
+
+    PIL releases the GIL while compressing, so encoding several frames in threads
+    overlaps with model inference on the main thread. At most `max_pending` frames
+    are queued at any time; `submit` blocks once the queue is full, which keeps the
+    host memory held by pending frames bounded.
+    """
+
+    def __init__(self, num_workers=4, max_pending=32):
+        """
+        Args:
+            num_workers (int): number of encoding threads. If 0, frames are
+                written synchronously on the calling thread.
+            max_pending (int): maximum number of frames submitted but not yet written.
+        """
+        self._logger = logging.getLogger(__name__)
+        self._executor = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+        self._slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self._lock = threading.Lock()
+        # the futures not yet written, and the failed ones until `drain` reports them
+        self._pending = set()
+        self._created_dirs = set()
+
+    def makedirs(self, dir_name):
+        """
+        Create `dir_name` once; repeated calls for the same directory are free.
+        """
+        if dir_name not in self._created_dirs:
+            os.makedirs(dir_name, exist_ok=True)
+            self._created_dirs.add(dir_name)
+
+    def submit(self, array, file_path):
+        """
+        Queue `array` (H, W) or (H, W, 3) uint8 to be saved at `file_path`.
+        The caller must not modify `array` afterwards.
+        """
+        if self._executor is None:
+            _save_png(array, file_path)
+            return
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(_save_png, array, file_path)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        if future.exception() is None:
+            with self._lock:
+                self._pending.discard(future)
+        self._slots.release()
+
+    def drain(self):
+        """
+        Block until every submitted frame is written, re-raising the first write error.
+        """
+        with self._lock:
+            pending = list(self._pending)
+        # the errors are read from the futures, their done callbacks may not have run yet
+        errors = [e for e in (future.exception() for future in pending) if e is not None]
+        with self._lock:
+            self._pending.difference_update(pending)
+        if len(errors) > 0:
+            self._logger.error("{} frames failed to be written.".format(len(errors)))
+            raise errors[0]
+
+    def close(self):
+        self.drain()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
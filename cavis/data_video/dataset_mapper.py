@@ -27,6 +27,7 @@ from detectron2.data import transforms as T
 from pycocotools import mask as coco_mask
 
 from .augmentation import build_augmentation, build_pseudo_augmentation
+from .telemetry import MapperTimer, telemetry_sample_period
 
 from .datasets.ytvis import COCO_TO_YTVIS_2019, COCO_TO_YTVIS_2021, COCO_TO_OVIS
 
@@ -156,6 +157,7 @@ class YTVISDatasetMapper:
         num_classes: int = 40,
         src_dataset_name: str = "",
         tgt_dataset_name: str = "",
+        telemetry_sample_period: int = 0,
     ):
         """
         NOTE: this interface is experimental.
@@ -164,6 +166,7 @@ class YTVISDatasetMapper:
             augmentations: a list of augmentations or deterministic transforms to apply
             image_format: an image format supported by :func:`detection_utils.read_image`.
             use_instance_mask: whether to process instance segmentation annotations, if available
+            telemetry_sample_period: time the stages of one in this many clips, see :class:`MapperTimer`
         """
         # fmt: off
         self.is_train               = is_train
@@ -177,6 +180,7 @@ class YTVISDatasetMapper:
         self.num_classes            = num_classes
         self.sampling_frame_ratio = 1.0
         self.reverse_agu = reverse_agu
+        self.timer = MapperTimer(telemetry_sample_period)
 
         if not is_tgt:
             self.src_metadata = MetadataCatalog.get(src_dataset_name)
@@ -227,6 +231,7 @@ class YTVISDatasetMapper:
             "reverse_agu": reverse_agu,
             "num_classes": cfg.MODEL.SEM_SEG_HEAD.NUM_CLASSES,
             "tgt_dataset_name": cfg.DATASETS.TRAIN[-1],
+            "telemetry_sample_period": telemetry_sample_period(cfg, is_train),
         }
 
         return ret
@@ -290,6 +295,7 @@ class YTVISDatasetMapper:
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
+        timing = self.timer.start()
         # TODO consider examining below deepcopy as it costs huge amount of computations.
         dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
 
@@ -320,13 +326,16 @@ class YTVISDatasetMapper:
         for frame_idx in selected_idx:
             dataset_dict["file_names"].append(file_names[frame_idx])
 
+            timing.lap("setup")
             # Read image
             image = utils.read_image(file_names[frame_idx], format=self.image_format)
             utils.check_image_size(dataset_dict, image)
+            timing.lap("decode")
 
             aug_input = T.AugInput(image)
             transforms = self.augmentations(aug_input)
             image = aug_input.image
+            timing.lap("augment")
 
             image_shape = image.shape[:2]  # h, w
             # Pytorch's dataloader is efficient on torch.Tensor due to shared-memory,
@@ -357,8 +366,10 @@ class YTVISDatasetMapper:
                 idx = ids[_anno["id"]]
                 sorted_annos[idx] = _anno
             _gt_ids = [_anno["id"] for _anno in sorted_annos]
+            timing.lap("targets")
 
             instances = utils.annotations_to_instances(sorted_annos, image_shape, mask_format="bitmask")
+            timing.lap("masks")
             if not self.is_tgt:
                 instances.gt_classes = torch.tensor(
                     [self.src2tgt[c] if c in self.src2tgt else -1 for c in instances.gt_classes.tolist()]
@@ -369,6 +380,8 @@ class YTVISDatasetMapper:
                 instances.gt_masks = BitMasks(torch.empty((0, *image_shape)))
             dataset_dict["instances"].append(instances)
 
+        timing.lap("targets")
+        timing.attach(dataset_dict)
         return dataset_dict
 
 class CocoClipDatasetMapper:
@@ -391,6 +404,7 @@ class CocoClipDatasetMapper:
         reverse_agu: bool = False,
         src_dataset_name: str = "",
         tgt_dataset_name: str = "",
+        telemetry_sample_period: int = 0,
     ):
         """
         NOTE: this interface is experimental.
@@ -398,6 +412,7 @@ class CocoClipDatasetMapper:
             is_train: whether it's used in training or inference
             augmentations: a list of augmentations or deterministic transforms to apply
             image_format: an image format supported by :func:`detection_utils.read_image`.
+            telemetry_sample_period: time the stages of one in this many clips, see :class:`MapperTimer`
         """
         # fmt: off
         self.is_train               = is_train
@@ -409,6 +424,7 @@ class CocoClipDatasetMapper:
         self.sampling_frame_shuffle = sampling_frame_shuffle
         self.reverse_agu            = reverse_agu
         self.sampling_frame_ratio   = 1.0
+        self.timer                  = MapperTimer(telemetry_sample_period)
 
         if not is_tgt:
             self.src_metadata = MetadataCatalog.get(src_dataset_name)
@@ -451,6 +467,7 @@ class CocoClipDatasetMapper:
             "sampling_frame_shuffle": sampling_frame_shuffle,
             "reverse_agu": reverse_agu,
             "tgt_dataset_name": cfg.DATASETS.TRAIN[-1],
+            "telemetry_sample_period": telemetry_sample_period(cfg, is_train),
         }
 
         return ret
@@ -513,11 +530,14 @@ class CocoClipDatasetMapper:
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
+        timing = self.timer.start()
         dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
 
         img_annos = dataset_dict.pop("annotations", None)
         file_name = dataset_dict.pop("file_name", None)
+        timing.lap("setup")
         original_image = utils.read_image(file_name, format=self.image_format)
+        timing.lap("decode")
 
         if self.is_train:
             video_length = random.randrange(16, 49)
@@ -533,10 +553,12 @@ class CocoClipDatasetMapper:
         dataset_dict["file_names"] = [file_name] * self.sampling_frame_num
         for _ in range(self.sampling_frame_num):
             utils.check_image_size(dataset_dict, original_image)
+            timing.lap("setup")
 
             aug_input = T.AugInput(original_image)
             transforms = self.augmentations(aug_input)
             image = aug_input.image
+            timing.lap("augment")
 
             image_shape = image.shape[:2]  # h, w
             # Pytorch's dataloader is efficient on torch.Tensor due to shared-memory,
@@ -573,6 +595,7 @@ class CocoClipDatasetMapper:
             instances.gt_ids = torch.tensor(_gt_ids)
             # instances.gt_boxes = instances.gt_masks.get_bounding_boxes()  # NOTE we don't need boxes
             instances = filter_empty_instances(instances)
+            timing.lap("targets")
             h, w = instances.image_size
             if hasattr(instances, 'gt_masks'):
                 gt_masks = instances.gt_masks
@@ -581,5 +604,7 @@ class CocoClipDatasetMapper:
             else:
                 instances.gt_masks = torch.zeros((0, h, w), dtype=torch.uint8)
             dataset_dict["instances"].append(instances)
+            timing.lap("masks")
 
+        timing.attach(dataset_dict)
         return dataset_dict
@@ -13,6 +13,7 @@ from detectron2.structures import BitMasks, Instances, Boxes
 from detectron2.projects.point_rend import ColorAugSSDTransform
 from panopticapi.utils import rgb2id
 
+from .telemetry import MapperTimer, telemetry_sample_period
 from .utils import Video_BitMasks, Video_Boxes
 import random
 
@@ -49,6 +50,7 @@ class PanopticDatasetVideoMapper:
             reverse_agu: bool = False,
             src_dataset_name: str = "",  # not used
             tgt_dataset_name: str = "",  # not used
+            telemetry_sample_period: int = 0,
     ):
         """
         NOTE: this interface is experimental.
@@ -58,6 +60,7 @@ class PanopticDatasetVideoMapper:
             image_format: an image format supported by :func:`detection_utils.read_image`.
             ignore_label: the label that is ignored to evaluation
             size_divisibility: pad image size to be divisible by this value
+            telemetry_sample_period: time the stages of one in this many clips, see :class:`MapperTimer`
         """
         self.is_train = is_train
         self.tfm_gens = augmentations
@@ -70,6 +73,7 @@ class PanopticDatasetVideoMapper:
         self.sampling_frame_range = sampling_frame_range
         self.sampling_frame_ratio = 1.0
         self.reverse_agu = reverse_agu
+        self.timer = MapperTimer(telemetry_sample_period)
 
         logger = logging.getLogger(__name__)
         mode = "training" if is_train else "inference"
@@ -135,6 +139,7 @@ class PanopticDatasetVideoMapper:
             "sampling_frame_num": sampling_frame_num,
             "sampling_frame_range": sampling_frame_range,
             "reverse_agu": reverse_agu,
+            "telemetry_sample_period": telemetry_sample_period(cfg, is_train),
         }
         return ret
 
@@ -221,7 +226,7 @@ class PanopticDatasetVideoMapper:
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
-
+        timing = self.timer.start()
         dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
         video_length = len(dataset_dict['file_names'])
         if self.is_train:
@@ -252,6 +257,7 @@ class PanopticDatasetVideoMapper:
         input_panoptic_seg = []
         for ii_, (file_name, pan_seg_file_name, segments_infos) in enumerate(
                 zip(select_filenames, select_pan_seg_file_names, select_segments_infos)):
+            timing.lap("setup")
 
             if segments_infos is not None and self.is_train:
                 for segments_info in segments_infos:
@@ -268,27 +274,34 @@ class PanopticDatasetVideoMapper:
                     pan_seg_gt = utils.read_image(pan_seg_file_name, "RGB")
                 else:
                     pan_seg_gt = None
+                timing.lap("decode")
 
                 aug_input = T.AugInput(image, sem_seg=pan_seg_gt)
                 aug_input, transforms = T.apply_transform_gens(self.tfm_gens, aug_input)
                 image = aug_input.image
                 pan_seg_gt = aug_input.sem_seg
+                timing.lap("augment")
 
             else:
                 image = utils.read_image(file_name, format=self.img_format)
                 utils.check_image_size(dataset_dict, image)
+                timing.lap("decode")
                 image = transforms.apply_image(image)
+                timing.lap("augment")
                 if pan_seg_file_name is not None and self.is_train:
                     pan_seg_gt = utils.read_image(pan_seg_file_name, "RGB")
                 else:
                     pan_seg_gt = None
+                timing.lap("decode")
 
                 # apply the same transformation to panoptic segmentation
                 if pan_seg_gt is not None:
                     pan_seg_gt = transforms.apply_segmentation(pan_seg_gt)
+                timing.lap("augment")
 
             if pan_seg_gt is not None:
                 pan_seg_gt = rgb2id(pan_seg_gt)
+            timing.lap("masks")
 
             # Pad image and segmentation label here!
             image = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
@@ -301,6 +314,7 @@ class PanopticDatasetVideoMapper:
         if not self.is_train:
             self.convert2ytvis(dataset_dict)
             return dataset_dict
+        timing.lap("setup")
 
         image_shape = (input_images.shape[-2], input_images.shape[-1])
         input_panoptic_seg = np.stack(input_panoptic_seg)
@@ -330,10 +344,13 @@ class PanopticDatasetVideoMapper:
                 torch.stack([torch.from_numpy(np.ascontiguousarray(x.copy())) for x in masks])
             )
             instances.gt_masks = masks
+        timing.lap("masks")
 
         dataset_dict["instances"] = instances
 
         # align to ytvis target format
         self.convert2ytvis(dataset_dict)
+        timing.lap("targets")
+        timing.attach(dataset_dict)
 
         return dataset_dict
\ No newline at end of file
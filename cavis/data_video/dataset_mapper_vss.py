@@ -11,6 +11,7 @@ from detectron2.data import detection_utils as utils
 from detectron2.data import transforms as T
 from detectron2.structures import BitMasks, Instances, Boxes
 
+from .telemetry import MapperTimer, telemetry_sample_period
 from .utils import Video_BitMasks, Video_Boxes
 import random
 
@@ -33,6 +34,7 @@ class SemanticDatasetVideoMapper:
             reverse_agu: bool = False,
             src_dataset_name: str = "",  # not used
             tgt_dataset_name: str = "",  # not used
+            telemetry_sample_period: int = 0,
     ):
         """
         NOTE: this interface is experimental.
@@ -42,6 +44,7 @@ class SemanticDatasetVideoMapper:
             image_format: an image format supported by :func:`detection_utils.read_image`.
             ignore_label: the label that is ignored to evaluation
             size_divisibility: pad image size to be divisible by this value
+            telemetry_sample_period: time the stages of one in this many clips, see :class:`MapperTimer`
         """
         self.is_train = is_train
         self.tfm_gens = augmentations
@@ -53,6 +56,7 @@ class SemanticDatasetVideoMapper:
         self.sampling_frame_range = sampling_frame_range
         self.sampling_frame_ratio = 1.0
         self.reverse_agu = reverse_agu
+        self.timer = MapperTimer(telemetry_sample_period)
 
         logger = logging.getLogger(__name__)
         mode = "training" if is_train else "inference"
@@ -107,6 +111,7 @@ class SemanticDatasetVideoMapper:
             "sampling_frame_num": sampling_frame_num,
             "sampling_frame_range": sampling_frame_range,
             "reverse_agu": reverse_agu,
+            "telemetry_sample_period": telemetry_sample_period(cfg, is_train),
         }
         return ret
 
@@ -200,7 +205,7 @@ class SemanticDatasetVideoMapper:
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
-
+        timing = self.timer.start()
         dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
 
         video_length = len(dataset_dict['file_names'])
@@ -224,6 +229,7 @@ class SemanticDatasetVideoMapper:
         input_sem_seg = []
         for ii_, (file_name, sem_seg_file_name) in enumerate(
                 zip(select_filenames, select_sem_seg_file_names)):
+            timing.lap("setup")
 
             #####
             if ii_ == 0:
@@ -233,25 +239,32 @@ class SemanticDatasetVideoMapper:
                     sem_seg_gt = utils.read_image(sem_seg_file_name, "RGB")
                 else:
                     sem_seg_gt = None
+                timing.lap("decode")
 
                 aug_input = T.AugInput(image, sem_seg=sem_seg_gt)
                 aug_input, transforms = T.apply_transform_gens(self.tfm_gens, aug_input)
                 image = aug_input.image
                 sem_seg_gt = aug_input.sem_seg
+                timing.lap("augment")
 
             else:
                 image = utils.read_image(file_name, format=self.img_format)
+                timing.lap("decode")
                 image = transforms.apply_image(image)
+                timing.lap("augment")
                 if sem_seg_file_name is not None and self.is_train:
                     sem_seg_gt = utils.read_image(sem_seg_file_name, "RGB")
                 else:
                     sem_seg_gt = None
+                timing.lap("decode")
                 if sem_seg_gt is not None:
                     sem_seg_gt = transforms.apply_segmentation(sem_seg_gt)
+                timing.lap("augment")
 
             if sem_seg_gt is not None:
                 # only use for vspw dataset
                 sem_seg_gt = self._vspw_preprocess(sem_seg_gt)
+            timing.lap("masks")
 
             # Pad image and segmentation label here!
             image = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
@@ -264,6 +277,7 @@ class SemanticDatasetVideoMapper:
         if not self.is_train:
             self.convert2ytvis(dataset_dict)
             return dataset_dict
+        timing.lap("setup")
 
         image_shape = (input_images.shape[-2], input_images.shape[-1])
         input_sem_seg = np.stack(input_sem_seg)
@@ -287,10 +301,13 @@ class SemanticDatasetVideoMapper:
                 torch.stack([torch.from_numpy(np.ascontiguousarray(x.copy())) for x in masks])
             )
             instances.gt_masks = masks
+        timing.lap("masks")
 
         dataset_dict["instances"] = instances
 
         # align to ytvis target format
         self.convert2ytvis(dataset_dict)
+        timing.lap("targets")
+        timing.attach(dataset_dict)
 
         return dataset_dict
\ No newline at end of file
@@ -236,7 +236,7 @@ class YTVOS:
         annsVidIds = [ann['video_id'] for ann in anns]
         assert set(annsVidIds) == (set(annsVidIds) & set(self.getVidIds())), \
                'Results do not correspond to current coco set'
-        if 'segmentations' in anns[0]:
+        if len(anns) > 0 and 'segmentations' in anns[0]:
             res.dataset['categories'] = copy.deepcopy(self.dataset['categories'])
             for id, ann in enumerate(anns):
                 ann['areas'] = []
@@ -9,6 +9,55 @@ import time
 from collections import defaultdict
 from pycocotools import mask as maskUtils
 import copy
+import multiprocessing as mp
+
+# fields of the per video results read by YTVOSeval.accumulate
+ACCUMULATE_FIELDS = ('dtScores', 'dtMatches', 'dtIgnore', 'gtIgnore')
+
+def segmIoUSeq(d, g):
+    '''
+    Compute the video IoU between every dt and gt RLE sequence.
+    Instead of merging every (dt, gt) pair frame by frame, maskUtils.iou is called
+    once per frame for all pairs, and the intersections and unions are accumulated
+    over frames.
+    :param d: list of D dt sequences, each a list of T RLEs
+    :param g: list of G gt sequences, each a list of T RLEs (None for empty frames)
+    :return: ious (np.ndarray [DxG]) and whether some pair has an empty union
+    '''
+    D, G = len(d), len(g)
+    inter = np.zeros((D, G))
+    union = np.zeros((D, G))
+    if D == 0 or G == 0:
+        return inter, False
+    T = min(len(seq) for seq in d + g)
+    for t in range(T):
+        dInds = [i for i in range(D) if d[i][t]]
+        gInds = [j for j in range(G) if g[j][t]]
+        dArea = np.zeros(D)
+        gArea = np.zeros(G)
+        if len(dInds) > 0:
+            dRles = [d[i][t] for i in dInds]
+            dArea[dInds] = maskUtils.area(dRles)
+        if len(gInds) > 0:
+            gRles = [g[j][t] for j in gInds]
+            gArea[gInds] = maskUtils.area(gRles)
+        union += dArea[:, None] + gArea[None, :]
+        if len(dInds) > 0 and len(gInds) > 0:
+            # with iscrowd=1, maskUtils.iou returns intersection / dt area
+            crowdIoU = np.asarray(maskUtils.iou(dRles, gRles, [1] * len(gInds))).reshape(len(dInds), len(gInds))
+            frameInter = np.round(crowdIoU * dArea[dInds][:, None])
+            inter[np.ix_(dInds, gInds)] += frameInter
+            union[np.ix_(dInds, gInds)] -= frameInter
+    ious = np.zeros((D, G))
+    valid = union > .0
+    ious[valid] = inter[valid] / union[valid]
+    return ious, not valid.all()
+
+
+def _segmIoUWorker(args):
+    key, d, g = args
+    return key, segmIoUSeq(d, g)
+
 
 class YTVOSeval:
     # Interface for evaluating video instance segmentation on the YouTubeVIS dataset.
@@ -20,6 +69,8 @@ class YTVOSeval:
     #  E.evaluate();                # run per image evaluation
     #  E.accumulate();              # accumulate per image results
     #  E.summarize();               # display summary metrics of results
+    # To shard the per image evaluation, run E.evaluateVids(vidIds) on each shard and
+    # E.loadEvalVids(mergedResults, allVidIds) before E.accumulate().
     # For example usage see evalDemo.m and http://mscoco.org/.
     #
     # The evaluation parameters are as follows (defaults in brackets):
@@ -60,11 +111,13 @@ class YTVOSeval:
     # Data, paper, and tutorials available at:  http://mscoco.org/
     # Code written by Piotr Dollar and Tsung-Yi Lin, 2015.
     # Licensed under the Simplified BSD License [see coco/license.txt]
-    def __init__(self, cocoGt=None, cocoDt=None, iouType='segm'):
+    def __init__(self, cocoGt=None, cocoDt=None, iouType='segm', useFastIoU=True, numWorkers=0):
         '''
         Initialize CocoEval using coco APIs for gt and dt
         :param cocoGt: coco object with ground truth annotations
         :param cocoDt: coco object with detection results
+        :param useFastIoU: compute segm ious with one maskUtils.iou call per frame
+        :param numWorkers: if > 1, compute segm ious of the (video, category) pairs in a process pool
         :return: None
         '''
         if not iouType:
@@ -80,6 +133,8 @@ class YTVOSeval:
         self._paramsEval = {}               # parameters for evaluation
         self.stats = []                     # result summarization
         self.ious = {}                      # ious between all gts and dts
+        self.useFastIoU = useFastIoU
+        self.numWorkers = numWorkers
         if not cocoGt is None:
             self.params.vidIds = sorted(cocoGt.getVidIds())
             self.params.catIds = sorted(cocoGt.getCatIds())
@@ -156,9 +211,12 @@ class YTVOSeval:
             computeIoU = self.computeIoU
         elif p.iouType == 'keypoints':
             computeIoU = self.computeOks
-        self.ious = {(vidId, catId): computeIoU(vidId, catId) \
-                        for vidId in p.vidIds
-                        for catId in catIds}
+        if p.iouType == 'segm' and self.useFastIoU and self.numWorkers > 1:
+            self.ious = self.computeIoUParallel(catIds)
+        else:
+            self.ious = {(vidId, catId): computeIoU(vidId, catId) \
+                            for vidId in p.vidIds
+                            for catId in catIds}
 
         evaluateVid = self.evaluateVid
         maxDet = p.maxDets[-1]
@@ -173,7 +231,51 @@ class YTVOSeval:
         toc = time.time()
         print('DONE (t={:0.2f}s).'.format(toc-tic))
 
-    def computeIoU(self, vidId, catId):
+    def evaluateVids(self, vidIds):
+        '''
+        Run per video evaluation on a subset of the videos (e.g. the shard of one process).
+        :return: dict mapping (catId, areaRng index, vidId) to the per video results used by
+                 accumulate, to be merged with the other shards and passed to loadEvalVids
+        '''
+        if len(vidIds) == 0:
+            return {}
+        self.params.vidIds = list(vidIds)
+        self.evaluate()
+        p = self.params
+        catIds = p.catIds if p.useCats else [-1]
+        keys = [(catId, a, vidId)
+                for catId in catIds
+                for a in range(len(p.areaRng))
+                for vidId in p.vidIds]
+        return {key: {k: e[k] for k in ACCUMULATE_FIELDS}
+                for key, e in zip(keys, self.evalImgs) if e is not None}
+
+    def loadEvalVids(self, evalVids, vidIds):
+        '''
+        Set the per video results of all the videos from the merged outputs of evaluateVids,
+        so that accumulate can run without the gts and dts.
+        :param evalVids: dict mapping (catId, areaRng index, vidId) to per video results
+        :param vidIds: all the video ids of the evaluation
+        :return: None
+        '''
+        p = self.params
+        p.vidIds = list(np.unique(vidIds))
+        if p.useCats:
+            p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        catIds = p.catIds if p.useCats else [-1]
+        self.evalImgs = [evalVids.get((catId, a, vidId))
+                 for catId in catIds
+                 for a in range(len(p.areaRng))
+                 for vidId in p.vidIds
+             ]
+        self._paramsEval = copy.deepcopy(p)
+
+    def _loadSeqs(self, vidId, catId):
+        '''
+        Load the gt and the top scored dt sequences of a video and category.
+        :return: (d, g) lists of per-frame segmentations or boxes, or None if both are empty
+        '''
         p = self.params
         if p.useCats:
             gt = self._gts[vidId,catId]
@@ -182,7 +284,7 @@ class YTVOSeval:
             gt = [_ for cId in p.catIds for _ in self._gts[vidId,cId]]
             dt = [_ for cId in p.catIds for _ in self._dts[vidId,cId]]
         if len(gt) == 0 and len(dt) ==0:
-            return []
+            return None
         inds = np.argsort([-d['score'] for d in dt], kind='mergesort')
         dt = [dt[i] for i in inds]
         if len(dt) > p.maxDets[-1]:
@@ -196,9 +298,44 @@ class YTVOSeval:
             d = [d['bboxes'] for d in dt]
         else:
             raise Exception('unknown iouType for iou computation')
+        return d, g
+
+    def computeIoUParallel(self, catIds):
+        '''
+        Compute the segm ious of all (video, category) pairs in a process pool.
+        :return: dict mapping (vidId, catId) to ious
+        '''
+        p = self.params
+        ious = {}
+        jobs = []
+        for vidId in p.vidIds:
+            for catId in catIds:
+                seqs = self._loadSeqs(vidId, catId)
+                if seqs is None:
+                    ious[vidId, catId] = []
+                else:
+                    jobs.append(((vidId, catId), seqs[0], seqs[1]))
+        with mp.Pool(self.numWorkers) as pool:
+            for (vidId, catId), (iou, emptyUnion) in pool.imap_unordered(_segmIoUWorker, jobs, chunksize=16):
+                if emptyUnion:
+                    print("Mask sizes in video {} and category {} may not match!".format(vidId, catId))
+                ious[vidId, catId] = iou
+        return ious
+
+    def computeIoU(self, vidId, catId):
+        p = self.params
+        seqs = self._loadSeqs(vidId, catId)
+        if seqs is None:
+            return []
+        d, g = seqs
+
+        if p.iouType == 'segm' and self.useFastIoU:
+            ious, emptyUnion = segmIoUSeq(d, g)
+            if emptyUnion:
+                print("Mask sizes in video {} and category {} may not match!".format(vidId, catId))
+            return ious
 
         # compute iou between each dt and gt region
-        iscrowd = [int(o['iscrowd']) for o in gt]
         #ious = maskUtils.iou(d,g,iscrowd)
         def iou_seq(d_seq, g_seq):
             i = .0
@@ -302,30 +439,29 @@ class YTVOSeval:
         gtIg = np.array([g['_ignore'] for g in gt])
         dtIg = np.zeros((T,D))
         if not len(ious)==0:
-            for tind, t in enumerate(p.iouThrs):
-                for dind, d in enumerate(dt):
-                    # information about best match so far (m=-1 -> unmatched)
-                    iou = min([t,1-1e-10])
-                    m   = -1
-                    for gind, g in enumerate(gt):
-                        # if this gt already matched, and not a crowd, continue
-                        if gtm[tind,gind]>0 and not iscrowd[gind]:
-                            continue
-                        # if dt matched to reg gt, and on ignore gt, stop
-                        if m>-1 and gtIg[m]==0 and gtIg[gind]==1:
-                            break
-                        # continue to next gt unless better match made
-                        if ious[dind,gind] < iou:
-                            continue
-                        # if match successful and best so far, store appropriately
-                        iou=ious[dind,gind]
-                        m=gind
-                    # if match made store id of match for both dt and gt
-                    if m ==-1:
-                        continue
-                    dtIg[tind,dind] = gtIg[m]
-                    dtm[tind,dind]  = gt[m]['id']
-                    gtm[tind,m]     = d['id']
+            # greedy matching for all iou thresholds at once, one dt at a time.
+            # it reproduces the sequential scan: the dt is matched to the best available
+            # regular gt above the threshold, falling back to the ignored gts (sorted last),
+            # and ties are won by the last gt.
+            thrs = np.minimum(p.iouThrs, 1-1e-10)[:, None]
+            crowd = np.array(iscrowd, dtype=bool)[None, :]
+            regular = np.logical_not(gtIg.astype(bool))[None, :]
+            gtIds = np.array([g['id'] for g in gt])
+            for dind, d in enumerate(dt):
+                dIous = ious[dind][None, :]
+                # if a gt is already matched, and not a crowd, it is not available
+                cand = np.logical_and(np.logical_or(gtm <= 0, crowd), dIous >= thrs)
+                candReg = np.logical_and(cand, regular)
+                cand = np.where(candReg.any(axis=1, keepdims=True), candReg, cand)
+                tinds = np.nonzero(cand.any(axis=1))[0]
+                if len(tinds) == 0:
+                    continue
+                vals = np.where(cand[tinds], dIous, -np.inf)
+                m = G - 1 - np.argmax(vals[:, ::-1], axis=1)
+                # store id of match for both dt and gt
+                dtIg[tinds,dind] = gtIg[m]
+                dtm[tinds,dind]  = gtIds[m]
+                gtm[tinds,m]     = d['id']
         # set unmatched detections outside of area range to ignore
         a = np.array([d['avg_area']<aRng[0] or d['avg_area']>aRng[1] for d in dt]).reshape((1, len(dt)))
         dtIg = np.logical_or(dtIg, np.logical_and(dtm==0, np.repeat(a,T,0)))
@@ -407,39 +543,30 @@ class YTVOSeval:
                     tps = np.logical_and(               dtm,  np.logical_not(dtIg) )
                     fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg) )
 
-                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
-                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
-                    for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
-                        tp = np.array(tp)
-                        fp = np.array(fp)
-                        nd = len(tp)
-                        rc = tp / npig
-                        pr = tp / (fp+tp+np.spacing(1))
-                        q  = np.zeros((R,))
-                        ss = np.zeros((R,))
-
-                        if nd:
-                            recall[t,k,a,m] = rc[-1]
-                        else:
-                            recall[t,k,a,m] = 0
-
-                        # numpy is slow without cython optimization for accessing elements
-                        # use python array gets significant speed improvement
-                        pr = pr.tolist(); q = q.tolist()
-
-                        for i in range(nd-1, 0, -1):
-                            if pr[i] > pr[i-1]:
-                                pr[i-1] = pr[i]
-
-                        inds = np.searchsorted(rc, p.recThrs, side='left')
-                        try:
-                            for ri, pi in enumerate(inds):
-                                q[ri] = pr[pi]
-                                ss[ri] = dtScoresSorted[pi]
-                        except:
-                            pass
-                        precision[t,:,k,a,m] = np.array(q)
-                        scores[t,:,k,a,m] = np.array(ss)
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float64)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float64)
+                    nd = tp_sum.shape[1]
+                    rc = tp_sum / npig
+                    pr = tp_sum / (fp_sum+tp_sum+np.spacing(1))
+                    q  = np.zeros((T,R))
+                    ss = np.zeros((T,R))
+
+                    if nd:
+                        recall[:,k,a,m] = rc[:, -1]
+                    else:
+                        recall[:,k,a,m] = 0
+
+                    # make precision monotonically decreasing for all thresholds at once
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+
+                    for t in range(T):
+                        inds = np.searchsorted(rc[t], p.recThrs, side='left')
+                        # recall thresholds above the max recall keep precision 0
+                        valid = inds < nd
+                        q[t, valid] = pr[t, inds[valid]]
+                        ss[t, valid] = dtScoresSorted[inds[valid]]
+                    precision[:,:,k,a,m] = q
+                    scores[:,:,k,a,m] = ss
         self.eval = {
             'params': p,
             'counts': [T, R, K, A, M],
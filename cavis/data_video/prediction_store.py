@@ -0,0 +1,170 @@
+import json
+import os
+
+import numpy as np
+
+
+class VideoPredictionStore:
+    """
+    Columnar storage for the video instance predictions of a dataset.
+
+    Instead of one python dict per instance, the store keeps numpy columns for
+    video id, score, category and mask size, and the RLE counts strings of all
+    frames concatenated in one byte buffer indexed by offsets. It pickles as a few
+    arrays (cheap to gather across ranks), can be saved as a shard directory and
+    memory-mapped back, and builds the YTVIS json result dicts lazily.
+    """
+
+    _COLUMNS = ("video_ids", "scores", "category_ids", "sizes", "frame_offsets", "byte_offsets")
+
+    def __init__(self):
+        self._video_ids = []
+        self._scores = []
+        self._category_ids = []
+        self._sizes = []
+        self._frame_offsets = [0]
+        self._byte_offsets = [0]
+        self._counts = bytearray()
+        # frozen columns, set when loaded from disk or unpickled
+        self._columns = None
+
+    def __len__(self):
+        if self._columns is not None:
+            return len(self._columns["video_ids"])
+        return len(self._video_ids)
+
+    def add(self, video_id, score, category_id, segmentations):
+        """
+        Args:
+            video_id (int):
+            score (float):
+            category_id (int):
+            segmentations (list[dict]): one RLE per frame, with "size" and "counts".
+        """
+        assert self._columns is None, "Can not add predictions to a frozen store!"
+        self._video_ids.append(video_id)
+        self._scores.append(score)
+        self._category_ids.append(category_id)
+        self._sizes.append(segmentations[0]["size"] if len(segmentations) > 0 else (0, 0))
+        for rle in segmentations:
+            counts = rle["counts"]
+            if isinstance(counts, str):
+                counts = counts.encode("utf-8")
+            self._counts += counts
+            self._byte_offsets.append(len(self._counts))
+        self._frame_offsets.append(len(self._byte_offsets) - 1)
+
+    def extend(self, predictions):
+        """
+        Add a list of YTVIS json result dicts.
+        """
+        for res in predictions:
+            self.add(res["video_id"], res["score"], res["category_id"], res["segmentations"])
+
+    def columns(self):
+        """
+        Returns:
+            dict[str, ndarray]: the columns, plus "counts", the uint8 RLE byte buffer.
+        """
+        if self._columns is not None:
+            return self._columns
+        return {
+            "video_ids": np.asarray(self._video_ids, dtype=np.int64),
+            "scores": np.asarray(self._scores, dtype=np.float64),
+            "category_ids": np.asarray(self._category_ids, dtype=np.int64),
+            "sizes": np.asarray(self._sizes, dtype=np.int64).reshape(-1, 2),
+            "frame_offsets": np.asarray(self._frame_offsets, dtype=np.int64),
+            "byte_offsets": np.asarray(self._byte_offsets, dtype=np.int64),
+            "counts": np.frombuffer(bytes(self._counts), dtype=np.uint8),
+        }
+
+    @classmethod
+    def from_columns(cls, columns):
+        store = cls()
+        store._columns = columns
+        return store
+
+    def __getstate__(self):
+        return {"columns": self.columns()}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self._columns = state["columns"]
+
+    def save(self, dirname):
+        """
+        Save the store as a shard directory of `.npy` files and a raw `counts.bin`.
+        """
+        os.makedirs(dirname, exist_ok=True)
+        columns = self.columns()
+        for name in self._COLUMNS:
+            np.save(os.path.join(dirname, name + ".npy"), columns[name])
+        columns["counts"].tofile(os.path.join(dirname, "counts.bin"))
+
+    @classmethod
+    def load(cls, dirname, mmap=True):
+        """
+        Load a shard written by :meth:`save`, memory-mapped unless `mmap` is False.
+        """
+        mmap_mode = "r" if mmap else None
+        columns = {
+            name: np.load(os.path.join(dirname, name + ".npy"), mmap_mode=mmap_mode)
+            for name in cls._COLUMNS
+        }
+        counts_file = os.path.join(dirname, "counts.bin")
+        if os.path.getsize(counts_file) == 0:
+            columns["counts"] = np.zeros(0, dtype=np.uint8)
+        elif mmap:
+            columns["counts"] = np.memmap(counts_file, dtype=np.uint8, mode="r")
+        else:
+            columns["counts"] = np.fromfile(counts_file, dtype=np.uint8)
+        return cls.from_columns(columns)
+
+    def iter_results(self, category_lut=None):
+        """
+        Lazily build the YTVIS json result dicts.
+
+        Args:
+            category_lut (ndarray or None): if given, category ids are mapped
+                through this lookup table (e.g. contiguous id -> dataset id).
+        """
+        columns = self.columns()
+        category_ids = columns["category_ids"]
+        if category_lut is not None:
+            category_ids = category_lut[category_ids]
+        frame_offsets = columns["frame_offsets"]
+        byte_offsets = columns["byte_offsets"]
+        counts = columns["counts"]
+        for i in range(len(category_ids)):
+            size = columns["sizes"][i].tolist()
+            segms = []
+            for f in range(frame_offsets[i], frame_offsets[i + 1]):
+                rle_counts = counts[byte_offsets[f]: byte_offsets[f + 1]].tobytes().decode("utf-8")
+                segms.append({"size": size, "counts": rle_counts})
+            yield {
+                "video_id": int(columns["video_ids"][i]),
+                "score": float(columns["scores"][i]),
+                "category_id": int(category_ids[i]),
+                "segmentations": segms,
+            }
+
+
+def iter_video_predictions(stores, category_lut=None):
+    """
+    Chain the json result dicts of several :class:`VideoPredictionStore`.
+    """
+    for store in stores:
+        yield from store.iter_results(category_lut)
+
+
+def dump_video_predictions(stores, f, category_lut=None):
+    """
+    Stream the json results of `stores` into the file object `f`, without
+    materializing the full list of dicts.
+    """
+    f.write("[")
+    for i, res in enumerate(iter_video_predictions(stores, category_lut)):
+        if i > 0:
+            f.write(", ")
+        f.write(json.dumps(res))
+    f.write("]")
@@ -0,0 +1,208 @@
+import time
+from collections import OrderedDict
+
+import torch
+
+from detectron2.engine import HookBase
+
+__all__ = ["MapperTimer", "LoaderTelemetry", "DataTelemetryHook", "telemetry_sample_period"]
+
+# the key of the mapped dicts holding the stage times of a sampled clip
+MAPPER_TIMING_KEY = "mapper_timing"
+
+
+def telemetry_sample_period(cfg, is_train):
+    """
+    The sample period of the :class:`MapperTimer` of a dataset mapper, 0 to disable it.
+    """
+    if not (is_train and cfg.DATALOADER.TELEMETRY.ENABLED):
+        return 0
+    return cfg.DATALOADER.TELEMETRY.MAPPER_SAMPLE_PERIOD
+
+
+class _NullTiming:
+    def lap(self, stage):
+        pass
+
+    def attach(self, dataset_dict):
+        pass
+
+
+_NULL_TIMING = _NullTiming()
+
+
+class _Timing:
+    def __init__(self):
+        self.times = OrderedDict()
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.times[stage] = self.times.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    def attach(self, dataset_dict):
+        self.times["total"] = sum(self.times.values())
+        dataset_dict[MAPPER_TIMING_KEY] = dict(self.times)
+
+
+class MapperTimer:
+    """
+    Times the stages of a dataset mapper (image decoding, augmentation, mask rasterization,
+    target building, ...) on one in `sample_period` of the clips it maps.
+
+    The mapper calls :meth:`start` for every clip, then `lap(stage)` at the end of each stage,
+    which charges the time since the previous lap to `stage`, and finally `attach(dataset_dict)`.
+    The times of a sampled clip travel with its mapped dict from the data loader worker to the
+    training loop, where :class:`LoaderTelemetry` removes them. Every worker samples its own clips.
+    """
+
+    def __init__(self, sample_period=0):
+        """
+        Args:
+            sample_period (int): time one in `sample_period` clips, none if 0.
+        """
+        self.sample_period = sample_period
+        self._count = 0
+
+    def start(self):
+        if self.sample_period <= 0:
+            return _NULL_TIMING
+        self._count += 1
+        if self._count % self.sample_period != 0:
+            return _NULL_TIMING
+        return _Timing()
+
+
+class _TimedLoader:
+    def __init__(self, loader, telemetry, name, to_device):
+        self.loader = loader
+        self.telemetry = telemetry
+        self.name = name
+        self.to_device = to_device
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.telemetry.add(self.name, time.perf_counter() - start)
+            if self.to_device:
+                batch = self.telemetry.to_device(batch)
+            yield batch
+
+
+class LoaderTelemetry:
+    """
+    Accumulates, until :meth:`pop`, the time the training loop spends waiting for its data
+    loaders, the time to copy the batches to the device, and the stage times of the clips
+    sampled by the :class:`MapperTimer` of the dataset mappers.
+    """
+
+    def __init__(self, device="cpu"):
+        self.device = torch.device(device)
+        self._times = OrderedDict()
+        self._mapper_times = OrderedDict()
+        self._num_sampled = 0
+
+    def wrap(self, loader, name="data_wait", to_device=False):
+        """
+        Wrap a data loader to charge the time spent in `next` to `name`.
+
+        Args:
+            to_device (bool): copy the images and instances of the batches to the device,
+                which the model would otherwise do, and time the copy as "h2d". Only the
+                loader of the training loop should do it.
+        """
+        return _TimedLoader(loader, self, name, to_device)
+
+    def add(self, name, seconds):
+        self._times[name] = self._times.get(name, 0.0) + seconds
+
+    def to_device(self, batch):
+        for dataset_dict in batch:
+            timing = dataset_dict.pop(MAPPER_TIMING_KEY, None)
+            if timing is not None:
+                self._num_sampled += 1
+                for stage, seconds in timing.items():
+                    self._mapper_times[stage] = self._mapper_times.get(stage, 0.0) + seconds
+        if self.device.type != "cuda":
+            return batch
+
+        torch.cuda.synchronize(self.device)
+        start = time.perf_counter()
+        for dataset_dict in batch:
+            dataset_dict["image"] = [image.to(self.device) for image in dataset_dict["image"]]
+            if "instances" in dataset_dict:
+                dataset_dict["instances"] = [instances.to(self.device) for instances in dataset_dict["instances"]]
+        torch.cuda.synchronize(self.device)
+        self.add("h2d", time.perf_counter() - start)
+        return batch
+
+    def pop(self):
+        """
+        Returns:
+            dict[str, float]: the seconds charged to each loader and to "h2d" since the last call.
+            dict[str, float]: the mean seconds per sampled clip of each mapper stage, empty if
+                no clip was sampled since the last call.
+        """
+        times, self._times = self._times, OrderedDict()
+        mapper_times = OrderedDict((k, v / self._num_sampled) for k, v in self._mapper_times.items())
+        self._mapper_times, self._num_sampled = OrderedDict(), 0
+        return times, mapper_times
+
+
+class DataTelemetryHook(HookBase):
+    """
+    Puts in the `EventStorage`, every iteration, the time spent waiting for data, copying it to
+    the device and computing the step, as recorded by a :class:`LoaderTelemetry`, so that they
+    are written to the metrics JSON with the other scalars:
+
+    * telemetry/step_ms: the wall time of the iteration.
+    * telemetry/data_wait_ms: the time spent in `next` of the data loader of the training loop,
+      with telemetry/data_wait/<dataset>_ms the part spent in each loader of a combined loader.
+    * telemetry/h2d_ms: the time to copy the batch to the device.
+    * telemetry/compute_ms: the rest of the iteration.
+    * telemetry/data_wait_fraction: the fraction of the iteration spent waiting for data, close
+      to 0 unless the training is input-bound.
+    * telemetry/mapper/<stage>_ms: the mean time per clip of each mapper stage, in the workers,
+      on the iterations that received a sampled clip.
+
+    CUDA is synchronized at the end of every iteration, so that its kernels are charged to it.
+    The times are those of the local process.
+    """
+
+    def __init__(self, telemetry):
+        """
+        Args:
+            telemetry (LoaderTelemetry): the telemetry of the data loader of the trainer.
+        """
+        self.telemetry = telemetry
+        self._start = None
+
+    def before_step(self):
+        self._start = time.perf_counter()
+
+    def after_step(self):
+        if self.telemetry.device.type == "cuda":
+            torch.cuda.synchronize(self.telemetry.device)
+        step_time = time.perf_counter() - self._start
+        times, mapper_times = self.telemetry.pop()
+
+        data_wait = times.pop("data_wait", 0.0)
+        h2d = times.pop("h2d", 0.0)
+        scalars = {
+            "telemetry/step_ms": step_time * 1000,
+            "telemetry/data_wait_ms": data_wait * 1000,
+            "telemetry/h2d_ms": h2d * 1000,
+            "telemetry/compute_ms": max(step_time - data_wait - h2d, 0.0) * 1000,
+            "telemetry/data_wait_fraction": data_wait / step_time,
+        }
+        for name, seconds in times.items():
+            scalars["telemetry/{}_ms".format(name)] = seconds * 1000
+        for stage, seconds in mapper_times.items():
+            scalars["telemetry/mapper/{}_ms".format(stage)] = seconds * 1000
+        self.trainer.storage.put_scalars(**scalars, smoothing_hint=True)
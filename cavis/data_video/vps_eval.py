@@ -4,23 +4,201 @@ import logging
 import numpy as np
 import os
 import torch
+from collections import OrderedDict, defaultdict
 
 
 import detectron2.utils.comm as comm
 from detectron2.config import CfgNode
 from detectron2.data import MetadataCatalog
+from detectron2.data import detection_utils as utils
 from detectron2.evaluation import DatasetEvaluator
 from detectron2.utils.file_io import PathManager
 
 
-from PIL import Image
 from panopticapi.utils import rgb2id
 from panopticapi.utils import IdGenerator
 
+from .async_writer import AsyncImageWriter
+
+OFFSET = 256 * 256 * 256
+VOID = 0
+# VPQ tube lengths, evaluated as the window sizes k = (nframes - 1) * 5
+VPQ_NFRAMES = (1, 2, 4, 6, 8)
+
+
+class PQStatCat:
+    def __init__(self):
+        self.iou = 0.0
+        self.tp = 0
+        self.fp = 0
+        self.fn = 0
+
+    def __iadd__(self, pq_stat_cat):
+        self.iou += pq_stat_cat.iou
+        self.tp += pq_stat_cat.tp
+        self.fp += pq_stat_cat.fp
+        self.fn += pq_stat_cat.fn
+        return self
+
+
+class PQStat:
+    """
+    Per category sums of matched IoU, TP, FP and FN, which add up across videos and ranks.
+    """
+
+    def __init__(self):
+        self.pq_per_cat = defaultdict(PQStatCat)
+
+    def __getitem__(self, i):
+        return self.pq_per_cat[i]
+
+    def __iadd__(self, pq_stat):
+        for label, pq_stat_cat in pq_stat.pq_per_cat.items():
+            self.pq_per_cat[label] += pq_stat_cat
+        return self
+
+    def pq_average(self, categories, isthing):
+        pq, sq, rq, n = 0, 0, 0, 0
+        for label, label_info in categories.items():
+            if isthing is not None:
+                cat_isthing = label_info['isthing'] == 1
+                if isthing != cat_isthing:
+                    continue
+            iou = self.pq_per_cat[label].iou
+            tp = self.pq_per_cat[label].tp
+            fp = self.pq_per_cat[label].fp
+            fn = self.pq_per_cat[label].fn
+            if tp + fp + fn == 0:
+                continue
+            n += 1
+            pq += iou / (tp + 0.5 * fp + 0.5 * fn)
+            sq += iou / tp if tp != 0 else 0
+            rq += tp / (tp + 0.5 * fp + 0.5 * fn)
+        if n == 0:
+            return {'pq': 0.0, 'sq': 0.0, 'rq': 0.0, 'n': 0}
+        return {'pq': pq / n, 'sq': sq / n, 'rq': rq / n, 'n': n}
+
+
+def frame_pair_counts(pan_gt, pan_pred):
+    """
+    Intersections of the gt and predicted segments of one frame.
+
+    Returns:
+        tuple(ndarray, ndarray): the (gt_id * OFFSET + pred_id) labels and their pixel counts.
+    """
+    labels = pan_gt.astype(np.uint64) * OFFSET + pan_pred.astype(np.uint64)
+    return np.unique(labels, return_counts=True)
+
+
+def vpq_window_stat(vpq_stat, pair_counts, gt_segms, pred_categories):
+    """
+    Match the tubes of one window of frames and add their IoU, TP, FP and FN to `vpq_stat`,
+    following the official VIPSeg VPQ evaluation (utils/eval_vpq_vspw.py).
+
+    Args:
+        pair_counts (list[tuple]): :func:`frame_pair_counts` of the frames of the window.
+        gt_segms (dict): gt segment id -> dict with "category_id", "iscrowd" and "area",
+            the area being summed over the frames of the window.
+        pred_categories (dict): predicted segment id -> category id.
+    """
+    labels = np.concatenate([x[0] for x in pair_counts])
+    counts = np.concatenate([x[1] for x in pair_counts])
+    labels, inverse = np.unique(labels, return_inverse=True)
+    counts = np.bincount(inverse, weights=counts).astype(np.int64)
+    gt_ids = (labels // OFFSET).tolist()
+    pred_ids = (labels % OFFSET).tolist()
+    gt_pred_map = dict(zip(zip(gt_ids, pred_ids), counts.tolist()))
+
+    pred_areas = defaultdict(int)
+    for pred_id, count in zip(pred_ids, counts.tolist()):
+        if pred_id != VOID:
+            pred_areas[pred_id] += count
+    for pred_id in pred_areas:
+        if pred_id not in pred_categories:
+            raise KeyError('Segment with ID {} is presented in the prediction and not in its segments info.'.format(pred_id))
+
+    gt_matched = set()
+    pred_matched = set()
+    for (gt_label, pred_label), intersection in gt_pred_map.items():
+        if gt_label not in gt_segms:
+            continue
+        if pred_label not in pred_areas:
+            continue
+        if gt_segms[gt_label]['iscrowd'] == 1:
+            continue
+        if gt_segms[gt_label]['category_id'] != pred_categories[pred_label]:
+            continue
+
+        union = pred_areas[pred_label] + gt_segms[gt_label]['area'] - intersection - gt_pred_map.get(
+            (VOID, pred_label), 0)
+        iou = intersection / union
+        assert iou <= 1.0, 'INVALID IOU VALUE : %d' % (gt_label)
+        if iou > 0.5:
+            vpq_stat[gt_segms[gt_label]['category_id']].tp += 1
+            vpq_stat[gt_segms[gt_label]['category_id']].iou += iou
+            gt_matched.add(gt_label)
+            pred_matched.add(pred_label)
+
+    # count false negatives, crowd segments are ignored
+    crowd_labels_dict = {}
+    for gt_label, gt_info in gt_segms.items():
+        if gt_label in gt_matched:
+            continue
+        if gt_info['iscrowd'] == 1:
+            crowd_labels_dict[gt_info['category_id']] = gt_label
+            continue
+        vpq_stat[gt_info['category_id']].fn += 1
+
+    # count false positives
+    for pred_label, pred_area in pred_areas.items():
+        if pred_label in pred_matched:
+            continue
+        category_id = pred_categories[pred_label]
+        # intersection of the segment with VOID, plus with the CROWD region of its category
+        intersection = gt_pred_map.get((VOID, pred_label), 0)
+        if category_id in crowd_labels_dict:
+            intersection += gt_pred_map.get((crowd_labels_dict[category_id], pred_label), 0)
+        # the segment is ignored if more than half of it is in VOID and CROWD regions
+        if intersection / pred_area > 0.5:
+            continue
+        vpq_stat[category_id].fp += 1
+
+
+def vpq_video_stats(pair_counts, gt_segments_infos, pred_categories, nframes_list=VPQ_NFRAMES):
+    """
+    VPQ statistics of one video for every tube length, sliding over all the windows.
+
+    Args:
+        pair_counts (list[tuple]): :func:`frame_pair_counts` of every frame.
+        gt_segments_infos (list[list[dict]]): the gt segments of every frame.
+        pred_categories (dict): predicted segment id -> category id.
+
+    Returns:
+        dict[int, PQStat]: the statistics of each number of frames in `nframes_list`.
+    """
+    stats = {}
+    for nframes in nframes_list:
+        vpq_stat = PQStat()
+        for idx in range(0, len(pair_counts) - nframes + 1):
+            gt_segms = {}
+            for segments_info in gt_segments_infos[idx: idx + nframes]:
+                for el in segments_info:
+                    if el['id'] in gt_segms:
+                        gt_segms[el['id']]['area'] += el['area']
+                    else:
+                        gt_segms[el['id']] = {
+                            'category_id': el['category_id'], 'iscrowd': el['iscrowd'], 'area': el['area']
+                        }
+            vpq_window_stat(vpq_stat, pair_counts[idx: idx + nframes], gt_segms, pred_categories)
+        stats[nframes] = vpq_stat
+    return stats
+
 
 class VPSEvaluator(DatasetEvaluator):
     """
-    Only for save the prediction results in VIPSeg format
+    Save the prediction results in VIPSeg format, and compute VPQ when the ground truth
+    is available. Every rank computes the VPQ statistics of its videos in :meth:`process`,
+    and only the per category tables are gathered and reduced in :meth:`evaluate`.
     """
 
     def __init__(
@@ -31,6 +209,8 @@ class VPSEvaluator(DatasetEvaluator):
         output_dir=None,
         *,
         use_fast_impl=True,
+        num_writer_threads=4,
+        max_pending_writes=32,
     ):
         """
         Args:
@@ -58,11 +238,18 @@ class VPSEvaluator(DatasetEvaluator):
                 Although the results should be very close to the official implementation in COCO
                 API, it is still recommended to compute results with the official API for use in
                 papers. The faster implementation also uses more RAM.
+            num_writer_threads (int): number of background threads encoding the predicted
+                PNG frames. If 0, frames are saved synchronously in :meth:`process`.
+            max_pending_writes (int): maximum number of frames waiting to be written before
+                :meth:`process` blocks, bounding the memory held by the writer.
         """
         self._logger = logging.getLogger(__name__)
         self._distributed = distributed
         self._output_dir = output_dir
         self._use_fast_impl = use_fast_impl
+        self._num_writer_threads = num_writer_threads
+        self._max_pending_writes = max_pending_writes
+        self._writer = None
 
         if tasks is not None and isinstance(tasks, CfgNode):
             self._logger.warning(
@@ -90,9 +277,14 @@ class VPSEvaluator(DatasetEvaluator):
 
     def reset(self):
         self._predictions = []
+        self._vpq_stats = {nframes: PQStat() for nframes in VPQ_NFRAMES}
+        self._do_evaluation = False
         PathManager.mkdirs(self._output_dir)
         if not os.path.exists(os.path.join(self._output_dir, 'pan_pred')):
             os.makedirs(os.path.join(self._output_dir, 'pan_pred'), exist_ok=True)
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = AsyncImageWriter(self._num_writer_threads, self._max_pending_writes)
 
     def process(self, inputs, outputs):
         """
@@ -107,6 +299,7 @@ class VPSEvaluator(DatasetEvaluator):
         pan_seg_result = outputs['pred_masks']
         segments_infos = outputs['segments_infos']
         segments_infos_ = []
+        pred_categories = {}
 
         pan_format = np.zeros((pan_seg_result.shape[0], img_shape[0], img_shape[1], 3), dtype=np.uint8)
         for segments_info in segments_infos:
@@ -117,6 +310,7 @@ class VPSEvaluator(DatasetEvaluator):
                 sem = self.contiguous_id_to_thing_dataset_id[sem]
             else:
                 sem = self.contiguous_id_to_stuff_dataset_id[sem - len(self.contiguous_id_to_thing_dataset_id)]
+            pred_categories[id] = int(sem)
 
             mask = pan_seg_result == id
             color = color_generator.get_color(sem)
@@ -143,25 +337,54 @@ class VPSEvaluator(DatasetEvaluator):
             segments_infos_.append(dts)
         #### save image
         annotations = []
+        video_dir = os.path.join(self._output_dir, 'pan_pred', video_id)
+        self._writer.makedirs(video_dir)
         for i, image_name in enumerate(image_names):
-            image_ = Image.fromarray(pan_format[i])
-            if not os.path.exists(os.path.join(self._output_dir, 'pan_pred', video_id)):
-                os.makedirs(os.path.join(self._output_dir, 'pan_pred', video_id))
-            image_.save(os.path.join(self._output_dir, 'pan_pred', video_id, image_name.split('/')[-1].split('.')[0] + '.png'))
+            self._writer.submit(pan_format[i], os.path.join(video_dir, image_name.split('/')[-1].split('.')[0] + '.png'))
             annotations.append({"segments_info": [item[i] for item in segments_infos_ if item[i] is not None], "file_name": image_name.split('/')[-1]})
         self._predictions.append({'annotations': annotations, 'video_id': video_id})
 
+        if self._has_ground_truth(inputs[0]):
+            self._do_evaluation = True
+            self._accumulate_vpq(inputs[0], pan_seg_result, pred_categories)
+
+    def _has_ground_truth(self, input):
+        pan_seg_file_names = input.get("pan_seg_file_names", None)
+        return pan_seg_file_names is not None and len(pan_seg_file_names) > 0 \
+            and PathManager.isfile(pan_seg_file_names[0])
+
+    def _accumulate_vpq(self, input, pan_seg_result, pred_categories):
+        pan_pred = pan_seg_result.cpu().numpy()
+        pair_counts = []
+        gt_segments_infos = []
+        for i, idx in enumerate(input["frame_idx"]):
+            pan_gt = rgb2id(utils.read_image(input["pan_seg_file_names"][idx], "RGB"))
+            pair_counts.append(frame_pair_counts(pan_gt, pan_pred[i]))
+            gt_segments_infos.append(input["segments_infos"][idx])
+        stats = vpq_video_stats(pair_counts, gt_segments_infos, pred_categories)
+        for nframes, vpq_stat in stats.items():
+            self._vpq_stats[nframes] += vpq_stat
+
     def evaluate(self):
         """
         save jsons
         """
+        self._writer.drain()
+        vpq_stats = self._vpq_stats
+        do_evaluation = self._do_evaluation
         if self._distributed:
             comm.synchronize()
             predictions = comm.gather(self._predictions, dst=0)
             predictions = list(itertools.chain(*predictions))
+            shards = comm.gather((self._vpq_stats, self._do_evaluation), dst=0)
 
             if not comm.is_main_process():
                 return {}
+            vpq_stats = {nframes: PQStat() for nframes in VPQ_NFRAMES}
+            for stats, _ in shards:
+                for nframes, vpq_stat in stats.items():
+                    vpq_stats[nframes] += vpq_stat
+            do_evaluation = any(x for _, x in shards)
         else:
             predictions = self._predictions
 
@@ -173,4 +396,28 @@ class VPSEvaluator(DatasetEvaluator):
             file_path = os.path.join(self._output_dir, 'pred.json')
             with open(file_path, 'w') as f:
                 json.dump({'annotations': predictions}, f)
-        return {}
\ No newline at end of file
+        if not do_evaluation:
+            return {}
+        return {"panoptic_seg": self._derive_vpq_results(vpq_stats)}
+
+    def _derive_vpq_results(self, vpq_stats):
+        """
+        Returns:
+            dict: VPQ of all, thing and stuff categories averaged over the tube lengths,
+            and the VPQ of each window size k.
+        """
+        metrics = [("", None), ("_th", True), ("_st", False)]
+        res = OrderedDict()
+        per_window = OrderedDict()
+        for nframes in VPQ_NFRAMES:
+            k = (nframes - 1) * 5
+            for suffix, isthing in metrics:
+                result = vpq_stats[nframes].pq_average(self._metadata.categories, isthing=isthing)
+                per_window["VPQ{}-k{}".format(suffix, k)] = float(100 * result['pq'])
+        for suffix, _ in metrics:
+            res["VPQ" + suffix] = float(np.mean(
+                [per_window["VPQ{}-k{}".format(suffix, (nframes - 1) * 5)] for nframes in VPQ_NFRAMES]
+            ))
+        res.update(per_window)
+        self._logger.info("VPQ results: {}".format(dict(res)))
+        return res
\ No newline at end of file
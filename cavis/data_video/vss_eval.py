@@ -1,19 +1,69 @@
+import copy
 import logging
 import numpy as np
 import os
 import torch
+from collections import OrderedDict
 
+import detectron2.utils.comm as comm
 from detectron2.config import CfgNode
 from detectron2.data import MetadataCatalog
+from detectron2.data import detection_utils as utils
 from detectron2.evaluation import DatasetEvaluator
 from detectron2.utils.file_io import PathManager
 
-from PIL import Image
+from .async_writer import AsyncImageWriter
+
+
+def vspw_gt_lut(dataset_id_to_contiguous_id, ignore_label=255):
+    """
+    Build a lookup table mapping raw VSPW mask values to contiguous category ids.
+    Raw value 0 and 255 are void; raw value k is dataset category k - 1
+    (see `SemanticDatasetVideoMapper._vspw_preprocess`).
+    """
+    lut = np.full(256, ignore_label, dtype=np.uint8)
+    for dataset_id, contiguous_id in dataset_id_to_contiguous_id.items():
+        if 0 <= dataset_id + 1 < 255:
+            lut[dataset_id + 1] = contiguous_id
+    return lut
+
+
+def video_consistency_counts(gt, pred, window):
+    """
+    Video consistency (VC) statistics of one video as defined by VSPW.
+
+    For each clip of `window` consecutive frames, the pixels whose ground truth label
+    stays constant over the clip are counted, together with those of them whose
+    prediction also stays constant. Following the official implementation, the
+    last clip of the video is not evaluated.
+
+    Args:
+        gt (ndarray): (t, h, w) ground truth labels.
+        pred (ndarray): (t, h, w) predicted labels.
+        window (int): clip length, 8 or 16 in VSPW.
+    Returns:
+        (float, int): sum of per-clip consistency accuracies and number of valid clips.
+    """
+    acc_sum, num_clips = 0.0, 0
+    for i in range(gt.shape[0] - window):
+        gt_common = np.all(gt[i + 1: i + window] == gt[i], axis=0)
+        num_common = gt_common.sum()
+        if num_common == 0:
+            continue
+        pred_common = np.all(pred[i + 1: i + window] == pred[i], axis=0)
+        acc_sum += float(np.logical_and(gt_common, pred_common).sum()) / num_common
+        num_clips += 1
+    return acc_sum, num_clips
 
 
 class VSSEvaluator(DatasetEvaluator):
     """
-    Only for save the prediction results in VSPW format
+    Save the prediction results in VSPW format, and, when ground truth masks are
+    available, evaluate mIoU and the video consistency mVC_8 / mVC_16.
+
+    The confusion matrix and the consistency counts are accumulated video by video
+    in :meth:`process`, so no predictions are kept in memory; in distributed
+    inference these small statistics are summed over all ranks.
     """
 
     def __init__(
@@ -24,6 +74,10 @@ class VSSEvaluator(DatasetEvaluator):
         output_dir=None,
         *,
         use_fast_impl=True,
+        num_writer_threads=4,
+        max_pending_writes=32,
+        save_pred_png=True,
+        vc_windows=(8, 16),
     ):
         """
         Args:
@@ -51,11 +105,23 @@ class VSSEvaluator(DatasetEvaluator):
                 Although the results should be very close to the official implementation in COCO
                 API, it is still recommended to compute results with the official API for use in
                 papers. The faster implementation also uses more RAM.
+            num_writer_threads (int): number of background threads encoding the predicted
+                PNG frames. If 0, frames are saved synchronously in :meth:`process`.
+            max_pending_writes (int): maximum number of frames waiting to be written before
+                :meth:`process` blocks, bounding the memory held by the writer.
+            save_pred_png (bool): whether to dump the predictions as PNG images in VSPW
+                format. Metrics are computed in-process either way.
+            vc_windows (tuple[int]): clip lengths of the video consistency metrics.
         """
         self._logger = logging.getLogger(__name__)
         self._distributed = distributed
         self._output_dir = output_dir
         self._use_fast_impl = use_fast_impl
+        self._num_writer_threads = num_writer_threads
+        self._max_pending_writes = max_pending_writes
+        self._writer = None
+        self._save_pred_png = save_pred_png
+        self._vc_windows = tuple(vc_windows)
 
         if tasks is not None and isinstance(tasks, CfgNode):
             self._logger.warning(
@@ -74,41 +140,118 @@ class VSSEvaluator(DatasetEvaluator):
         self.contiguous_id_to_dataset_id = {}
         for i, key in enumerate(dataset_id_to_contiguous_id.keys()):
             self.contiguous_id_to_dataset_id.update({i: key})
+        self._num_classes = len(self.contiguous_id_to_dataset_id)
+
+        # contiguous id -> dataset id, ignore stays ignore
+        self._pred_lut = np.full(256, self.ignore_val, dtype=np.uint8)
+        for contiguous_id, dataset_id in self.contiguous_id_to_dataset_id.items():
+            self._pred_lut[contiguous_id] = dataset_id
+        self._gt_lut = vspw_gt_lut(dataset_id_to_contiguous_id, self.ignore_val)
 
         self._do_evaluation = False
 
     def reset(self):
         self._predictions = []
         PathManager.mkdirs(self._output_dir)
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = AsyncImageWriter(self._num_writer_threads, self._max_pending_writes)
+        self._do_evaluation = False
+        # the extra column counts gt pixels predicted as ignore
+        self._conf_matrix = np.zeros((self._num_classes, self._num_classes + 1), dtype=np.int64)
+        self._vc_stats = {window: np.zeros(2, dtype=np.float64) for window in self._vc_windows}
 
     def process(self, inputs, outputs):
         """
-         save semantic segmentation result as an image
+        save semantic segmentation result as an image, and accumulate the metric
+        statistics if the ground truth is available
         """
         assert len(inputs) == 1, "More than one inputs are loaded for inference!"
 
         video_id = inputs[0]["video_id"]
         image_names = [inputs[0]['file_names'][idx] for idx in inputs[0]["frame_idx"]]
-        img_shape = outputs['image_size']
-        sem_seg_result = outputs['pred_masks'].numpy().astype(np.uint8)  # (t, h, w, 3)
-        sem_seg_result_ = np.zeros_like(sem_seg_result, dtype=np.uint8) + 255
-        unique_cls = np.unique(sem_seg_result)
-        for cls in unique_cls:
-            if cls == self.ignore_val:
-                continue
-            cls_ = self.contiguous_id_to_dataset_id[cls]
-            sem_seg_result_[sem_seg_result == cls] = cls_
-        sem_seg_result = sem_seg_result_
-        for i, image_name in enumerate(image_names):
-            image_ = Image.fromarray(sem_seg_result[i])
-            if not os.path.exists(os.path.join(self._output_dir, video_id)):
-                os.makedirs(os.path.join(self._output_dir, video_id))
-            image_.save(os.path.join(self._output_dir, video_id, image_name.split('/')[-1].split('.')[0] + '.png'))
+        sem_seg_result = outputs['pred_masks'].numpy().astype(np.uint8)  # (t, h, w)
+
+        gt_names = [inputs[0]['sem_mask_names'][idx] for idx in inputs[0]["frame_idx"]]
+        if all(name is not None for name in gt_names):
+            self._do_evaluation = True
+            self._accumulate(sem_seg_result, gt_names)
+
+        if self._save_pred_png:
+            sem_seg_result = self._pred_lut[sem_seg_result]
+            video_dir = os.path.join(self._output_dir, video_id)
+            self._writer.makedirs(video_dir)
+            for i, image_name in enumerate(image_names):
+                self._writer.submit(sem_seg_result[i], os.path.join(video_dir, image_name.split('/')[-1].split('.')[0] + '.png'))
         return
 
+    def _accumulate(self, pred, gt_names):
+        gt = np.stack([utils.read_image(name, "RGB")[:, :, 0] for name in gt_names])
+        gt = self._gt_lut[gt]
+        assert gt.shape == pred.shape, \
+            "Ground truth shape {} does not match prediction shape {}!".format(gt.shape, pred.shape)
+
+        num_classes = self._num_classes
+        valid = gt < num_classes
+        pred_ = np.minimum(pred[valid].astype(np.int64), num_classes)
+        self._conf_matrix += np.bincount(
+            (num_classes + 1) * gt[valid].astype(np.int64) + pred_,
+            minlength=num_classes * (num_classes + 1),
+        ).reshape(num_classes, num_classes + 1)
+
+        for window in self._vc_windows:
+            acc_sum, num_clips = video_consistency_counts(gt, pred, window)
+            self._vc_stats[window] += (acc_sum, num_clips)
+
     def evaluate(self):
         """
-        Args:
-            img_ids: a list of image IDs to evaluate on. Default to None for the whole dataset
+        Returns:
+            dict: {"sem_seg": {"mIoU", "mVC_8", "mVC_16", "IoU-<class>", ...}} if the
+                ground truth is available, otherwise an empty dict.
         """
-        return {}
\ No newline at end of file
+        self._writer.drain()
+
+        conf_matrix = self._conf_matrix
+        vc_stats = self._vc_stats
+        do_evaluation = self._do_evaluation
+        if self._distributed:
+            comm.synchronize()
+            all_stats = comm.gather((conf_matrix, vc_stats, do_evaluation), dst=0)
+            if not comm.is_main_process():
+                return {}
+            conf_matrix = sum(stats[0] for stats in all_stats)
+            vc_stats = {
+                window: sum(stats[1][window] for stats in all_stats) for window in self._vc_windows
+            }
+            do_evaluation = any(stats[2] for stats in all_stats)
+
+        if not do_evaluation:
+            self._logger.info("Annotations are not available for evaluation.")
+            return {}
+
+        tp = np.diag(conf_matrix[:, :self._num_classes]).astype(np.float64)
+        gt_area = conf_matrix.sum(axis=1).astype(np.float64)
+        pred_area = conf_matrix[:, :self._num_classes].sum(axis=0).astype(np.float64)
+        union = gt_area + pred_area - tp
+        iou = np.full(self._num_classes, np.nan, dtype=np.float64)
+        iou_valid = union > 0
+        iou[iou_valid] = tp[iou_valid] / union[iou_valid]
+
+        res = OrderedDict()
+        res["mIoU"] = 100 * float(np.nanmean(iou))
+        for window in self._vc_windows:
+            acc_sum, num_clips = vc_stats[window]
+            res["mVC_{}".format(window)] = 100 * acc_sum / num_clips if num_clips > 0 else float("nan")
+        class_names = self._metadata.get("stuff_classes")
+        if class_names is not None:
+            for i, name in enumerate(class_names):
+                res["IoU-{}".format(name)] = 100 * float(iou[i])
+
+        if self._output_dir:
+            file_path = os.path.join(self._output_dir, "vss_conf_matrix.npy")
+            with PathManager.open(file_path, "wb") as f:
+                np.save(f, conf_matrix)
+
+        results = OrderedDict({"sem_seg": res})
+        self._logger.info(results)
+        return copy.deepcopy(results)
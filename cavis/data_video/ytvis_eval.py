@@ -10,10 +10,11 @@ import logging
 import numpy as np
 import os
 from collections import OrderedDict
-import pycocotools.mask as mask_util
 import torch
 from .datasets.ytvis_api.ytvos import YTVOS
 from .datasets.ytvis_api.ytvoseval import YTVOSeval
+from .prediction_store import VideoPredictionStore, dump_video_predictions, iter_video_predictions
+from ..inference_utils import encode_video_masks, unpack_masks
 from tabulate import tabulate
 
 import detectron2.utils.comm as comm
@@ -43,6 +44,8 @@ class YTVISEvaluator(DatasetEvaluator):
         output_dir=None,
         *,
         use_fast_impl=True,
+        num_eval_workers=0,
+        sharded_eval=False,
     ):
         """
         Args:
@@ -60,21 +63,27 @@ class YTVISEvaluator(DatasetEvaluator):
                 in the main process.
                 Otherwise, will only evaluate the results in the current process.
             output_dir (str): optional, an output directory to dump all
-                results predicted on the dataset. The dump contains two files:
+                results predicted on the dataset. The dump contains:
 
-                1. "instances_predictions.pth" a file in torch serialization
-                   format that contains all the raw original predictions.
-                2. "coco_instances_results.json" a json file in COCO's result
-                   format.
+                1. "instances_predictions/shard_<rank>" directories, one
+                   :class:`VideoPredictionStore` per rank with all the raw predictions.
+                2. "results.json" a json file in YTVIS's result format.
             use_fast_impl (bool): use a fast but **unofficial** implementation to compute AP.
                 Although the results should be very close to the official implementation in COCO
                 API, it is still recommended to compute results with the official API for use in
                 papers. The faster implementation also uses more RAM.
+            num_eval_workers (int): if > 1, the video IoUs of all (video, category) pairs are
+                computed in a pool of this many processes.
+            sharded_eval (bool): if True and distributed, every rank runs the per video
+                evaluation of the videos it predicted, and only the per video match tables
+                are gathered and accumulated in the main process.
         """
         self._logger = logging.getLogger(__name__)
         self._distributed = distributed
         self._output_dir = output_dir
         self._use_fast_impl = use_fast_impl
+        self._num_eval_workers = num_eval_workers
+        self._sharded_eval = sharded_eval
 
         if tasks is not None and isinstance(tasks, CfgNode):
             self._logger.warning(
@@ -98,7 +107,7 @@ class YTVISEvaluator(DatasetEvaluator):
         self._do_evaluation = "annotations" in self._ytvis_api.dataset
 
     def reset(self):
-        self._predictions = []
+        self._predictions = VideoPredictionStore()
 
     def process(self, inputs, outputs):
         """
@@ -117,73 +126,157 @@ class YTVISEvaluator(DatasetEvaluator):
         Args:
             img_ids: a list of image IDs to evaluate on. Default to None for the whole dataset
         """
+        shards = None
         if self._distributed:
             comm.synchronize()
-            predictions = comm.gather(self._predictions, dst=0)
-            predictions = list(itertools.chain(*predictions))
-
+            if self._sharded_eval and self._do_evaluation:
+                shards = self._evaluate_shard()
+            if shards is None or self._output_dir:
+                predictions = self._collect_predictions()
+            else:
+                predictions = [self._predictions]
             if not comm.is_main_process():
                 return {}
         else:
-            predictions = self._predictions
+            predictions = [self._predictions]
+            if self._output_dir:
+                self._predictions.save(self._shard_dir(0))
 
-        if len(predictions) == 0:
+        num_predictions = sum(len(x) for x in predictions) if shards is None else shards[0]
+        if num_predictions == 0:
             self._logger.warning("[COCOEvaluator] Did not receive valid predictions.")
             return {}
 
-        if self._output_dir:
-            PathManager.mkdirs(self._output_dir)
-            file_path = os.path.join(self._output_dir, "instances_predictions.pth")
-            with PathManager.open(file_path, "wb") as f:
-                torch.save(predictions, f)
-
         self._results = OrderedDict()
-        self._eval_predictions(predictions)
+        self._eval_predictions(predictions, None if shards is None else shards[1])
         # Copy so the caller can do whatever with results
         return copy.deepcopy(self._results)
 
-    def _eval_predictions(self, predictions):
+    def _shard_dir(self, rank):
+        return os.path.join(self._output_dir, "instances_predictions", "shard_{}".format(rank))
+
+    def _collect_predictions(self):
+        """
+        Collect the prediction stores of all ranks on the main process.
+
+        On a single machine every rank writes its store as a shard in the output
+        directory, which the main process memory-maps; otherwise the compact
+        stores are gathered.
+
+        Returns:
+            list[VideoPredictionStore] on the main process, None on the others.
+        """
+        if self._output_dir and comm.get_local_size() == comm.get_world_size():
+            self._predictions.save(self._shard_dir(comm.get_rank()))
+            comm.synchronize()
+            if not comm.is_main_process():
+                return None
+            return [
+                VideoPredictionStore.load(self._shard_dir(rank)) for rank in range(comm.get_world_size())
+            ]
+
+        predictions = comm.gather(self._predictions, dst=0)
+        if not comm.is_main_process():
+            return None
+        if self._output_dir:
+            for rank, store in enumerate(predictions):
+                store.save(self._shard_dir(rank))
+        return predictions
+
+    def _evaluate_shard(self):
+        """
+        Run the per video evaluation of the videos predicted by this rank, and gather
+        the per video match tables in the main process.
+
+        Returns:
+            tuple(int, dict) on the main process: the total number of predictions and the
+            merged per video results of :meth:`YTVOSeval.evaluateVids`. None on the others.
+        """
+        category_lut = self._category_lut([self._predictions])
+        vid_ids = set(np.unique(self._predictions.columns()["video_ids"]).tolist())
+        all_vid_ids = comm.all_gather(vid_ids)
+        if comm.is_main_process():
+            # ground truth videos that no rank predicted still count as false negatives
+            vid_ids |= set(self._ytvis_api.getVidIds()) - set().union(*all_vid_ids)
+
+        eval_vids = _evaluate_shard_on_coco(
+            self._ytvis_api,
+            iter_video_predictions([self._predictions], category_lut),
+            sorted(vid_ids),
+            num_workers=self._num_eval_workers,
+        )
+        shards = comm.gather((len(self._predictions), eval_vids), dst=0)
+        if not comm.is_main_process():
+            return None
+        merged = {}
+        for _, shard in shards:
+            merged.update(shard)
+        return sum(num for num, _ in shards), merged
+
+    def _category_lut(self, predictions):
+        """
+        Returns:
+            ndarray or None: the lookup table from contiguous id to dataset category id,
+            after checking that the category ids of `predictions` are in range.
+        """
+        if not hasattr(self._metadata, "thing_dataset_id_to_contiguous_id"):
+            return None
+        dataset_id_to_contiguous_id = self._metadata.thing_dataset_id_to_contiguous_id
+        all_contiguous_ids = list(dataset_id_to_contiguous_id.values())
+        num_classes = len(all_contiguous_ids)
+        assert min(all_contiguous_ids) == 0 and max(all_contiguous_ids) == num_classes - 1
+
+        category_lut = np.zeros(num_classes, dtype=np.int64)
+        for k, v in dataset_id_to_contiguous_id.items():
+            category_lut[v] = k
+        for store in predictions:
+            if len(store) == 0:
+                continue
+            category_id = int(store.columns()["category_ids"].max())
+            assert category_id < num_classes, (
+                f"A prediction has class={category_id}, "
+                f"but the dataset only has {num_classes} classes and "
+                f"predicted class id should be in [0, {num_classes - 1}]."
+            )
+        return category_lut
+
+    def _eval_predictions(self, predictions, eval_vids=None):
         """
         Evaluate predictions. Fill self._results with the metrics of the tasks.
+
+        Args:
+            predictions (list[VideoPredictionStore]):
+            eval_vids (dict or None): if given, the merged per video results of the
+                sharded evaluation, which are accumulated instead of evaluating `predictions`.
         """
         self._logger.info("Preparing results for YTVIS format ...")
 
         # unmap the category ids for COCO
-        if hasattr(self._metadata, "thing_dataset_id_to_contiguous_id"):
-            dataset_id_to_contiguous_id = self._metadata.thing_dataset_id_to_contiguous_id
-            all_contiguous_ids = list(dataset_id_to_contiguous_id.values())
-            num_classes = len(all_contiguous_ids)
-            assert min(all_contiguous_ids) == 0 and max(all_contiguous_ids) == num_classes - 1
-
-            reverse_id_mapping = {v: k for k, v in dataset_id_to_contiguous_id.items()}
-            for result in predictions:
-                category_id = result["category_id"]
-                assert category_id < num_classes, (
-                    f"A prediction has class={category_id}, "
-                    f"but the dataset only has {num_classes} classes and "
-                    f"predicted class id should be in [0, {num_classes - 1}]."
-                )
-                result["category_id"] = reverse_id_mapping[category_id]
+        category_lut = self._category_lut(predictions)
 
         if self._output_dir:
             file_path = os.path.join(self._output_dir, "results.json")
             self._logger.info("Saving results to {}".format(file_path))
             with PathManager.open(file_path, "w") as f:
-                f.write(json.dumps(predictions))
+                dump_video_predictions(predictions, f, category_lut)
                 f.flush()
 
         if not self._do_evaluation:
             self._logger.info("Annotations are not available for evaluation.")
             return
 
-        coco_eval = (
-            _evaluate_predictions_on_coco(
-                self._ytvis_api,
-                predictions,
+        if eval_vids is not None:
+            coco_eval = _accumulate_shards_on_coco(self._ytvis_api, eval_vids)
+        else:
+            coco_eval = (
+                _evaluate_predictions_on_coco(
+                    self._ytvis_api,
+                    iter_video_predictions(predictions, category_lut),
+                    num_workers=self._num_eval_workers,
+                )
+                if sum(len(x) for x in predictions) > 0
+                else None  # cocoapi does not handle empty results very well
             )
-            if len(predictions) > 0
-            else None  # cocoapi does not handle empty results very well
-        )
 
         res = self._derive_coco_results(
             coco_eval, class_names=self._metadata.get("thing_classes")
@@ -272,16 +365,17 @@ def instances_to_coco_json_video(inputs, outputs):
     scores = outputs["pred_scores"]
     labels = outputs["pred_labels"]
     masks = outputs["pred_masks"]
+    mask_format = outputs.get("mask_format", "bitmask")
+    if mask_format == "rle":
+        rles = masks
+    elif mask_format == "packed":
+        width = outputs["image_size"][1]
+        rles = encode_video_masks([torch.from_numpy(unpack_masks(m, width)) for m in masks])
+    else:
+        rles = encode_video_masks(masks)
 
     ytvis_results = []
-    for instance_id, (s, l, m) in enumerate(zip(scores, labels, masks)):
-        segms = [
-            mask_util.encode(np.array(_mask[:, :, None], order="F", dtype="uint8"))[0]
-            for _mask in m
-        ]
-        for rle in segms:
-            rle["counts"] = rle["counts"].decode("utf-8")
-
+    for instance_id, (s, l, segms) in enumerate(zip(scores, labels, rles)):
         res = {
             "video_id": video_id,
             "score": s,
@@ -297,13 +391,21 @@ def _evaluate_predictions_on_coco(
     coco_gt,
     coco_results,
     img_ids=None,
+    num_workers=0,
 ):
     """
     Evaluate the coco results using COCOEval API.
+
+    `coco_results` is either a list of result dicts, which is copied before
+    evaluation, or an iterable (e.g. from :func:`iter_video_predictions`) building
+    fresh dicts, which is used as is.
     """
+    if isinstance(coco_results, list):
+        coco_results = copy.deepcopy(coco_results)
+    else:
+        coco_results = list(coco_results)
     assert len(coco_results) > 0
 
-    coco_results = copy.deepcopy(coco_results)
     # When evaluating mask AP, if the results contain bbox, cocoapi will
     # use the box area as the area of the instance, instead of the mask area.
     # This leads to a different definition of small/medium/large.
@@ -312,7 +414,7 @@ def _evaluate_predictions_on_coco(
         c.pop("bbox", None)
 
     coco_dt = coco_gt.loadRes(coco_results)
-    coco_eval = YTVOSeval(coco_gt, coco_dt)
+    coco_eval = YTVOSeval(coco_gt, coco_dt, numWorkers=num_workers)
     # For COCO, the default max_dets_per_image is [1, 10, 100].
     max_dets_per_image = [1, 10, 100]  # Default from COCOEval
     coco_eval.params.maxDets = max_dets_per_image
@@ -325,3 +427,31 @@ def _evaluate_predictions_on_coco(
     coco_eval.summarize()
 
     return coco_eval
+
+
+def _evaluate_shard_on_coco(coco_gt, coco_results, vid_ids, num_workers=0):
+    """
+    Run the per video evaluation of `coco_results` on the videos `vid_ids` only.
+
+    Returns:
+        dict: the per video results of :meth:`YTVOSeval.evaluateVids`.
+    """
+    if len(vid_ids) == 0:
+        return {}
+    coco_dt = coco_gt.loadRes(list(coco_results))
+    coco_eval = YTVOSeval(coco_gt, coco_dt, numWorkers=num_workers)
+    coco_eval.params.maxDets = [1, 10, 100]
+    return coco_eval.evaluateVids(vid_ids)
+
+
+def _accumulate_shards_on_coco(coco_gt, eval_vids):
+    """
+    Accumulate and summarize the merged per video results of all the shards.
+    """
+    coco_eval = YTVOSeval(coco_gt, None)
+    coco_eval.params.maxDets = [1, 10, 100]
+    coco_eval.loadEvalVids(eval_vids, coco_gt.getVidIds())
+    coco_eval.accumulate()
+    coco_eval.summarize()
+
+    return coco_eval
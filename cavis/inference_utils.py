@@ -0,0 +1,484 @@
+import math
+import tempfile
+
+import numpy as np
+import pycocotools.mask as mask_util
+import torch
+from scipy.optimize import linear_sum_assignment
+from torch.nn import functional as F
+
+MASK_FORMATS = ("bitmask", "packed", "rle")
+MASK_STORAGE_DTYPES = ("float32", "float16", "bfloat16", "uint8")
+
+
+def encode_video_masks(masks):
+    """
+    Run-length encode the masks of all instances of a video with a single
+    `mask_util.encode` call.
+
+    Args:
+        masks (Tensor or list[Tensor]): bool masks of shape (N, T, H, W), or a list
+            of N tensors of shape (T, H, W).
+
+    Returns:
+        list[list[dict]]: N lists of T RLEs, with "counts" decoded to str.
+    """
+    if isinstance(masks, (list, tuple)):
+        if len(masks) == 0:
+            return []
+        masks = torch.stack(list(masks), dim=0)
+    if masks.numel() == 0:
+        return [[] for _ in range(masks.shape[0])]
+    num_instances, num_frames, h, w = masks.shape
+    # (N*T, W, H) in C order is (H, W, N*T) in Fortran order, which is what
+    # pycocotools expects, so the transposed numpy view needs no further copy
+    masks = masks.reshape(num_instances * num_frames, h, w).transpose(1, 2)
+    masks = masks.to(dtype=torch.uint8).contiguous().cpu().numpy()
+    rles = mask_util.encode(masks.transpose(2, 1, 0))
+    for rle in rles:
+        rle["counts"] = rle["counts"].decode("utf-8")
+    return [rles[i * num_frames: (i + 1) * num_frames] for i in range(num_instances)]
+
+
+def pack_masks(masks):
+    """
+    Pack bool masks (..., H, W) to bits along the width, 8 pixels per byte.
+
+    Returns:
+        ndarray: uint8 array of shape (..., H, ceil(W / 8)).
+    """
+    if isinstance(masks, torch.Tensor):
+        masks = masks.cpu().numpy()
+    return np.packbits(masks, axis=-1)
+
+
+def unpack_masks(packed, width):
+    """
+    Inverse of :func:`pack_masks`, returns bool masks of shape (..., H, width).
+    """
+    return np.unpackbits(packed, axis=-1, count=width).astype(bool)
+
+
+def store_mask_logits(mask_logits, storage_dtype="float32"):
+    """
+    Move mask logits to the host in a compact dtype, for the (Q, T, H, W) masks of a
+    whole video that are kept until the video is merged and upsampled.
+
+    Args:
+        mask_logits (Tensor): mask logits, on any device.
+        storage_dtype (str): one of:
+
+            * "float32", "float16" or "bfloat16": the logits cast to this dtype.
+            * "uint8": the sigmoid probabilities quantized to 256 levels. A pixel is
+              above 0.5 after :func:`load_mask_logits` iff its logit is above 0.
+
+    Returns:
+        Tensor: the stored masks, on the CPU.
+    """
+    assert storage_dtype in MASK_STORAGE_DTYPES, "Unknown mask storage dtype {}!".format(storage_dtype)
+    mask_logits = mask_logits.detach()
+    if storage_dtype == "uint8":
+        # quantize on the device, before the copy; `.float()` does not copy a float32
+        # input, so the sigmoid must not be in place
+        return torch.sigmoid(mask_logits.float()).mul_(255).round_().to(torch.uint8).cpu()
+    return mask_logits.to(getattr(torch, storage_dtype)).cpu()
+
+
+def load_mask_logits(masks):
+    """
+    The float32 mask logits of masks stored by :func:`store_mask_logits`.
+    """
+    if masks.dtype != torch.uint8:
+        return masks.float()
+    # bin centers, clamped so that the saturated bins map to finite logits
+    probs = (masks.float() / 255).clamp_(0.5 / 255, 1 - 0.5 / 255)
+    return probs.log() - probs.neg().log1p_()
+
+
+def panoptic_merge(cur_masks, cur_scores, cur_classes, num_thing_classes, overlap_threshold):
+    """
+    Merge the masks of the kept queries of a video into a panoptic id map.
+
+    It reproduces the usual per-query loop of Mask2Former panoptic inference, but
+    the per-query areas, the overlap ratios and the stuff merging are computed with
+    a few `bincount` over the argmax map and one gather, so the (T, H, W) volume is
+    traversed a constant number of times and the device is synchronized once.
+
+    Args:
+        cur_masks (Tensor): (Q, T, H, W) mask probabilities of the kept queries.
+        cur_scores (Tensor): (Q,) classification scores of the kept queries.
+        cur_classes (Tensor): (Q,) class of the kept queries, things come first.
+        num_thing_classes (int): number of thing classes.
+        overlap_threshold (float): a query is dropped if the area it wins in the argmax
+            map is less than this fraction of its own mask area.
+
+    Returns:
+        panoptic_seg (Tensor): (T, H, W) int32 segment ids, 0 for void.
+        segments_infos (list[dict]): "id", "isthing" and "category_id" of each segment.
+        segment_queries (list[int]): the index of the query of each segment.
+    """
+    num_queries = cur_masks.shape[0]
+    cur_prob_masks = cur_scores.view(-1, 1, 1, 1).to(cur_masks) * cur_masks
+    cur_mask_ids = cur_prob_masks.argmax(0)  # (t, h, w)
+    del cur_prob_masks
+
+    # a pixel is kept if its own query mask is above 0.5
+    valid = cur_masks.gather(0, cur_mask_ids[None]).squeeze(0) >= 0.5
+    flat_ids = cur_mask_ids.flatten()
+    mask_area = torch.bincount(flat_ids, minlength=num_queries)
+    original_area = (cur_masks >= 0.5).flatten(1).sum(1)
+    kept_area = torch.bincount(flat_ids[valid.flatten()], minlength=num_queries)
+    stats = torch.stack([mask_area, original_area, kept_area, cur_classes.to(mask_area)]).tolist()
+
+    segment_lut = [0] * num_queries
+    segments_infos = []
+    segment_queries = []
+    stuff_memory_list = {}
+    current_segment_id = 0
+    for k, (area, orig_area, kept, pred_class) in enumerate(zip(*stats)):
+        isthing = pred_class < num_thing_classes
+        # filter out the unstable segmentation results
+        if area == 0 or orig_area == 0 or kept == 0:
+            continue
+        if area / orig_area < overlap_threshold:
+            continue
+        # merge stuff regions
+        if not isthing:
+            if pred_class in stuff_memory_list:
+                segment_lut[k] = stuff_memory_list[pred_class]
+                continue
+            stuff_memory_list[pred_class] = current_segment_id + 1
+        current_segment_id += 1
+        segment_lut[k] = current_segment_id
+        segments_infos.append(
+            {
+                "id": current_segment_id,
+                "isthing": bool(isthing),
+                "category_id": int(pred_class),
+            }
+        )
+        segment_queries.append(k)
+
+    segment_lut = torch.tensor(segment_lut, dtype=torch.int32, device=cur_mask_ids.device)
+    panoptic_seg = segment_lut[cur_mask_ids].masked_fill_(~valid, 0)
+    return panoptic_seg, segments_infos, segment_queries
+
+
+def crop_to_image(masks, img_size, first_resize_size):
+    """
+    Crop the padding of masks predicted at a lower resolution than the padded
+    input of size `first_resize_size`, keeping the region of the `img_size` image.
+    """
+    h, w = masks.shape[-2:]
+    crop_h = min(math.ceil(img_size[0] * h / first_resize_size[0]), h)
+    crop_w = min(math.ceil(img_size[1] * w / first_resize_size[1]), w)
+    return masks[..., :crop_h, :crop_w]
+
+
+def upsample_ids(id_map, size):
+    """
+    Nearest neighbor upsampling of a (T, h, w) integer map to `size`.
+    """
+    upsampled = F.interpolate(id_map[None].float(), size=size, mode="nearest")[0]
+    return upsampled.to(id_map.dtype)
+
+
+def semantic_fusion(
+    mask_cls, mask_pred, img_size, first_resize_size, output_size, frame_chunk_size=0, low_res=False,
+):
+    """
+    Semantic segmentation of a video from the query classes and masks, i.e. the
+    per-pixel argmax over classes of sum_q mask_cls[q, c] * sigmoid(mask_pred[q]).
+
+    Frames are processed `frame_chunk_size` at a time, so the upsampled masks and the
+    class scores are only materialized for one chunk, instead of a (C, T, H, W) volume.
+
+    Args:
+        mask_cls (Tensor): (Q, C) class probabilities of the queries.
+        mask_pred (Tensor): (Q, T, h, w) mask logits at mask resolution, as stored by
+            :func:`store_mask_logits`.
+        img_size (tuple): size of the image in the padded input.
+        first_resize_size (tuple): size of the padded input.
+        output_size (tuple): (H, W) output resolution.
+        frame_chunk_size (int): number of frames per chunk, all frames at once if <= 0.
+        low_res (bool): take the argmax at mask resolution and upsample the labels
+            with nearest interpolation.
+
+    Returns:
+        Tensor: (T, H, W) int64 class of each pixel, on the CPU.
+    """
+    num_frames = mask_pred.shape[1]
+    if frame_chunk_size <= 0:
+        frame_chunk_size = num_frames
+    sem_masks = []
+    for start in range(0, num_frames, frame_chunk_size):
+        masks = load_mask_logits(mask_pred[:, start: start + frame_chunk_size])
+        if low_res:
+            masks = crop_to_image(masks, img_size, first_resize_size).sigmoid()
+        else:
+            # interpolation to original image size
+            masks = F.interpolate(masks, size=first_resize_size, mode="bilinear", align_corners=False)
+            masks = masks[:, :, :img_size[0], :img_size[1]].sigmoid()
+            masks = F.interpolate(masks, size=output_size, mode="bilinear", align_corners=False)
+        semseg = torch.einsum("qc,qthw->cthw", mask_cls, masks)
+        del masks
+        sem_mask = semseg.max(0)[1]
+        del semseg
+        if low_res:
+            sem_mask = upsample_ids(sem_mask, output_size)
+        sem_masks.append(sem_mask.cpu())
+    return torch.cat(sem_masks)
+
+
+def upsample_mask_chunks(pred_masks, img_size, first_resize_size, output_size, frame_chunk_size=0):
+    """
+    Upsample and threshold the (K, T, h, w) mask logits `frame_chunk_size` frames at a time.
+
+    Yields:
+        Tensor: (K, t, H, W) bool masks of consecutive chunks of frames.
+    """
+    num_frames = pred_masks.shape[1]
+    if frame_chunk_size <= 0:
+        frame_chunk_size = num_frames
+    for start in range(0, num_frames, frame_chunk_size):
+        masks = load_mask_logits(pred_masks[:, start: start + frame_chunk_size])
+        # interpolation to original image size
+        masks = F.interpolate(masks, size=first_resize_size, mode="bilinear", align_corners=False)
+        masks = masks[:, :, :img_size[0], :img_size[1]]
+        masks = F.interpolate(masks, size=output_size, mode="bilinear", align_corners=False)
+        yield masks > 0.
+
+
+def video_instance_masks(
+    pred_masks, img_size, first_resize_size, output_size, frame_chunk_size=0, mask_format="bitmask",
+):
+    """
+    Binary masks of the instances of a video at output resolution, built chunk by
+    chunk so that only (K, frame_chunk_size, H, W) masks live on the device.
+
+    Args:
+        pred_masks (Tensor): (K, T, h, w) mask logits at mask resolution, as stored by
+            :func:`store_mask_logits`.
+        mask_format (str): the format of the returned masks, one of:
+
+            * "bitmask": a (T, H, W) bool tensor per instance.
+            * "packed": a (T, H, ceil(W / 8)) uint8 array per instance, see
+              :func:`pack_masks`.
+            * "rle": a list of T RLEs per instance, with "counts" as str.
+
+    Returns:
+        list: the K instance masks.
+    """
+    assert mask_format in MASK_FORMATS, "Unknown mask format {}!".format(mask_format)
+    num_instances, num_frames = pred_masks.shape[:2]
+    h, w = output_size
+    if mask_format == "bitmask":
+        out = torch.empty((num_instances, num_frames, h, w), dtype=torch.bool)
+    elif mask_format == "packed":
+        out = np.empty((num_instances, num_frames, h, (w + 7) // 8), dtype=np.uint8)
+    else:
+        out = [[] for _ in range(num_instances)]
+
+    start = 0
+    for masks in upsample_mask_chunks(pred_masks, img_size, first_resize_size, output_size, frame_chunk_size):
+        end = start + masks.shape[1]
+        if mask_format == "bitmask":
+            out[:, start:end] = masks.cpu()
+        elif mask_format == "packed":
+            out[:, start:end] = pack_masks(masks)
+        else:
+            for rles, chunk_rles in zip(out, encode_video_masks(masks)):
+                rles.extend(chunk_rles)
+        start = end
+    return [m for m in out]
+
+
+def match_consecutive_frames(pred_embds):
+    """
+    Associate the queries of every frame to the ones of the first frame, as the
+    frame by frame matching of MinVIS, where each frame is matched to the previous
+    one after reordering.
+
+    The cosine costs of all consecutive frame pairs come from one batched matmul and
+    are moved to the host at once. Since matching against a reordered previous frame
+    only permutes the rows of its cost matrix, the permutations are solved on the raw
+    consecutive costs and composed cumulatively.
+
+    Args:
+        pred_embds (Tensor): (T, Q, C) query embeddings of each frame.
+
+    Returns:
+        Tensor: (T, Q) int64 permutations, `pred_embds[t][perms[t]]` aligns to frame 0.
+    """
+    num_frames, num_queries = pred_embds.shape[:2]
+    embds = pred_embds / pred_embds.norm(dim=2)[:, :, None]
+    # target x current cost of each pair of consecutive frames
+    costs = 1 - torch.bmm(embds[:-1], embds[1:].transpose(1, 2))
+    costs = costs.cpu().numpy()
+
+    perms = [np.arange(num_queries)]
+    for cost in costs:
+        indices = linear_sum_assignment(cost)[1]  # permutation that makes current aligns to previous
+        perms.append(indices[perms[-1]])
+    return torch.as_tensor(np.stack(perms), dtype=torch.int64)
+
+
+def apply_frame_permutations(perms, pred_logits, pred_masks):
+    """
+    Reorder the per-frame predictions with the permutations of :func:`match_consecutive_frames`
+    using one gather each.
+
+    Args:
+        perms (Tensor): (T, Q) permutations.
+        pred_logits (Tensor): (T, Q, K) class logits.
+        pred_masks (Tensor): (Q, T, H, W) masks.
+
+    Returns:
+        Tensor: (Q, K) class logits averaged over the frames.
+        Tensor: (Q, T, H, W) masks, the query of each frame aligned to the first frame.
+    """
+    num_frames = perms.shape[0]
+    logit_perms = perms.to(pred_logits.device)
+    out_logits = pred_logits.gather(1, logit_perms[:, :, None].expand(-1, -1, pred_logits.shape[-1])).mean(0)
+    frame_inds = torch.arange(num_frames, device=pred_masks.device)
+    out_masks = pred_masks[perms.t().to(pred_masks.device), frame_inds[None, :]]
+    return out_logits, out_masks
+
+
+class MaskFeatureStore:
+    """
+    Append-only store of the per-frame mask features of a video, spilled to a
+    memory-mapped fp16 file instead of host memory.
+
+    Windows of features are appended as they are computed, and read back by slicing
+    the frames like the (b, t, c, h, w) tensor, i.e. `store[:, start:end]`. Host memory
+    is bounded by the window being written or read, whatever the video length, and
+    the file is deleted on :meth:`close`.
+    """
+
+    def __init__(self, dirname=None):
+        """
+        Args:
+            dirname (str): directory of the backing file, the system temporary directory if None.
+        """
+        self._file = tempfile.NamedTemporaryFile(dir=dirname, prefix="mask_features_", suffix=".bin")
+        self._frame_shape = None
+        self._num_frames = 0
+        self._memmap = None
+
+    def __len__(self):
+        return self._num_frames
+
+    def append(self, mask_features):
+        """
+        Args:
+            mask_features (Tensor): (1, t, c, h, w) mask features of consecutive frames.
+        """
+        assert self._memmap is None, "Can not append to a store that has been read!"
+        assert mask_features.shape[0] == 1, "Only support a batch of one video!"
+        frames = mask_features[0].detach().to(device="cpu", dtype=torch.float16).numpy()
+        if self._frame_shape is None:
+            self._frame_shape = frames.shape[1:]
+        assert frames.shape[1:] == self._frame_shape
+        self._file.write(frames.tobytes())
+        self._num_frames += frames.shape[0]
+
+    def __getitem__(self, index):
+        batch_index, frame_index = index
+        assert batch_index == slice(None) and isinstance(frame_index, slice), \
+            "Only support slicing frames, e.g. store[:, start:end]!"
+        if self._memmap is None:
+            self._file.flush()
+            self._memmap = np.memmap(
+                self._file.name, dtype=np.float16, mode="r", shape=(self._num_frames,) + self._frame_shape
+            )
+        return torch.from_numpy(np.ascontiguousarray(self._memmap[frame_index]))[None]
+
+    def close(self):
+        self._memmap = None
+        self._file.close()
+
+
+def is_cuda_oom(error):
+    """
+    Whether `error` is a CUDA out-of-memory error, as detected by detectron2's `retry_if_cuda_oom`.
+    """
+    return isinstance(error, RuntimeError) and "CUDA out of memory" in str(error)
+
+
+class WindowSizeTuner:
+    """
+    Pick the number of frames run through the model at a time during window inference,
+    as the largest window whose activations fit in a memory budget.
+
+    The peak memory of every window, above what was allocated before it, gives the
+    memory cost of a frame. It is cached per key (the stage and the input resolution),
+    keeping the largest cost seen. The next window then gets as many frames as fit in
+    the budget left by the memory currently allocated. The first window of an unseen key
+    probes with the configured window size. A window that runs out of memory caps the
+    windows of its key at half its size.
+
+    CUDA only; on other devices the configured window size is kept.
+    """
+
+    def __init__(self, memory_budget_mb=0, max_window_size=64):
+        """
+        Args:
+            memory_budget_mb (float): device memory the model may allocate, 90% of the
+                device memory if 0.
+            max_window_size (int): upper bound of the window size.
+        """
+        self.memory_budget_mb = memory_budget_mb
+        self.max_window_size = max_window_size
+        self._frame_cost = {}
+        self._max_size = {}
+
+    def _budget(self, device):
+        if self.memory_budget_mb > 0:
+            return self.memory_budget_mb * 2 ** 20
+        return 0.9 * torch.cuda.get_device_properties(device).total_memory
+
+    def window_size(self, key, device, default):
+        """
+        Args:
+            key: identifies the stage and the resolution, e.g. ("segmenter", h, w).
+            device (torch.device): the device of the model.
+            default (int): the configured window size, used to probe an unseen key.
+        """
+        if device.type != "cuda":
+            return default
+        cap = min(self._max_size.get(key, self.max_window_size), self.max_window_size)
+        if key not in self._frame_cost:
+            return max(min(default, cap), 1)
+        free = self._budget(device) - torch.cuda.memory_allocated(device)
+        return max(min(int(free // self._frame_cost[key]), cap), 1)
+
+    def start_window(self, device):
+        """
+        Call before running a window, returns the memory allocated before it.
+        """
+        if device.type != "cuda":
+            return 0
+        torch.cuda.reset_peak_memory_stats(device)
+        return torch.cuda.memory_allocated(device)
+
+    def end_window(self, key, device, window_size, allocated_before):
+        """
+        Record the memory cost of a window of `window_size` frames that succeeded.
+        """
+        if device.type != "cuda":
+            return
+        cost = max(torch.cuda.max_memory_allocated(device) - allocated_before, 1) / window_size
+        self._frame_cost[key] = max(self._frame_cost.get(key, 0), cost)
+
+    def out_of_memory(self, key, window_size):
+        """
+        Record that a window of `window_size` frames ran out of memory.
+
+        Returns:
+            bool: whether a smaller window may be tried.
+        """
+        if window_size <= 1:
+            return False
+        self._max_size[key] = window_size // 2
+        return True
@@ -0,0 +1,143 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+from detectron2.utils import comm
+from detectron2.utils.events import get_event_storage
+
+_DISABLED = nullcontext()
+
+
+class StageProfiler:
+    """
+    Opt-in timers around the stages of the video models (backbone, sem_seg_head, tracker
+    layers, refiner, post-processing, ...).
+
+    For every stage and window it records the number of calls, the wall time, the part
+    of it spent waiting for the device to finish the queued kernels, and the allocated
+    device memory. A forward ends with :meth:`flush`, which puts the totals per stage in
+    the `EventStorage` during training, and writes one JSON line per video at inference.
+
+    When disabled, :meth:`stage` returns a shared no-op context manager.
+    """
+
+    def __init__(self, enabled=False, synchronize=True, log_file=""):
+        """
+        Args:
+            enabled (bool):
+            synchronize (bool): synchronize CUDA around every stage, so that its kernels are
+                charged to it. Without it, the wall time only covers the kernel launches.
+            log_file (str): the JSON lines file of the inference records, appended to, with
+                the rank as suffix when distributed. The records are logged if empty.
+        """
+        self.enabled = enabled
+        self.synchronize = synchronize
+        self.log_file = log_file
+        self.window = None
+        self._records = OrderedDict()
+        self._logger = logging.getLogger(__name__)
+
+    def set_window(self, window):
+        """
+        Charge the following stages to the `window`-th window of the video, None after the last one.
+        """
+        self.window = window
+
+    def discard_window(self, window):
+        """
+        Drop the records of the `window`-th window, e.g. of a window run again after an OOM.
+        """
+        for key in [key for key in self._records if key[0] == window]:
+            del self._records[key]
+
+    def stage(self, name):
+        if not self.enabled:
+            return _DISABLED
+        return self._measure(name)
+
+    @contextmanager
+    def _measure(self, name):
+        cuda = torch.cuda.is_available() and torch.cuda.is_initialized()
+        if cuda and self.synchronize:
+            # do not charge the kernels queued before the stage to it
+            torch.cuda.synchronize()
+        allocated_before = torch.cuda.memory_allocated() if cuda else 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            sync_start = time.perf_counter()
+            if cuda and self.synchronize:
+                torch.cuda.synchronize()
+            end = time.perf_counter()
+
+            record = self._records.get((self.window, name))
+            if record is None:
+                record = {"calls": 0, "wall_ms": 0.0, "sync_ms": 0.0, "allocated_mb": 0.0, "allocated_delta_mb": 0.0}
+                self._records[(self.window, name)] = record
+            record["calls"] += 1
+            record["wall_ms"] += (end - start) * 1000
+            record["sync_ms"] += (end - sync_start) * 1000
+            if cuda:
+                allocated = torch.cuda.memory_allocated()
+                record["allocated_mb"] = max(record["allocated_mb"], allocated / 2 ** 20)
+                record["allocated_delta_mb"] += (allocated - allocated_before) / 2 ** 20
+
+    def _totals(self, records):
+        totals = OrderedDict()
+        for (_, name), record in records.items():
+            total = totals.setdefault(name, {k: 0 if k == "calls" else 0.0 for k in record})
+            for k, v in record.items():
+                total[k] = max(total[k], v) if k == "allocated_mb" else total[k] + v
+        return totals
+
+    def flush(self, training, video_id=None, num_frames=None):
+        """
+        Report the stages recorded since the last call.
+
+        Args:
+            training (bool): put the totals of the stages in the current `EventStorage` if
+                True, else write them with the records of every window as a JSON line.
+            video_id: identifies the video in the JSON line.
+            num_frames (int): the length of the video, in the JSON line.
+        """
+        self.window = None
+        if not self.enabled or len(self._records) == 0:
+            return
+        records, self._records = self._records, OrderedDict()
+        totals = self._totals(records)
+
+        if training:
+            storage = get_event_storage()
+            for name, total in totals.items():
+                storage.put_scalars(
+                    **{
+                        "profile/{}_ms".format(name): total["wall_ms"],
+                        "profile/{}_sync_ms".format(name): total["sync_ms"],
+                        "profile/{}_allocated_mb".format(name): total["allocated_mb"],
+                    },
+                    smoothing_hint=True,
+                )
+            return
+
+        windows = OrderedDict()
+        for (window, name), record in records.items():
+            windows.setdefault(window, OrderedDict())[name] = record
+        line = json.dumps({
+            "video_id": video_id,
+            "num_frames": num_frames,
+            "windows": [{"window": window, "stages": stages} for window, stages in windows.items()],
+            "total": totals,
+        })
+        if not self.log_file:
+            self._logger.info("Stage profile: {}".format(line))
+            return
+        log_file = self.log_file
+        if comm.get_world_size() > 1:
+            log_file = "{}.rank{}".format(log_file, comm.get_rank())
+        with open(log_file, "a") as f:
+            f.write(line + "\n")
@@ -7,6 +7,12 @@ from mask2former_video.modeling.transformer_decoder.video_mask2former_transforme
 from scipy.optimize import linear_sum_assignment
 import fvcore.nn.weight_init as weight_init
 
+from .inference_utils import store_mask_logits
+from .profiling import StageProfiler
+
+# mask logit of the queries pruned by the tracker
+PRUNED_MASK_LOGIT = -1e4
+
 
 class ReferringCrossAttentionLayer_CAVIS(nn.Module):
 
@@ -104,10 +110,21 @@ class CAVIS_Tracker(torch.nn.Module):
         decoder_layer_num=6,
         mask_dim=256,
         class_num=25,
+        prune_queries=False,
+        prune_threshold=0.1,
+        prune_decay=0.9,
+        profiler=None,
     ):
         super(CAVIS_Tracker, self).__init__()
 
         self.hidden_channel = hidden_channel
+        # at inference, the queries whose activity (the decayed maximum of their foreground
+        # probability over the past frames) is below prune_threshold skip the tracker layers
+        self.prune_queries = prune_queries
+        self.prune_threshold = prune_threshold
+        self.prune_decay = prune_decay
+        # times the tracker layers and the matching, shared with the model
+        self.profiler = profiler if profiler is not None else StageProfiler()
         # init transformer layers
         self.num_heads = num_head
         self.num_layers = decoder_layer_num
@@ -155,19 +172,38 @@ class CAVIS_Tracker(torch.nn.Module):
         # record previous frame information
         self.last_ctx_aware_query = None
         self.last_frame_embeds = None
+        self.query_activity = None
 
     def _clear_memory(self):
         del self.last_ctx_aware_query
         self.last_ctx_aware_query = None
+        self.query_activity = None
         return
 
+    def get_memory(self):
+        """
+        the tracking state carried from one frame to the next, e.g. to interleave several videos
+        :return: a dict to restore with set_memory before resuming the video
+        """
+        return {
+            'last_ctx_aware_query': self.last_ctx_aware_query,
+            'last_frame_embeds': self.last_frame_embeds,
+            'query_activity': self.query_activity,
+        }
+
+    def set_memory(self, memory):
+        for k, v in memory.items():
+            setattr(self, k, v)
+
     def forward(self, frame_embeds, mask_features, resume=False, return_indices=False,
-                frame_embeds_no_norm=None):
+                frame_embeds_no_norm=None, frame_logits=None):
         """
         :param frame_embeds: the context-aware instance queries output by the segmenter
         :param mask_features: the mask features output by the segmenter
         :param resume: whether the first frame is the start of the video
         :param return_indices: whether return the match indices
+        :param frame_logits: the class logits output by the segmenter, shape is (b, t, q, c),
+                             needed to prune the background queries at inference
         :return: output dict, including masks, classes, embeds.
         """
         frame_embeds = frame_embeds.permute(2, 3, 0, 1)  # t, q, b, 2c
@@ -179,6 +215,14 @@ class CAVIS_Tracker(torch.nn.Module):
         
         all_frames_references = []
 
+        prune = not self.training and self.prune_queries and frame_logits is not None
+        live_queries = None
+        if prune:
+            # foreground probability of the queries proposed by the segmenter
+            proposal_fg = 1 - frame_logits.softmax(dim=-1)[..., -1].permute(1, 2, 0)  # t, q, b
+            live_queries = torch.zeros(n_q, dtype=torch.bool, device=frame_embeds.device)
+        active = None
+
         for i in range(n_frame):
             ms_output = []
             single_frame_embeds = frame_embeds[i]  # q b 2c
@@ -193,44 +237,22 @@ class CAVIS_Tracker(torch.nn.Module):
             if i == 0 and resume is False:
                 self._clear_memory()
                 self.last_frame_embeds = single_frame_embeds
+                if prune:
+                    active = self._update_activity(proposal_fg[i])
                 for j in range(self.num_layers):
                     if j == 0:
                         ms_output.append(single_frame_embeds[..., :self.hidden_channel])
                         ret_indices.append(self.match_embds(single_frame_embeds, single_frame_embeds))
                         init_obj_embeds = single_frame_embeds[..., :self.hidden_channel]
                         ctx_aware_query = self.ctx_query_embed(single_frame_embeds)
-                        output = self.transformer_cross_attention_layers[j](
-                            init_obj_embeds, ctx_aware_query, ctx_aware_query, obj_embeds,
-                            memory_mask=None,
-                            memory_key_padding_mask=None,
-                            pos=None, query_pos=None
-                        )
-                        output = self.transformer_self_attention_layers[j](
-                            output, tgt_mask=None,
-                            tgt_key_padding_mask=None,
-                            query_pos=None
-                        )
-                        # FFN
-                        output = self.transformer_ffn_layers[j](
-                            output
+                        output = self._decoder_layer(
+                            j, init_obj_embeds, ctx_aware_query, ctx_aware_query, obj_embeds, active
                         )
                         ms_output.append(output)
                     else:
                         ctx_aware_query = self.ctx_query_embed(torch.cat([output, ctx_embeds], dim=-1))
-                        output = self.transformer_cross_attention_layers[j](
-                            ms_output[-1], ctx_aware_query, ctx_aware_key, obj_embeds,
-                            memory_mask=None,
-                            memory_key_padding_mask=None,
-                            pos=None, query_pos=None
-                        )
-                        output = self.transformer_self_attention_layers[j](
-                            output, tgt_mask=None,
-                            tgt_key_padding_mask=None,
-                            query_pos=None
-                        )
-                        # FFN
-                        output = self.transformer_ffn_layers[j](
-                            output
+                        output = self._decoder_layer(
+                            j, ms_output[-1], ctx_aware_query, ctx_aware_key, obj_embeds, active
                         )
                         ms_output.append(output)
             else:
@@ -242,49 +264,36 @@ class CAVIS_Tracker(torch.nn.Module):
                         indices = self.match_embds(self.last_frame_embeds, single_frame_embeds)
                         self.last_frame_embeds = single_frame_embeds[indices]
                         ret_indices.append(indices)
+                        if prune:
+                            active = self._update_activity(proposal_fg[i][indices])
                         init_obj_embeds = single_frame_embeds[indices][..., :self.hidden_channel]
-                        output = self.transformer_cross_attention_layers[j](
-                            init_obj_embeds, ctx_aware_query, ctx_aware_key, obj_embeds,
-                            memory_mask=None,
-                            memory_key_padding_mask=None,
-                            pos=None, query_pos=None
-                        )
-                        output = self.transformer_self_attention_layers[j](
-                            output, tgt_mask=None,
-                            tgt_key_padding_mask=None,
-                            query_pos=None
-                        )
-                        # FFN
-                        output = self.transformer_ffn_layers[j](
-                            output
+                        output = self._decoder_layer(
+                            j, init_obj_embeds, ctx_aware_query, ctx_aware_key, obj_embeds, active
                         )
                         ms_output.append(output)
                     else:
-                        output = self.transformer_cross_attention_layers[j](
-                            ms_output[-1], ctx_aware_query, ctx_aware_key, obj_embeds,
-                            memory_mask=None,
-                            memory_key_padding_mask=None,
-                            pos=None, query_pos=None
-                        )
-                        output = self.transformer_self_attention_layers[j](
-                            output, tgt_mask=None,
-                            tgt_key_padding_mask=None,
-                            query_pos=None
-                        )
-                        # FFN
-                        output = self.transformer_ffn_layers[j](
-                            output
+                        output = self._decoder_layer(
+                            j, ms_output[-1], ctx_aware_query, ctx_aware_key, obj_embeds, active
                         )
                         ms_output.append(output)
             ms_output = torch.stack(ms_output, dim=0)  # (1 + layers, q, b, c)
+            if prune:
+                self._track_activity(ms_output[-1], active)
+                live_queries[slice(None) if active is None else active] = True
             
             # Reorder context queries (See Eq. (10) in Sec. 4.1.2.)
             ctx_index = self.match_embds(ms_output[-1], obj_embeds)
             self.last_ctx_aware_query = torch.cat([ms_output[-1], ctx_embeds[ctx_index]], dim=-1)
             outputs.append(ms_output[1:])
         outputs = torch.stack(outputs, dim=0)  # (t, l, q, b, c)
-        all_frames_references = torch.stack(all_frames_references, dim=0)  # (t-1, q, b, c)
-        outputs_class, outputs_masks = self.prediction(outputs, mask_features)
+        if len(all_frames_references) > 0:
+            all_frames_references = torch.stack(all_frames_references, dim=0)  # (t-1, q, b, c)
+        else:
+            # a single frame starting the video has no reference
+            all_frames_references = frame_embeds.new_zeros((0, n_q, bs, self.hidden_channel))
+        if live_queries is not None and bool(live_queries.all()):
+            live_queries = None
+        outputs_class, outputs_masks = self.prediction(outputs, mask_features, live_queries=live_queries)
         outputs = self.decoder_norm(outputs)
         out = {
            'pred_logits': outputs_class[-1].transpose(1, 2),  # (b, t, q, c)
@@ -300,19 +309,76 @@ class CAVIS_Tracker(torch.nn.Module):
         else:
             return out
 
+    def _decoder_layer(self, j, indentify, ctx_aware_query, ctx_aware_key, obj_embeds, active=None):
+        """
+        the j-th tracker layer (cross-attention, self-attention and FFN)
+        :param active: indices of the queries to compute, the other queries keep `indentify`, all queries if None
+        """
+        if active is not None:
+            if active.numel() == 0:
+                return indentify
+            all_queries = indentify
+            indentify, ctx_aware_query = indentify[active], ctx_aware_query[active]
+        with self.profiler.stage("tracker.layer{}".format(j)):
+            output = self.transformer_cross_attention_layers[j](
+                indentify, ctx_aware_query, ctx_aware_key, obj_embeds,
+                memory_mask=None,
+                memory_key_padding_mask=None,
+                pos=None, query_pos=None
+            )
+            output = self.transformer_self_attention_layers[j](
+                output, tgt_mask=None,
+                tgt_key_padding_mask=None,
+                query_pos=None
+            )
+            # FFN
+            output = self.transformer_ffn_layers[j](
+                output
+            )
+        if active is not None:
+            output = all_queries.index_copy(0, active, output.to(all_queries))
+        return output
+
+    def _update_activity(self, proposal_fg):
+        """
+        decay the activity of the queries, and re-admit the ones matched to a foreground segmenter proposal
+        :param proposal_fg: foreground probability of the segmenter query matched to each query, shape is (q, b)
+        :return: indices of the active queries, None if all queries are active
+        """
+        if self.query_activity is None:
+            self.query_activity = proposal_fg
+        else:
+            self.query_activity = torch.maximum(self.query_activity * self.prune_decay, proposal_fg)
+        active = (self.query_activity >= self.prune_threshold).any(dim=1)
+        if bool(active.all()):
+            return None
+        return active.nonzero()[:, 0]
+
+    def _track_activity(self, output, active=None):
+        """
+        raise the activity of the active queries to their foreground probability predicted by the tracker
+        :param output: the last layer output, shape is (q, b, c)
+        """
+        if active is None:
+            active = slice(None)
+        logits = self.class_embed(self.decoder_norm(output[active]))
+        track_fg = 1 - logits.softmax(dim=-1)[..., -1]
+        self.query_activity[active] = torch.maximum(self.query_activity[active], track_fg.to(self.query_activity))
+
     def match_embds(self, ref_embds, cur_embds):
-        #  embeds (q, b, c)
-        ref_embds, cur_embds = ref_embds.detach()[:, 0, :], cur_embds.detach()[:, 0, :]
-        ref_embds = ref_embds / (ref_embds.norm(dim=1)[:, None] + 1e-6)
-        cur_embds = cur_embds / (cur_embds.norm(dim=1)[:, None] + 1e-6)
-        cos_sim = torch.mm(ref_embds, cur_embds.transpose(0, 1))
-        C = 1 - cos_sim
-
-        C = C.cpu()
-        C = torch.where(torch.isnan(C), torch.full_like(C, 0), C)
-
-        indices = linear_sum_assignment(C.transpose(0, 1))
-        indices = indices[1]
+        with self.profiler.stage("tracker.match_embds"):
+            #  embeds (q, b, c)
+            ref_embds, cur_embds = ref_embds.detach()[:, 0, :], cur_embds.detach()[:, 0, :]
+            ref_embds = ref_embds / (ref_embds.norm(dim=1)[:, None] + 1e-6)
+            cur_embds = cur_embds / (cur_embds.norm(dim=1)[:, None] + 1e-6)
+            cos_sim = torch.mm(ref_embds, cur_embds.transpose(0, 1))
+            C = 1 - cos_sim
+
+            C = C.cpu()
+            C = torch.where(torch.isnan(C), torch.full_like(C, 0), C)
+
+            indices = linear_sum_assignment(C.transpose(0, 1))
+            indices = indices[1]
         return indices
 
     @torch.jit.unused
@@ -324,14 +390,23 @@ class CAVIS_Tracker(torch.nn.Module):
                 for a, b in zip(outputs_class[:-1], outputs_seg_masks[:-1])
                 ]
 
-    def prediction(self, outputs, mask_features):
+    def prediction(self, outputs, mask_features, live_queries=None):
         # outputs (t, l, q, b, c)
         # mask_features (b, t, c, h, w)
+        # live_queries (q, ), if given, only the masks of these queries are computed, the classes
+        # of all queries are, so that the score of a query pruned in a window is kept
         decoder_output = self.decoder_norm(outputs)
         decoder_output = decoder_output.permute(1, 3, 0, 2, 4)  # (l, b, t, q, c)
         outputs_class = self.class_embed(decoder_output).transpose(2, 3)  # (l, b, q, t, cls+1)
         mask_embed = self.mask_embed(decoder_output)
-        outputs_mask = torch.einsum("lbtqc,btchw->lbqthw", mask_embed, mask_features)
+        if live_queries is None:
+            outputs_mask = torch.einsum("lbtqc,btchw->lbqthw", mask_embed, mask_features)
+        else:
+            live_mask = torch.einsum("lbtqc,btchw->lbqthw", mask_embed[:, :, :, live_queries], mask_features)
+            l, b, _, t, h, w = live_mask.shape
+            # the pruned queries are background, i.e. empty masks
+            outputs_mask = live_mask.new_full((l, b, live_queries.numel(), t, h, w), PRUNED_MASK_LOGIT)
+            outputs_mask[:, :, live_queries] = live_mask
         return outputs_class, outputs_mask
 
 
@@ -345,10 +420,19 @@ class TemporalRefiner(torch.nn.Module):
         mask_dim=256,
         class_num=25,
         windows=5,
+        chunk_size=0,
+        chunk_overlap=0,
+        mask_storage_dtype="float32",
     ):
         super(TemporalRefiner, self).__init__()
 
         self.windows = windows
+        # dtype of the predicted mask logits moved to the host at inference
+        self.mask_storage_dtype = mask_storage_dtype
+        # at inference, videos longer than chunk_size frames are refined in overlapping chunks
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        assert chunk_size <= 0 or 0 <= chunk_overlap < chunk_size
 
         # init transformer layers
         self.num_heads = num_head
@@ -427,6 +511,46 @@ class TemporalRefiner(torch.nn.Module):
         :param mask_features: the mask features output by the segmenter, shape is (b, t, c, h, w)
         :return: output dict, including masks, classes, embeds.
         """
+        n_frames = instance_embeds.size(2)
+        if not self.training and self.chunk_size > 0 and n_frames > self.chunk_size:
+            return self.chunked_forward(instance_embeds, frame_embeds, mask_features)
+
+        outputs = self.refine(instance_embeds, frame_embeds)
+        return self.predict_outputs(outputs, mask_features)
+
+    def chunked_forward(self, instance_embeds, frame_embeds, mask_features):
+        """
+        Refine a long video in temporal chunks of self.chunk_size frames, consecutive chunks
+        overlapping by self.chunk_overlap frames, so that the temporal attention is quadratic
+        in the chunk size instead of the video length. In an overlap, each frame is taken from
+        the chunk where it is farthest from the border, i.e. the first half of the overlap from
+        the earlier chunk and the second half from the later one.
+        The class of each instance is still predicted from all the frames of the video.
+        """
+        n_frames = instance_embeds.size(2)
+        stride = self.chunk_size - self.chunk_overlap
+        starts = list(range(0, n_frames - self.chunk_size, stride)) + [n_frames - self.chunk_size]
+
+        outputs = []
+        keep_start = 0
+        for i, start in enumerate(starts):
+            end = start + self.chunk_size
+            keep_end = n_frames if i == len(starts) - 1 else (starts[i + 1] + end) // 2
+            output = self.refine(
+                instance_embeds[:, :, start:end], frame_embeds[:, :, start:end], last_layer_only=True,
+            )[-1]
+            outputs.append(output[:, :, keep_start - start: keep_end - start])
+            keep_start = keep_end
+        outputs = [torch.cat(outputs, dim=2)]
+        return self.predict_outputs(outputs, mask_features)
+
+    def refine(self, instance_embeds, frame_embeds, last_layer_only=False):
+        """
+        :param instance_embeds: the aligned instance queries, shape is (b, c, t, q)
+        :param frame_embeds: the frame instance queries, shape is (b, c, t, q)
+        :param last_layer_only: only keep the output of the last layer
+        :return: list of the (b, c, t, q) outputs of the decoder layers
+        """
         n_batch, n_channel, n_frames, n_instance = instance_embeds.size()
 
         outputs = []
@@ -474,8 +598,18 @@ class TemporalRefiner(torch.nn.Module):
             )
 
             output = output.reshape(n_instance, n_batch, n_frames, n_channel).permute(1, 3, 2, 0)  # (b, c, t, q)
-            outputs.append(output)
+            if last_layer_only:
+                outputs = [output]
+            else:
+                outputs.append(output)
+        return outputs
 
+    def predict_outputs(self, outputs, mask_features):
+        """
+        :param outputs: list of the (b, c, t, q) outputs of the decoder layers
+        :param mask_features: the mask features output by the segmenter, shape is (b, t, c, h, w)
+        :return: output dict, including masks, classes, embeds.
+        """
         outputs = torch.stack(outputs, dim=0).permute(3, 0, 4, 1, 2)  # (l, b, c, t, q) -> (t, l, q, b, c)
         outputs_class, outputs_masks = self.prediction(outputs, mask_features)
         outputs = self.decoder_norm(outputs)
@@ -517,10 +651,10 @@ class TemporalRefiner(torch.nn.Module):
             outputs_mask = torch.einsum(
                 "lbtqc,btchw->lbqthw",
                 mask_embed,
-                mask_features[:, start_idx:end_idx].to(mask_embed.device)
+                mask_features[:, start_idx:end_idx].to(mask_embed)
             )
             outputs_classes.append(decoder_output)
-            outputs_masks.append(outputs_mask.cpu().to(torch.float32))
+            outputs_masks.append(store_mask_logits(outputs_mask, self.mask_storage_dtype))
         outputs_classes = torch.cat(outputs_classes, dim=2)
         outputs_classes = self.pred_class(outputs_classes)
         return outputs_classes.cpu().to(torch.float32), torch.cat(outputs_masks, dim=3)
@@ -544,7 +678,7 @@ class TemporalRefiner(torch.nn.Module):
     def prediction(self, outputs, mask_features):
         """
         :param outputs: instance queries, shape is (t, l, q, b, c)
-        :param mask_features: mask features, shape is (b, t, c, h, w)
+        :param mask_features: mask features, shape is (b, t, c, h, w), or a MaskFeatureStore at inference
         :return: pred class and pred masks
         """
         if self.training:
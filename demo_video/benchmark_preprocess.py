@@ -0,0 +1,77 @@
+"""
+Compare the per-frame preprocessing loop of VideoPredictor with the batched resize_clip on
+random clips, e.g.
+
+    python demo_video/benchmark_preprocess.py --num-frames 30 --device cuda
+
+Both paths are timed up to float32 frames on the device, as the model receives them.
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import detectron2.data.transforms as T
+
+from predictor import resize_clip
+
+RESOLUTIONS = {"720p": (720, 1280), "1080p": (1080, 1920)}
+
+
+def per_frame(frames, aug, device):
+    # the loop of VideoPredictor.preprocess, followed by the per-frame copy of the model
+    out = []
+    for frame in frames:
+        image = aug.get_transform(frame).apply_image(frame)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        out.append(image.to(device))
+    return out
+
+
+def _time(fn, repeats, device):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)), out
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="benchmark of the video demo preprocessing")
+    parser.add_argument("--resolutions", nargs="+", default=list(RESOLUTIONS), choices=list(RESOLUTIONS))
+    parser.add_argument("--num-frames", type=int, default=30)
+    parser.add_argument("--min-size-test", type=int, default=360)
+    parser.add_argument("--max-size-test", type=int, default=1333)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--repeats", type=int, default=10)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    device = torch.device(args.device)
+    aug = T.ResizeShortestEdge([args.min_size_test, args.min_size_test], args.max_size_test)
+    rng = np.random.default_rng(0)
+
+    for name in args.resolutions:
+        h, w = RESOLUTIONS[name]
+        frames = [rng.integers(0, 256, (h, w, 3), dtype=np.uint8) for _ in range(args.num_frames)]
+        # warm up the allocator and the kernels
+        per_frame(frames[:2], aug, device)
+        resize_clip(frames[:2], aug, device=device)
+
+        loop_time, loop_out = _time(lambda: per_frame(frames, aug, device), args.repeats, device)
+        clip_time, clip_out = _time(lambda: resize_clip(frames, aug, device=device), args.repeats, device)
+        diff = (torch.stack(loop_out) - clip_out).abs()
+        print(
+            "{} x {} frames on {}: loop {:.1f} ms ({:.0f} fps), batched {:.1f} ms ({:.0f} fps), "
+            "speedup {:.2f}x, mean abs diff {:.3f}, max abs diff {:.1f}".format(
+                name, args.num_frames, device, loop_time * 1000, args.num_frames / loop_time,
+                clip_time * 1000, args.num_frames / clip_time, loop_time / clip_time,
+                diff.mean().item(), diff.max().item(),
+            )
+        )
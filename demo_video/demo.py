@@ -33,7 +33,8 @@ from detectron2.utils.logger import setup_logger
 from mask2former import add_maskformer2_config
 from mask2former_video import add_maskformer2_video_config
 from cavis import add_minvis_config, add_dvis_config, add_cavis_config
-from predictor import VisualizationDemo
+from predictor import VisualizationDemo, _get_objects_from_outputs
+from output_sink import open_frame_sink, PredictionWriter
 
 import shutil
 
@@ -67,8 +68,17 @@ def get_parser():
 	)
 	parser.add_argument(
 		"--output",
-		help="directory to save output frames",
-		required=True,
+		help="directory to save output frames, or a video file (.mp4, .avi, .mkv or .mov)",
+	)
+	parser.add_argument(
+		"--export-predictions",
+		help="JSON Lines file to save the per-frame RLE masks and track ids of the predictions",
+	)
+	parser.add_argument(
+		"--fps",
+		type=float,
+		default=30.0,
+		help="Frame rate of the output video",
 	)
 	parser.add_argument(
 		"--confidence-threshold",
@@ -76,6 +86,12 @@ def get_parser():
 		default=0.5,
 		help="Minimum score for instance predictions to be shown",
 	)
+	parser.add_argument(
+		"--renderer",
+		default="detectron2",
+		choices=["detectron2", "overlay", "contour"],
+		help="detectron2 (matplotlib) visualizer, or fast numpy/OpenCV mask overlays or contours",
+	)
 	parser.add_argument(
 		"--opts",
 		help="Modify config options using the command-line 'KEY VALUE' pairs",
@@ -93,14 +109,12 @@ if __name__ == "__main__":
 
 	cfg = setup_cfg(args)
 
-	demo = VisualizationDemo(cfg)
+	demo = VisualizationDemo(cfg, renderer=args.renderer)
 
-	assert args.input and args.output
+	assert args.input and (args.output or args.export_predictions)
 
 	video_root = args.input
 	output_root = args.output
-
-	os.makedirs(output_root, exist_ok=True)
 	
 	frames_path = video_root
 	frames_path = glob.glob(os.path.expanduser(os.path.join(frames_path, '*.???')))
@@ -113,15 +127,25 @@ if __name__ == "__main__":
 
 	start_time = time.time()
 	with autocast():
-		predictions, visualized_output = demo.run_on_video(vid_frames)
+		if output_root:
+			predictions, visualized_output = demo.run_on_video(vid_frames)
+		else:
+			predictions, visualized_output = demo.predictor(vid_frames), []
+	pred_masks, pred_labels, pred_scores, pred_ids = _get_objects_from_outputs(predictions)
 	logger.info(
 		"detected {} instances per frame in {:.2f}s".format(
-			len(predictions["pred_scores"]), time.time() - start_time
+			len(pred_scores), time.time() - start_time
 		)
 	)
 
+	frame_names = [os.path.basename(path) for path in frames_path]
 	# save frames
-	for path, _vis_output in zip(frames_path, visualized_output):
-		out_filename = os.path.join(output_root, os.path.basename(path))
-		_vis_output.save(out_filename)
-
+	if output_root:
+		sink = open_frame_sink(output_root, fps=args.fps)
+		for frame_name, _vis_output in zip(frame_names, visualized_output):
+			sink.write(frame_name, _vis_output)
+		sink.close()
+	if args.export_predictions:
+		prediction_writer = PredictionWriter(args.export_predictions)
+		prediction_writer.write(frame_names, pred_masks, pred_labels, pred_scores, pred_ids)
+		prediction_writer.close()
@@ -7,7 +7,6 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 # Modified by Bowen Cheng from: https://github.com/facebookresearch/detectron2/blob/master/demo/demo.py
 import argparse
-import glob
 import multiprocessing as mp
 import os
 
@@ -19,10 +18,7 @@ sys.path.insert(1, os.path.join(sys.path[0], '..'))
 import time
 import tqdm
 
-from torch.cuda.amp import autocast
-
 from detectron2.config import get_cfg
-from detectron2.data.detection_utils import read_image
 from detectron2.projects.deeplab import add_deeplab_config
 from detectron2.utils.logger import setup_logger
 
@@ -30,6 +26,9 @@ from mask2former import add_maskformer2_config
 from mask2former_video import add_maskformer2_video_config
 from cavis import add_minvis_config, add_cavis_config, add_dvis_config
 from predictor import VisualizationDemo, VisualizationDemo_windows
+from frame_reader import FrameReader
+from output_sink import open_frame_sink, PredictionWriter
+from pipeline import PipelinedVideoRunner
 
 
 def setup_cfg(args):
@@ -56,13 +55,22 @@ def get_parser():
 	)
 	parser.add_argument(
 		"--input",
-		help="directory of input video frames",
+		help="directory of input video frames, or a video file",
 		required=True,
 	)
 	parser.add_argument(
 		"--output",
-		help="directory to save output frames",
-		required=True,
+		help="directory to save output frames, or a video file (.mp4, .avi, .mkv or .mov)",
+	)
+	parser.add_argument(
+		"--export_predictions",
+		help="JSON Lines file to save the per-frame RLE masks and track ids of the predictions",
+	)
+	parser.add_argument(
+		"--fps",
+		type=float,
+		default=None,
+		help="Frame rate of the output video, that of the input video by default",
 	)
 	parser.add_argument(
 		"--confidence_threshold",
@@ -76,6 +84,24 @@ def get_parser():
 		default=-1,
 		help="Windows size for semi-offline mode",
 	)
+	parser.add_argument(
+		"--decode_queue_size",
+		type=int,
+		default=64,
+		help="Maximum number of frames decoded ahead of the inference",
+	)
+	parser.add_argument(
+		"--max_pending_windows",
+		type=int,
+		default=2,
+		help="Maximum number of predicted windows waiting to be rendered",
+	)
+	parser.add_argument(
+		"--renderer",
+		default="detectron2",
+		choices=["detectron2", "overlay", "contour"],
+		help="detectron2 (matplotlib) visualizer, or fast numpy/OpenCV mask overlays or contours",
+	)
 	parser.add_argument(
 		"--opts",
 		help="Modify config options using the command-line 'KEY VALUE' pairs",
@@ -93,49 +119,36 @@ if __name__ == "__main__":
 
 	cfg = setup_cfg(args)
 
-	demo = VisualizationDemo_windows(cfg)
+	demo = VisualizationDemo_windows(cfg, renderer=args.renderer)
 
-	assert args.input and args.output
+	assert args.input and (args.output or args.export_predictions)
 
 	video_root = args.input
 	output_root = args.output
 	score_threshold = args.confidence_threshold
 	windows_size = args.windows_size
 
-
-	os.makedirs(output_root, exist_ok=True)
 	
-	frames_path = video_root
-	frames_path = glob.glob(os.path.expanduser(os.path.join(frames_path, '*.???')))
-	frames_path.sort()
+	reader = FrameReader(video_root, max_queue_size=args.decode_queue_size)
 	if windows_size == -1:
-		windows_size = len(frames_path)
+		windows_size = len(reader)
+	fps = args.fps or reader.fps or 30.0
+	sink = open_frame_sink(output_root, fps=fps) if output_root else None
+	prediction_writer = PredictionWriter(args.export_predictions) if args.export_predictions else None
+	# decoding, inference and rendering/writing run concurrently
+	runner = PipelinedVideoRunner(
+		demo, reader, windows_size, sink=sink, prediction_writer=prediction_writer,
+		max_pending_windows=args.max_pending_windows,
+	)
 	start_time = time.time()
-	vid_frames = []
-	_frames_path = []
-	instances = set()
-	for i, path in enumerate(tqdm.tqdm(frames_path)):
-		img = read_image(path, format="BGR")
-		_frames_path.append(path)
-		vid_frames.append(img)
-		if len(vid_frames) == windows_size or i == len(frames_path) - 1:
-			# do inference
-			with autocast():
-				if i < windows_size:
-					predictions, visualized_output = demo.run_on_video(vid_frames, keep=False)
-				else:
-					predictions, visualized_output = demo.run_on_video(vid_frames, keep=True)
-			# do save
-			for path, _vis_output in zip(_frames_path, visualized_output):
-				out_filename = os.path.join(output_root, os.path.basename(path))
-				_vis_output.save(out_filename)
-			if 'pred_ids' in predictions.keys():
-				for id in predictions['pred_ids']:
-					instances.add(id)
-			del visualized_output, vid_frames, _frames_path, predictions
-
-			vid_frames = []
-			_frames_path = []
+	progress = tqdm.tqdm(total=len(reader))
+	instances = runner.run(progress=progress)
+	progress.close()
+	if sink is not None:
+		sink.close()
+	if prediction_writer is not None:
+		prediction_writer.close()
+	runner.log_stats(logger)
 
 	logger.info(
 		"detected {} instances per frame in {:.2f}s".format(
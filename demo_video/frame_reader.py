@@ -0,0 +1,143 @@
+import glob
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+from detectron2.data.detection_utils import read_image
+
+
+class _EndToken:
+    pass
+
+
+class FrameReader:
+    """
+    Decode the frames of a video in a background thread.
+
+    The input is either a directory of frames, read in sorted file name order, or a
+    video file read with OpenCV. Decoded frames wait in a bounded queue, so decoding
+    overlaps with the inference and visualization on the main thread while at most
+    `max_queue_size` frames are held in memory.
+    """
+
+    def __init__(self, input_path, max_queue_size=64, stats=None):
+        """
+        Args:
+            input_path (str): a directory of frames or a video file.
+            max_queue_size (int): maximum number of decoded frames waiting to be consumed.
+            stats (StageStats or None): if given, records the decoding time and the time
+                blocked on a full queue.
+        """
+        input_path = os.path.expanduser(input_path)
+        self.input_path = input_path
+        self.max_queue_size = max(max_queue_size, 1)
+        self.is_video_file = not os.path.isdir(input_path)
+        if self.is_video_file:
+            capture = cv2.VideoCapture(input_path)
+            assert capture.isOpened(), "Can not open video {}!".format(input_path)
+            # may be an estimate, or 0 if the container does not store it
+            self.num_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            self.fps = capture.get(cv2.CAP_PROP_FPS)
+            capture.release()
+            self.frame_paths = None
+        else:
+            self.frame_paths = sorted(glob.glob(os.path.join(input_path, "*.???")))
+            self.num_frames = len(self.frame_paths)
+            self.fps = None
+
+        self.stats = stats
+        self._stop = threading.Event()
+
+    def __len__(self):
+        return self.num_frames
+
+    def _decode(self):
+        """
+        Yields:
+            str: the file name of the frame.
+            np.ndarray: the frame of shape (H, W, C) in BGR order.
+        """
+        if not self.is_video_file:
+            for path in self.frame_paths:
+                yield os.path.basename(path), read_image(path, format="BGR")
+            return
+        capture = cv2.VideoCapture(self.input_path)
+        try:
+            frame_idx = 0
+            while True:
+                success, frame = capture.read()
+                if not success:
+                    break
+                yield "{:06d}.jpg".format(frame_idx), frame
+                frame_idx += 1
+        finally:
+            capture.release()
+
+    def _put(self, frame_queue, item):
+        # give up when the consumer stopped reading
+        while not self._stop.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self, frame_queue):
+        try:
+            start = time.perf_counter()
+            for item in self._decode():
+                decoded = time.perf_counter()
+                if not self._put(frame_queue, item):
+                    return
+                if self.stats is not None:
+                    self.stats.add(1, decoded - start, time.perf_counter() - decoded)
+                start = time.perf_counter()
+        except Exception as e:
+            self._put(frame_queue, e)
+            return
+        self._put(frame_queue, _EndToken())
+
+    def __iter__(self):
+        """
+        Yields:
+            str: the file name of the frame.
+            np.ndarray: the frame of shape (H, W, C) in BGR order.
+        """
+        self._stop.clear()
+        frame_queue = queue.Queue(maxsize=self.max_queue_size)
+        thread = threading.Thread(target=self._worker, args=(frame_queue,), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = frame_queue.get()
+                if isinstance(item, _EndToken):
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self._stop.set()
+            thread.join()
+
+    def windows(self, window_size):
+        """
+        Group the frames in windows of `window_size` consecutive frames, the last one
+        may be shorter. All frames are in one window if `window_size` <= 0.
+
+        Yields:
+            list[str]: the file names of the frames of a window.
+            list[np.ndarray]: the frames of a window.
+        """
+        names, frames = [], []
+        for name, frame in self:
+            names.append(name)
+            frames.append(frame)
+            if len(frames) == window_size:
+                yield names, frames
+                names, frames = [], []
+        if len(frames) > 0:
+            yield names, frames
@@ -0,0 +1,169 @@
+import json
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+import pycocotools.mask as mask_util
+import torch
+
+from cavis.inference_utils import encode_video_masks
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv", ".mov")
+_FOURCC = {".mp4": "mp4v", ".avi": "XVID", ".mkv": "XVID", ".mov": "mp4v"}
+
+
+class ImageSink:
+    """
+    Save every visualized frame as an image in a directory.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+
+    def write(self, frame_name, vis_output):
+        vis_output.save(os.path.join(self.output_dir, frame_name))
+
+    def close(self):
+        pass
+
+
+class _StopToken:
+    pass
+
+
+class VideoSink:
+    """
+    Encode the visualized frames into a video file with OpenCV's VideoWriter.
+
+    Frames are encoded by a writer thread, which releases the GIL in OpenCV, so
+    encoding overlaps with inference and rendering; `write` blocks once
+    `max_pending` frames are waiting.
+    """
+
+    def __init__(self, output_file, fps=30.0, max_pending=32):
+        """
+        Args:
+            output_file (str): path of the video, the codec is chosen from its extension.
+            fps (float): frame rate of the video.
+            max_pending (int): maximum number of frames waiting to be encoded.
+        """
+        ext = os.path.splitext(output_file)[1].lower()
+        assert ext in _FOURCC, "Unsupported video extension {}!".format(ext)
+        output_dir = os.path.dirname(output_file)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        self.output_file = output_file
+        self.fps = fps
+        self._fourcc = cv2.VideoWriter_fourcc(*_FOURCC[ext])
+        self._queue = queue.Queue(maxsize=max(max_pending, 1))
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        writer = None
+        try:
+            while True:
+                frame = self._queue.get()
+                if isinstance(frame, _StopToken):
+                    break
+                if writer is None:
+                    height, width = frame.shape[:2]
+                    writer = cv2.VideoWriter(self.output_file, self._fourcc, self.fps, (width, height))
+                    assert writer.isOpened(), "Can not open video writer {}!".format(self.output_file)
+                writer.write(np.ascontiguousarray(frame[:, :, ::-1]))
+        except Exception as e:
+            self._error = e
+            # keep consuming so that the producer never blocks
+            while not isinstance(self._queue.get(), _StopToken):
+                pass
+        finally:
+            if writer is not None:
+                writer.release()
+
+    def write(self, frame_name, vis_output):
+        """
+        Args:
+            frame_name (str): unused, frames are written in the order of the calls.
+            vis_output: the rendered frame, with a `get_image` method returning (H, W, 3) RGB uint8.
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put(vis_output.get_image())
+
+    def close(self):
+        self._queue.put(_StopToken())
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+def open_frame_sink(output, fps=30.0):
+    """
+    A VideoSink if `output` has a video extension, else an ImageSink to the directory `output`.
+    """
+    if os.path.splitext(output)[1].lower() in VIDEO_EXTENSIONS:
+        return VideoSink(output, fps=fps)
+    return ImageSink(output)
+
+
+def _rle_to_bytes(rle):
+    counts = rle["counts"]
+    if isinstance(counts, str):
+        counts = counts.encode("utf-8")
+    return {"size": rle["size"], "counts": counts}
+
+
+class PredictionWriter:
+    """
+    Export the raw predictions of a video to a single JSON Lines file, one line per frame:
+    {"frame": <file name>, "objects": [{"id", "category_id", "score", "segmentation"}, ...]},
+    where "segmentation" is the COCO RLE of the object in the frame, with "counts" as str.
+    Objects absent from a frame are omitted.
+    """
+
+    def __init__(self, output_file):
+        output_dir = os.path.dirname(output_file)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        self._file = open(output_file, "w")
+
+    def write(self, frame_names, pred_masks, pred_labels, pred_scores, pred_ids=None):
+        """
+        Args:
+            frame_names (list[str]): the T frames of the predictions.
+            pred_masks (list): the (T, H, W) bool masks of each object, or its list of T RLEs.
+            pred_labels (list[int]): the category of each object.
+            pred_scores (list[float]): the score of each object.
+            pred_ids (list[int] or None): the track id of each object, its index if None.
+        """
+        if pred_ids is None:
+            pred_ids = list(range(len(pred_labels)))
+        if len(pred_masks) > 0 and not isinstance(pred_masks[0], (list, tuple)):
+            masks = torch.stack([torch.as_tensor(np.asarray(m)) for m in pred_masks])  # (N, T, H, W)
+            present = masks.flatten(2).any(dim=2).tolist()
+            pred_masks = encode_video_masks(masks)
+        else:
+            present = [
+                [mask_util.area(_rle_to_bytes(rle)) > 0 for rle in rles] for rles in pred_masks
+            ]
+        for t, frame_name in enumerate(frame_names):
+            objects = [
+                {
+                    "id": int(id),
+                    "category_id": int(label),
+                    "score": float(score),
+                    "segmentation": rles[t],
+                }
+                for rles, is_present, label, score, id in zip(
+                    pred_masks, present, pred_labels, pred_scores, pred_ids
+                )
+                if is_present[t]
+            ]
+            self._file.write(json.dumps({"frame": frame_name, "objects": objects}) + "\n")
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,151 @@
+import logging
+import queue
+import threading
+import time
+
+from torch.cuda.amp import autocast
+
+from predictor import _get_objects_from_outputs
+
+
+class StageStats:
+    """
+    Throughput of a pipeline stage: the frames it processed, the time it spent working
+    on them, and the time it was blocked waiting for the previous or next stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.num_frames = 0
+        self.busy_time = 0.0
+        self.blocked_time = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, num_frames, busy_time, blocked_time=0.0):
+        with self._lock:
+            self.num_frames += num_frames
+            self.busy_time += busy_time
+            self.blocked_time += blocked_time
+
+    def summary(self):
+        fps = self.num_frames / self.busy_time if self.busy_time > 0 else float("inf")
+        return "{}: {} frames, busy {:.2f}s ({:.1f} fps), blocked {:.2f}s".format(
+            self.name, self.num_frames, self.busy_time, fps, self.blocked_time
+        )
+
+
+class _EndToken:
+    pass
+
+
+class PipelinedVideoRunner:
+    """
+    Run a long video through three concurrent stages connected by bounded queues:
+
+    * decode: the background thread of a :class:`FrameReader`.
+    * model: the calling thread, which predicts the windows in order, so the tracker
+      state is carried from one window to the next.
+    * render: a thread that visualizes the predictions of each window and writes
+      them to the frame sink and the prediction writer.
+
+    Frames are passed between the stages by reference, so they are never copied. At
+    most `max_pending_windows` predicted windows wait for rendering.
+    """
+
+    def __init__(self, demo, reader, window_size, sink=None, prediction_writer=None, max_pending_windows=2):
+        """
+        Args:
+            demo (VisualizationDemo_windows): the model and the renderer.
+            reader (FrameReader): the input video.
+            window_size (int): number of frames predicted at a time, all frames if <= 0.
+            sink (ImageSink or VideoSink or None): where the visualized frames are written,
+                the frames are not visualized if None.
+            prediction_writer (PredictionWriter or None): where the raw predictions are written.
+            max_pending_windows (int): maximum number of predicted windows waiting for rendering.
+        """
+        self.demo = demo
+        self.reader = reader
+        self.window_size = window_size
+        self.sink = sink
+        self.prediction_writer = prediction_writer
+        self._queue = queue.Queue(maxsize=max(max_pending_windows, 1))
+        self._error = None
+
+        self.decode_stats = StageStats("decode")
+        self.model_stats = StageStats("model")
+        self.render_stats = StageStats("render")
+        self.reader.stats = self.decode_stats
+
+    def _render_worker(self):
+        while True:
+            start = time.perf_counter()
+            item = self._queue.get()
+            got = time.perf_counter()
+            if isinstance(item, _EndToken):
+                break
+            if self._error is not None:
+                # keep consuming so that the model stage never blocks
+                continue
+            frame_names, frames, predictions = item
+            try:
+                if self.sink is not None:
+                    for frame_name, vis_output in zip(frame_names, self.demo.render(frames, predictions)):
+                        self.sink.write(frame_name, vis_output)
+                if self.prediction_writer is not None:
+                    self.prediction_writer.write(frame_names, *_get_objects_from_outputs(predictions))
+            except Exception as e:
+                self._error = e
+                continue
+            self.render_stats.add(len(frames), time.perf_counter() - got, got - start)
+
+    def _put(self, item):
+        while self._error is None:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise self._error
+
+    def run(self, progress=None):
+        """
+        Args:
+            progress (tqdm or None): updated with the number of predicted frames.
+        Returns:
+            set: the ids of the instances predicted in the video.
+        """
+        instances = set()
+        render_thread = threading.Thread(target=self._render_worker, daemon=True)
+        render_thread.start()
+        windows = self.reader.windows(self.window_size)
+        try:
+            i = 0
+            while True:
+                start = time.perf_counter()
+                window = next(windows, None)
+                got = time.perf_counter()
+                if window is None:
+                    break
+                frame_names, frames = window
+                with autocast():
+                    predictions = self.demo.predictor((frames, i > 0))
+                predicted = time.perf_counter()
+                if 'pred_ids' in predictions.keys():
+                    instances.update(predictions['pred_ids'])
+                self._put((frame_names, frames, predictions))
+                self.model_stats.add(len(frames), predicted - got, got - start + time.perf_counter() - predicted)
+                if progress is not None:
+                    progress.update(len(frames))
+                i += 1
+        finally:
+            windows.close()
+            self._queue.put(_EndToken())
+            render_thread.join()
+        if self._error is not None:
+            raise self._error
+        return instances
+
+    def log_stats(self, logger=None):
+        logger = logger or logging.getLogger(__name__)
+        for stats in (self.decode_stats, self.model_stats, self.render_stats):
+            logger.info(stats.summary())
@@ -6,8 +6,9 @@ import multiprocessing as mp
 from collections import deque
 import cv2
 import torch
+from torch.nn import functional as F
 
-from visualizer import TrackVisualizer
+from visualizer import TrackVisualizer, FastTrackRenderer
 
 from detectron2.data import MetadataCatalog
 from detectron2.engine.defaults import DefaultPredictor
@@ -94,15 +95,58 @@ def _get_objects_from_outputs(outputs):
 
     return pred_masks, pred_labels, pred_scores, pred_ids
 
+RENDERERS = ("detectron2", "overlay", "contour")
+
+
+def resize_clip(frames, aug, input_format="BGR", device="cpu", chunk_size=16):
+    """
+    Batched version of the per-frame resizing of :class:`VideoPredictor`: the frames are
+    stacked as uint8, moved to `device` and resized with one interpolate call per chunk
+    of `chunk_size` frames, so that only a chunk of full-size frames is on the device at
+    a time. Downscaling is antialiased like the PIL resize of detectron2, the results are
+    close to, but not bit-identical with, the per-frame path.
+
+    Args:
+        frames (list[np.ndarray]): images of the same shape (H, W, C) (in BGR order).
+        aug (ResizeShortestEdge): the test-time resizing.
+        input_format (str): "RGB" or "BGR", the channel order expected by the model.
+        device (str or torch.device):
+        chunk_size (int): number of frames resized at once.
+    Returns:
+        Tensor: float32 frames of shape (T, C, H', W') on `device`.
+    """
+    transform = aug.get_transform(frames[0])
+    new_size = (transform.new_h, transform.new_w)
+    out = torch.empty((len(frames), frames[0].shape[2]) + new_size, dtype=torch.float32, device=device)
+    for start in range(0, len(frames), chunk_size):
+        chunk = torch.from_numpy(np.stack(frames[start: start + chunk_size]))  # (t, H, W, C) uint8
+        chunk = chunk.to(device).permute(0, 3, 1, 2)
+        if input_format == "RGB":
+            # whether the model expects BGR inputs or RGB
+            chunk = chunk.flip(1)
+        chunk = chunk.float()
+        if new_size != tuple(chunk.shape[-2:]):
+            chunk = F.interpolate(chunk, size=new_size, mode="bilinear", align_corners=False, antialias=True)
+        out[start: start + chunk.shape[0]] = chunk
+    return out
+
+
 class VisualizationDemo(object):
-    def __init__(self, cfg, instance_mode=ColorMode.IMAGE, parallel=False):
+    def __init__(self, cfg, instance_mode=ColorMode.IMAGE, parallel=False, renderer="detectron2"):
         """
         Args:
             cfg (CfgNode):
             instance_mode (ColorMode):
             parallel (bool): whether to run the model in different processes from visualization.
                 Useful since the visualization logic can be slow.
+            renderer (str): "detectron2" draws with the matplotlib based TrackVisualizer,
+                "overlay" and "contour" with FastTrackRenderer, filling the masks or only
+                drawing their contours.
         """
+        assert renderer in RENDERERS, "Unknown renderer {}!".format(renderer)
+        # the renderers and the prediction export draw the masks themselves
+        assert cfg.MODEL.MASK_FORMER.TEST.VIS_MASK_FORMAT == "bitmask", \
+            "The demo needs MODEL.MASK_FORMER.TEST.VIS_MASK_FORMAT bitmask!"
         self.metadata = MetadataCatalog.get(
             cfg.DATASETS.TEST[0] if len(cfg.DATASETS.TEST) else "__unused"
         )
@@ -116,6 +160,40 @@ class VisualizationDemo(object):
         else:
             self.predictor = VideoPredictor(cfg)
         self.id_memories = {}
+        self.renderer = renderer
+
+    def _render_frames(self, frames, image_size, pred_masks, pred_labels, pred_scores, ids=None,
+                       id_memories=None):
+        frame_masks = list(zip(*pred_masks))
+        if self.renderer != "detectron2":
+            fast_renderer = FastTrackRenderer(
+                self.metadata, id_memories=id_memories, contours_only=self.renderer == "contour"
+            )
+        total_vis_output = []
+        for frame_idx in range(len(frames)):
+            frame = frames[frame_idx][:, :, ::-1]
+            if self.renderer != "detectron2":
+                masks = np.stack([np.asarray(m) for m in frame_masks[frame_idx]]) if len(pred_scores) > 0 else None
+                vis_output = fast_renderer.draw_instance_predictions(
+                    frame, masks, pred_labels, pred_scores, ids=ids
+                )
+                total_vis_output.append(vis_output)
+                continue
+            visualizer = TrackVisualizer(frame, self.metadata,
+                                         instance_mode=self.instance_mode,
+                                         id_memories=id_memories)
+            ins = Instances(image_size)
+            if len(pred_scores) > 0:
+                ins.scores = pred_scores
+                ins.pred_classes = pred_labels
+                ins.pred_masks = torch.stack(frame_masks[frame_idx], dim=0)
+
+            if ids is None:
+                vis_output = visualizer.draw_instance_predictions(predictions=ins)
+            else:
+                vis_output = visualizer.draw_instance_predictions(predictions=ins, ids=ids)
+            total_vis_output.append(vis_output)
+        return total_vis_output
 
     def run_on_video(self, frames):
         """
@@ -132,23 +210,29 @@ class VisualizationDemo(object):
         image_size = predictions["image_size"]
         pred_masks, pred_labels, pred_scores, pred_ids = _get_objects_from_outputs(predictions)
 
-        frame_masks = list(zip(*pred_masks))
-        total_vis_output = []
-        for frame_idx in range(len(frames)):
-            frame = frames[frame_idx][:, :, ::-1]
-            visualizer = TrackVisualizer(frame, self.metadata, instance_mode=self.instance_mode)
-            ins = Instances(image_size)
-            if len(pred_scores) > 0:
-                ins.scores = pred_scores
-                ins.pred_classes = pred_labels
-                ins.pred_masks = torch.stack(frame_masks[frame_idx], dim=0)
-
-            vis_output = visualizer.draw_instance_predictions(predictions=ins)
-            total_vis_output.append(vis_output)
+        total_vis_output = self._render_frames(frames, image_size, pred_masks, pred_labels, pred_scores)
 
         return predictions, total_vis_output
 
 class VisualizationDemo_windows(VisualizationDemo):
+    def render(self, frames, predictions):
+        """
+        Visualize the predictions of a window, independently of the model, e.g. on
+        another thread. Windows must be rendered in order to keep the id memories.
+        Args:
+            frames (List[np.ndarray]): the images of the window (in BGR order).
+            predictions (dict): the output of the model for the window.
+        Returns:
+            vis_output (list[VisImage]): the visualized image outputs.
+        """
+        pred_masks, pred_labels, pred_scores, pred_ids = _get_objects_from_outputs(predictions)
+        image_size = predictions["image_size"]
+
+        return self._render_frames(
+            frames, image_size, pred_masks, pred_labels, pred_scores,
+            ids=pred_ids, id_memories=self.id_memories,
+        )
+
     def run_on_video(self, frames, keep=False):
         """
         Args:
@@ -159,25 +243,7 @@ class VisualizationDemo_windows(VisualizationDemo):
             vis_output (VisImage): the visualized image output.
         """
         predictions = self.predictor((frames, keep))
-
-        pred_masks, pred_labels, pred_scores, pred_ids = _get_objects_from_outputs(predictions)
-        image_size = predictions["image_size"]
-
-        frame_masks = list(zip(*pred_masks))
-        total_vis_output = []
-        for frame_idx in range(len(frames)):
-            frame = frames[frame_idx][:, :, ::-1]
-            visualizer = TrackVisualizer(frame, self.metadata,
-                                         instance_mode=self.instance_mode,
-                                         id_memories=self.id_memories)
-            ins = Instances(image_size)
-            if len(pred_scores) > 0:
-                ins.scores = pred_scores
-                ins.pred_classes = pred_labels
-                ins.pred_masks = torch.stack(frame_masks[frame_idx], dim=0)
-
-            vis_output = visualizer.draw_instance_predictions(predictions=ins, ids=pred_ids)
-            total_vis_output.append(vis_output)
+        total_vis_output = self.render(frames, predictions)
 
         return predictions, total_vis_output
 
@@ -202,7 +268,13 @@ class VideoPredictor(DefaultPredictor):
         outputs = pred(inputs)
     """
 
-    def __init__(self, cfg):
+    def __init__(self, cfg, batched_preprocess=True):
+        """
+        Args:
+            cfg (CfgNode):
+            batched_preprocess (bool): resize the frames of a clip at once on the model
+                device with :func:`resize_clip`, when they have the same shape.
+        """
         self.cfg = cfg.clone()  # cfg can be modified by model
         self.model = build_model(self.cfg)
         self.model.eval()
@@ -220,6 +292,21 @@ class VideoPredictor(DefaultPredictor):
 
         self.input_format = cfg.INPUT.FORMAT
         assert self.input_format in ["RGB", "BGR"], self.input_format
+        self.batched_preprocess = batched_preprocess
+
+    def preprocess(self, original_image):
+        """
+        Args:
+            original_image (np.ndarray): an image of shape (H, W, C) (in BGR order).
+        Returns:
+            Tensor: the resized image of shape (C, H', W'), in the input format of the model.
+        """
+        # Apply pre-processing to image.
+        if self.input_format == "RGB":
+            # whether the model expects BGR inputs or RGB
+            original_image = original_image[:, :, ::-1]
+        image = self.aug.get_transform(original_image).apply_image(original_image)
+        return torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
 
     def __call__(self, frames):
         """
@@ -236,16 +323,11 @@ class VideoPredictor(DefaultPredictor):
         else:
             keep = False
         with torch.no_grad():  # https://github.com/sphinx-doc/sphinx/issues/4258
-            input_frames = []
-            for original_image in frames:
-                # Apply pre-processing to image.
-                if self.input_format == "RGB":
-                    # whether the model expects BGR inputs or RGB
-                    original_image = original_image[:, :, ::-1]
-                height, width = original_image.shape[:2]
-                image = self.aug.get_transform(original_image).apply_image(original_image)
-                image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
-                input_frames.append(image)
+            height, width = frames[-1].shape[:2]
+            if self.batched_preprocess and len({frame.shape for frame in frames}) == 1:
+                input_frames = resize_clip(frames, self.aug, self.input_format, self.model.device)
+            else:
+                input_frames = [self.preprocess(original_image) for original_image in frames]
 
             inputs = {"image": input_frames, "height": height, "width": width, "keep": keep}
             predictions = self.model([inputs])
@@ -0,0 +1,335 @@
+"""
+A local inference server for CAVIS_online, for many concurrent video streams.
+
+Clients POST the encoded frames (JPEG, PNG, ...) of a stream, one per request, to
+
+    POST http://<host>:<port>/streams/<stream id>/frames
+
+and receive the predictions of the frame as JSON:
+
+    {"stream": <stream id>, "frame_index": <index of the frame in the stream>,
+     "objects": [{"id", "category_id", "score", "segmentation"}, ...]}
+
+where "id" is the track id, consistent over the frames of a stream, and "segmentation"
+is the COCO RLE of the mask, with "counts" as str.
+
+    DELETE http://<host>:<port>/streams/<stream id>
+
+drops the tracking state of a stream, which is also dropped after `--stream-timeout`
+seconds without frames.
+
+The frames pending from all streams are batched into one segmenter forward, waiting at
+most `--max-wait-ms` after the first frame of a batch, and the tracker then runs on the
+frames of each stream in order, with the tracking state of that stream.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# fmt: off
+import sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+# fmt: on
+
+import cv2
+import numpy as np
+import torch
+from torch.cuda.amp import autocast
+
+from detectron2.config import get_cfg
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.utils.logger import setup_logger
+
+from mask2former import add_maskformer2_config
+from mask2former_video import add_maskformer2_video_config
+from cavis import add_minvis_config, add_dvis_config, add_cavis_config, CAVIS_online, CAVIS_offline
+from cavis.inference_utils import encode_video_masks, store_mask_logits, unpack_masks
+from predictor import VideoPredictor, _get_objects_from_outputs
+
+
+class _StreamState:
+    def __init__(self):
+        self.tracker_memory = None
+        # sum of the class logits of the frames, the scores are averaged over the stream so far
+        self.logits_sum = None
+        self.num_frames = 0
+        self.last_seen = time.monotonic()
+
+
+class _CloseStream:
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+
+
+class StreamBatcher:
+    """
+    Run CAVIS_online frame by frame on many streams from a single model thread.
+
+    Frames submitted from any thread are queued; the model thread takes the first pending
+    frame, waits up to `max_wait_ms` for more (at most `max_batch_size`), runs the segmenter
+    on the whole batch at once, then the tracker on the frames of each stream, restoring
+    and saving the tracking state of the stream around it.
+    """
+
+    def __init__(self, predictor, max_batch_size=8, max_wait_ms=10, stream_timeout=300):
+        """
+        Args:
+            predictor (VideoPredictor): the loaded model and its preprocessing.
+            max_batch_size (int): maximum number of frames in a segmenter forward.
+            max_wait_ms (float): maximum time the first frame of a batch waits for others.
+            stream_timeout (float): seconds without frames after which a stream is dropped.
+        """
+        self.predictor = predictor
+        self.model = predictor.model
+        assert isinstance(self.model, CAVIS_online) and not isinstance(self.model, CAVIS_offline), \
+            "Only the online CAVIS model can predict streams frame by frame!"
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait = max_wait_ms / 1000
+        self.stream_timeout = stream_timeout
+        self.logger = logging.getLogger(__name__)
+
+        self._queue = queue.Queue()
+        self._streams = {}
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, stream_id, frame):
+        """
+        Args:
+            stream_id (str):
+            frame (np.ndarray): an image of shape (H, W, C) (in BGR order).
+        Returns:
+            Future: resolves to the json-serializable predictions of the frame.
+        """
+        future = Future()
+        self._queue.put((stream_id, frame, future))
+        return future
+
+    def close_stream(self, stream_id):
+        self._queue.put(_CloseStream(stream_id))
+
+    def _collect(self):
+        # wake up regularly without traffic, to drop the idle streams
+        try:
+            batch = [self._queue.get(timeout=min(self.stream_timeout, 10))]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            requests = []
+            for item in self._collect():
+                if isinstance(item, _CloseStream):
+                    self._streams.pop(item.stream_id, None)
+                else:
+                    requests.append(item)
+            if len(requests) > 0:
+                try:
+                    self._run_batch(requests)
+                except Exception as e:
+                    self.logger.exception("Failed to predict a batch of {} frames.".format(len(requests)))
+                    for _, _, future in requests:
+                        if not future.done():
+                            future.set_exception(e)
+            now = time.monotonic()
+            for stream_id in [k for k, v in self._streams.items() if now - v.last_seen > self.stream_timeout]:
+                del self._streams[stream_id]
+
+    @torch.no_grad()
+    def _run_batch(self, requests):
+        model = self.model
+        # frames of different streams may have different sizes, they are padded to a common one
+        images = model.preprocess_image([{"image": [self.predictor.preprocess(frame) for _, frame, _ in requests]}])
+
+        # the segmenter predicts each frame independently, frames of all streams are batched
+        with autocast():
+            features = model.backbone(images.tensor)
+            out = model.sem_seg_head(features)
+        del features
+
+        frames_per_stream = OrderedDict()
+        for i, (stream_id, _, _) in enumerate(requests):
+            frames_per_stream.setdefault(stream_id, []).append(i)
+        for stream_id, indices in frames_per_stream.items():
+            self._track(stream_id, indices, out, images, requests)
+
+    def _track(self, stream_id, indices, out, images, requests):
+        model = self.model
+        state = self._streams.get(stream_id)
+        resume = state is not None
+        if not resume:
+            state = _StreamState()
+        else:
+            model.tracker.set_memory(state.tracker_memory)
+
+        index = torch.as_tensor(indices, device=out['mask_features'].device)
+        with autocast():
+            track_out = model.tracker(
+                out['pred_embds'][:, :, index], out['mask_features'][index].unsqueeze(0),
+                resume=resume,
+                frame_embeds_no_norm=out['pred_embds_without_norm'][:, :, index],
+                frame_logits=out['pred_logits'][:, index],
+            )
+        state.tracker_memory = model.tracker.get_memory()
+        state.last_seen = time.monotonic()
+        # only once the tracker succeeded, a failed first frame leaves no stream behind
+        self._streams[stream_id] = state
+
+        pred_logits = track_out['pred_logits'][0].to(torch.float32).cpu()  # (t, q, c)
+        pred_masks = store_mask_logits(track_out['pred_masks'][0], model.mask_storage_dtype)  # (q, t, h, w)
+        pred_ids = torch.arange(0, pred_masks.size(0))
+        first_resize_size = (images.tensor.shape[-2], images.tensor.shape[-1])
+        for t, i in enumerate(indices):
+            _, frame, future = requests[i]
+            state.logits_sum = pred_logits[t] if state.logits_sum is None else state.logits_sum + pred_logits[t]
+            state.num_frames += 1
+            outputs = model.inference_video_task(
+                state.logits_sum / state.num_frames, pred_masks[:, t: t + 1], images.image_sizes[i],
+                frame.shape[0], frame.shape[1], first_resize_size, pred_ids,
+            )
+            future.set_result(self._serialize(stream_id, state.num_frames - 1, outputs))
+
+    @staticmethod
+    def _serialize(stream_id, frame_index, outputs):
+        pred_masks, pred_labels, pred_scores, pred_ids = _get_objects_from_outputs(outputs)
+        if pred_ids is None:
+            pred_ids = list(range(len(pred_labels)))
+        mask_format = outputs.get("mask_format", "bitmask")
+        if mask_format == "rle":
+            rles = [rle[0] for rle in pred_masks]
+        elif mask_format == "packed":
+            width = outputs["image_size"][1]
+            rles = [rle[0] for rle in encode_video_masks([torch.from_numpy(unpack_masks(m, width)) for m in pred_masks])]
+        else:
+            rles = [rle[0] for rle in encode_video_masks([torch.as_tensor(np.asarray(m)) for m in pred_masks])]
+        objects = [
+            {"id": int(id), "category_id": int(label), "score": float(score), "segmentation": rle}
+            for rle, label, score, id in zip(rles, pred_labels, pred_scores, pred_ids)
+        ]
+        return {"stream": stream_id, "frame_index": frame_index, "objects": objects}
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def _send_json(self, code, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream_path(self):
+        # ["streams", <stream id>] or ["streams", <stream id>, "frames"]
+        parts = self.path.strip("/").split("/")
+        if len(parts) in (2, 3) and parts[0] == "streams" and parts[1]:
+            return parts
+        return None
+
+    def do_POST(self):
+        parts = self._stream_path()
+        if parts is None or len(parts) != 3 or parts[2] != "frames":
+            self._send_json(404, {"error": "unknown path {}".format(self.path)})
+            return
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            self._send_json(400, {"error": "can not decode the frame"})
+            return
+        try:
+            result = self.server.batcher.submit(parts[1], frame).result(timeout=self.server.request_timeout)
+        except Exception as e:
+            self._send_json(500, {"error": repr(e)})
+            return
+        self._send_json(200, result)
+
+    def do_DELETE(self):
+        parts = self._stream_path()
+        if parts is None or len(parts) != 2:
+            self._send_json(404, {"error": "unknown path {}".format(self.path)})
+            return
+        self.server.batcher.close_stream(parts[1])
+        self._send_json(200, {"stream": parts[1]})
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format, *args)
+
+
+def serve(batcher, host="127.0.0.1", port=8080, request_timeout=60):
+    server = ThreadingHTTPServer((host, port), _RequestHandler)
+    server.daemon_threads = True
+    server.batcher = batcher
+    server.request_timeout = request_timeout
+    logging.getLogger(__name__).info("Serving on http://{}:{}".format(host, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def setup_cfg(args):
+    # load config from file and command-line arguments
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_maskformer2_config(cfg)
+    add_maskformer2_video_config(cfg)
+    add_minvis_config(cfg)
+    add_dvis_config(cfg)
+    add_cavis_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    return cfg
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="local inference server for CAVIS_online")
+    parser.add_argument("--config-file", required=True, metavar="FILE", help="path to config file")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-batch-size", type=int, default=8,
+                        help="maximum number of frames of all streams in a segmenter forward")
+    parser.add_argument("--max-wait-ms", type=float, default=10,
+                        help="maximum time a frame waits for others to fill a batch")
+    parser.add_argument("--stream-timeout", type=float, default=300,
+                        help="seconds without frames after which the state of a stream is dropped")
+    parser.add_argument("--request-timeout", type=float, default=60)
+    parser.add_argument(
+        "--opts",
+        help="Modify config options using the command-line 'KEY VALUE' pairs",
+        default=[],
+        nargs=argparse.REMAINDER,
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    setup_logger(name="fvcore")
+    logger = setup_logger()
+    logger.info("Arguments: " + str(args))
+
+    cfg = setup_cfg(args)
+    batcher = StreamBatcher(
+        VideoPredictor(cfg),
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        stream_timeout=args.stream_timeout,
+    )
+    serve(batcher, host=args.host, port=args.port, request_timeout=args.request_timeout)
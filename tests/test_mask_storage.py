@@ -0,0 +1,73 @@
+"""
+Check the host storage of the mask logits of a video (MODEL.MASK_FORMER.TEST.MASK_STORAGE_DTYPE):
+
+    python -m pytest tests/test_mask_storage.py
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("detectron2")
+
+from torch.nn import functional as F
+
+from cavis.inference_utils import (
+    MASK_STORAGE_DTYPES, load_mask_logits, store_mask_logits, video_instance_masks,
+)
+
+# maximum error of the round trip, on the logits for the float dtypes, on the sigmoid
+# probabilities for uint8 (half of a quantization step)
+TOLERANCES = {"float32": 0.0, "float16": 1e-3, "bfloat16": 1e-2, "uint8": 0.5 / 255}
+
+
+def _mask_logits(seed=0):
+    # smooth (Q, T, h, w) logits, as predicted at mask resolution
+    generator = torch.Generator().manual_seed(seed)
+    coarse = torch.randn(10, 3, 6, 8, generator=generator) * 8
+    return F.interpolate(coarse, size=(48, 64), mode="bilinear", align_corners=False)
+
+
+@pytest.mark.parametrize("storage_dtype", MASK_STORAGE_DTYPES)
+@pytest.mark.parametrize("input_dtype", [torch.float32, torch.float16])
+def test_store_leaves_the_input_unchanged(storage_dtype, input_dtype):
+    mask_logits = _mask_logits().to(input_dtype)
+    original = mask_logits.clone()
+    store_mask_logits(mask_logits, storage_dtype)
+    assert torch.equal(mask_logits, original)
+
+
+@pytest.mark.parametrize("storage_dtype", MASK_STORAGE_DTYPES)
+def test_round_trip(storage_dtype):
+    mask_logits = _mask_logits()
+    stored = store_mask_logits(mask_logits, storage_dtype)
+    assert stored.dtype == getattr(torch, storage_dtype) and stored.device.type == "cpu"
+
+    loaded = load_mask_logits(stored)
+    assert loaded.dtype == torch.float32 and loaded.shape == mask_logits.shape
+    if storage_dtype == "uint8":
+        error = (loaded.sigmoid() - mask_logits.sigmoid()).abs().max()
+    else:
+        error = ((loaded - mask_logits).abs() / mask_logits.abs().clamp(min=1)).max()
+    assert error <= TOLERANCES[storage_dtype] + 1e-6
+
+
+@pytest.mark.parametrize("storage_dtype", MASK_STORAGE_DTYPES)
+def test_load_keeps_the_sign_of_the_logits(storage_dtype):
+    mask_logits = _mask_logits()
+    # logits close to 0 on both sides
+    mask_logits[:, 0, 0, :8] = torch.tensor([-1, 1, -0.1, 0.1, -0.01, 0.01, -1e-3, 1e-3])
+    mask_logits = mask_logits[mask_logits.abs() >= 1e-3].view(1, 1, 1, -1)
+    loaded = load_mask_logits(store_mask_logits(mask_logits, storage_dtype))
+    assert torch.equal(loaded > 0, mask_logits > 0)
+
+
+@pytest.mark.parametrize("storage_dtype", MASK_STORAGE_DTYPES)
+def test_output_masks_match_float32(storage_dtype):
+    # the binary masks of the video, upsampled from the stored logits, as in inference_video_vis
+    mask_logits = _mask_logits()
+    img_size, first_resize_size, output_size = (180, 250), (192, 256), (360, 500)
+    expected = video_instance_masks(mask_logits, img_size, first_resize_size, output_size)
+    masks = video_instance_masks(
+        store_mask_logits(mask_logits, storage_dtype), img_size, first_resize_size, output_size
+    )
+    mismatch = (torch.stack(masks) != torch.stack(expected)).float().mean()
+    assert mismatch < 1e-3
@@ -0,0 +1,90 @@
+"""
+Check that the query pruning of CAVIS_Tracker only skips the masks of the pruned queries,
+and keeps their class logits, so that a query re-admitted later in the video keeps its score:
+
+    python -m pytest tests/test_query_pruning.py
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("detectron2")
+
+from cavis.video_cavis_modules import CAVIS_Tracker, PRUNED_MASK_LOGIT
+
+NUM_QUERIES, NUM_CLASSES, HIDDEN = 6, 3, 32
+
+
+def _tracker():
+    torch.manual_seed(0)
+    tracker = CAVIS_Tracker(
+        hidden_channel=HIDDEN, feedforward_channel=64, num_head=4, decoder_layer_num=2,
+        mask_dim=HIDDEN, class_num=NUM_CLASSES, prune_queries=True,
+    )
+    # the tracker predicts background for every query, so that only the segmenter
+    # proposals keep the queries active
+    tracker.class_embed.bias.data[-1] = 10
+    return tracker.eval()
+
+
+def _inputs(num_frames):
+    generator = torch.Generator().manual_seed(0)
+    # the same queries in every frame, so that the tracker matches each query to itself
+    frame_embeds = torch.randn(1, 2 * HIDDEN, 1, NUM_QUERIES, generator=generator).repeat(1, 1, num_frames, 1)
+    mask_features = torch.randn(num_frames, HIDDEN, 8, 8, generator=generator).unsqueeze(0)
+    return frame_embeds, mask_features
+
+
+def _frame_logits(num_frames, background_frames):
+    # query 0 is proposed as background in the first `background_frames` frames, then as
+    # foreground like the other queries
+    frame_logits = torch.full((1, num_frames, NUM_QUERIES, NUM_CLASSES + 1), -5.0)
+    frame_logits[..., 0] = 5.0
+    frame_logits[0, :background_frames, 0] = -5.0
+    frame_logits[0, :background_frames, 0, -1] = 5.0
+    return frame_logits
+
+
+def test_prediction_keeps_the_classes_of_pruned_queries():
+    tracker = _tracker()
+    generator = torch.Generator().manual_seed(1)
+    outputs = torch.randn(4, 2, NUM_QUERIES, 1, HIDDEN, generator=generator)  # (t, l, q, b, c)
+    mask_features = torch.randn(1, 4, HIDDEN, 8, 8, generator=generator)
+    live_queries = torch.tensor([False, True, True, False, True, True])
+    with torch.no_grad():
+        all_class, all_masks = tracker.prediction(outputs, mask_features)
+        live_class, live_masks = tracker.prediction(outputs, mask_features, live_queries=live_queries)
+
+    assert torch.allclose(live_class, all_class)
+    assert torch.allclose(live_masks[:, :, live_queries], all_masks[:, :, live_queries], atol=1e-5)
+    assert bool((live_masks[:, :, ~live_queries] == PRUNED_MASK_LOGIT).all())
+
+
+def test_readmitted_query_keeps_its_score():
+    tracker = _tracker()
+    window, num_frames = 4, 8
+    frame_embeds, mask_features = _inputs(num_frames)
+    frame_logits = _frame_logits(num_frames, background_frames=window)
+
+    windows = []
+    with torch.no_grad():
+        for start in range(0, num_frames, window):
+            frames = slice(start, start + window)
+            windows.append(tracker(
+                frame_embeds[:, :, frames], mask_features[:, frames], resume=start > 0,
+                frame_logits=frame_logits[:, frames],
+            ))
+
+    # query 0 is pruned in the first window and re-admitted in the second
+    assert bool((windows[0]['pred_masks'][0, 0] == PRUNED_MASK_LOGIT).all())
+    assert not bool((windows[1]['pred_masks'][0, 0] == PRUNED_MASK_LOGIT).any())
+    assert bool((windows[0]['pred_masks'][0, 1:] != PRUNED_MASK_LOGIT).all())
+
+    # in every frame, the class logits of all queries are those of their embeddings, so the
+    # video score (the mean of the logits over the frames) of query 0 is not pulled down by
+    # the window in which it was pruned
+    for out in windows:
+        with torch.no_grad():
+            expected = tracker.class_embed(out['pred_embds'].permute(0, 2, 3, 1))  # (b, t, q, c)
+        assert torch.allclose(out['pred_logits'], expected, atol=1e-5)
+    video_logits = torch.cat([out['pred_logits'] for out in windows], dim=1)[0].mean(dim=0)  # (q, c)
+    assert bool((video_logits[0] > PRUNED_MASK_LOGIT / 100).all())
@@ -0,0 +1,51 @@
+"""
+Check the in-process video consistency (VC) of VSSEvaluator against the official VSPW
+definition on synthetic videos:
+
+    python -m pytest tests/test_video_consistency.py
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("detectron2")
+
+from cavis.data_video.vss_eval import video_consistency_counts
+
+
+# copied from get_common in VC_perclip.py of VSPW, the images of a video are arrays here
+def get_common(list_,predlist,clip_num,h,w):
+    accs = []
+    for i in range(len(list_)-clip_num):
+        global_common = np.ones((h,w))
+        predglobal_common = np.ones((h,w))
+
+
+        for j in range(1,clip_num):
+            common = (list_[i] == list_[i+j])
+            global_common = np.logical_and(global_common,common)
+            pred_common = (predlist[i]==predlist[i+j])
+            predglobal_common = np.logical_and(predglobal_common,pred_common)
+        pred = (predglobal_common*global_common)
+
+        acc = pred.sum()/global_common.sum()
+        accs.append(acc)
+    return accs
+
+
+@pytest.mark.parametrize("num_frames", [8, 9, 16, 23])
+@pytest.mark.parametrize("window", [8, 16])
+def test_video_consistency_matches_official(num_frames, window):
+    rng = np.random.default_rng(num_frames * window)
+    gt = np.repeat(rng.integers(0, 4, (1, 12, 16)), num_frames, axis=0)
+    gt[:, :3] = rng.integers(0, 4, (num_frames, 3, 16))  # rows without a common label
+    pred = gt.copy()
+    flips = rng.random(pred.shape) < 0.05
+    pred[flips] = rng.integers(0, 4, flips.sum())
+
+    acc_sum, num_clips = video_consistency_counts(gt, pred, window)
+    expected = get_common(list(gt), list(pred), window, *gt.shape[1:])
+    assert num_clips == len(expected) == max(num_frames - window, 0)
+    if num_clips > 0:
+        # VC_perclip.py averages the accuracies of all clips with np.nanmean
+        assert acc_sum / num_clips == pytest.approx(np.nanmean(expected))
@@ -0,0 +1,102 @@
+"""
+Check the in-process VPQ of VPSEvaluator against the official utils/eval_vpq_vspw.py on
+synthetic videos:
+
+    python -m pytest tests/test_vpq.py
+"""
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("detectron2")
+pytest.importorskip("panopticapi")
+pytest.importorskip("tqdm")
+Image = pytest.importorskip("PIL.Image")
+
+from cavis.data_video.vps_eval import VPQ_NFRAMES, frame_pair_counts, vpq_video_stats
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# category id -> isthing, ids 1 and 2 are things, 3 and 4 stuff
+CATEGORIES = {1: 1, 2: 1, 3: 0, 4: 0}
+
+
+def _load_official_vpq():
+    spec = importlib.util.spec_from_file_location(
+        "eval_vpq_vspw", os.path.join(REPO_ROOT, "utils", "eval_vpq_vspw.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _synthetic_panoptic_video(rng, num_frames, h=24, w=32):
+    """
+    Ground truth and prediction of a video: a few drifting boxes over stuff regions, the
+    prediction being the ground truth with shifted boxes, swapped and missing segments.
+    Returns the (t, h, w) segment ids and the segment id -> (category id, iscrowd) maps.
+    """
+    gt_segments = {10: (3, 0), 11: (4, 0), 20: (1, 0), 21: (1, 0), 22: (2, 0), 23: (2, 1)}
+    pred_segments = {5: (3, 0), 6: (4, 0), 7: (1, 0), 8: (1, 0), 9: (2, 0), 12: (1, 0)}
+    gt = np.zeros((num_frames, h, w), dtype=np.int64)
+    pred = np.zeros((num_frames, h, w), dtype=np.int64)
+    for t in range(num_frames):
+        gt[t, : h // 2] = 10
+        gt[t, h // 2:] = 11
+        gt[t, -2:] = 0  # void
+        pred[t, : h // 2 + rng.integers(-2, 3)] = 5
+        pred[t, h // 2 + rng.integers(-2, 3):] = 6
+        for segment_id, pred_id, y, x in ((20, 7, 2, 2), (21, 8, 12, 4), (22, 9, 4, 18), (23, 12, 14, 20)):
+            dx = t + rng.integers(0, 2)
+            gt[t, y: y + 6, x + t: x + t + 6] = segment_id
+            if segment_id == 21 and t % 3 == 0:
+                continue  # missed
+            pred[t, y + rng.integers(-1, 2): y + 6, x + dx: x + dx + 5 + rng.integers(0, 3)] = pred_id
+    return gt, pred, gt_segments, pred_segments
+
+
+def _id2rgb(ids):
+    rgb = np.zeros(ids.shape + (3,), dtype=np.uint8)
+    for i in range(3):
+        rgb[..., i] = (ids >> (8 * i)) % 256
+    return rgb
+
+
+def _segments_info(frame, segments):
+    return [
+        {"id": int(i), "category_id": segments[i][0], "iscrowd": segments[i][1], "area": int(area)}
+        for i, area in zip(*np.unique(frame, return_counts=True)) if i in segments
+    ]
+
+
+def _official_vpq_stats(official, tmp_path, gt, pred, gt_segments, pred_segments, nframes):
+    gt_pred_set = []
+    for t in range(gt.shape[0]):
+        gt_png, pred_png = str(tmp_path / "gt_{}.png".format(t)), str(tmp_path / "pred_{}.png".format(t))
+        Image.fromarray(_id2rgb(gt[t])).save(gt_png)
+        Image.fromarray(_id2rgb(pred[t])).save(pred_png)
+        gt_json = {"segments_info": _segments_info(gt[t], gt_segments)}
+        pred_json = {"segments_info": _segments_info(pred[t], pred_segments)}
+        gt_pred_set.append((gt_json, pred_json, gt_png, pred_png, None))
+    categories = {k: {"id": k, "isthing": v} for k, v in CATEGORIES.items()}
+    return official.vpq_compute_single_core(categories, nframes, gt_pred_set)
+
+
+@pytest.mark.parametrize("num_frames", [1, 5, 8, 12])
+def test_vpq_matches_official(tmp_path, num_frames):
+    official = _load_official_vpq()
+    gt, pred, gt_segments, pred_segments = _synthetic_panoptic_video(np.random.default_rng(num_frames), num_frames)
+
+    pair_counts = [frame_pair_counts(gt[t], pred[t]) for t in range(num_frames)]
+    gt_segments_infos = [_segments_info(gt[t], gt_segments) for t in range(num_frames)]
+    pred_categories = {k: v[0] for k, v in pred_segments.items()}
+    stats = vpq_video_stats(pair_counts, gt_segments_infos, pred_categories)
+
+    for nframes in VPQ_NFRAMES:
+        expected = _official_vpq_stats(official, tmp_path, gt, pred, gt_segments, pred_segments, nframes)
+        for category_id in CATEGORIES:
+            ours, theirs = stats[nframes][category_id], expected[category_id]
+            assert (ours.tp, ours.fp, ours.fn) == (theirs.tp, theirs.fp, theirs.fn), (nframes, category_id)
+            assert ours.iou == pytest.approx(theirs.iou), (nframes, category_id)
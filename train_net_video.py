@@ -30,6 +30,7 @@ from detectron2.engine import (
     DefaultTrainer,
     default_argument_parser,
     default_setup,
+    hooks,
     launch,
 )
 from detectron2.evaluation import (
@@ -60,6 +61,8 @@ from cavis import (
     build_combined_loader,
     build_detection_train_loader,
     build_detection_test_loader,
+    LoaderTelemetry,
+    DataTelemetryHook,
 )
 
 
@@ -81,8 +84,21 @@ class Trainer(DefaultTrainer):
             os.makedirs(output_folder, exist_ok=True)
 
         evaluator_dict = {'vis': YTVISEvaluator, 'vss': VSSEvaluator, 'vps': VPSEvaluator}
-        assert cfg.MODEL.MASK_FORMER.TEST.TASK in evaluator_dict.keys()
-        return evaluator_dict[cfg.MODEL.MASK_FORMER.TEST.TASK](dataset_name, cfg, True, output_folder)
+        task = cfg.MODEL.MASK_FORMER.TEST.TASK
+        assert task in evaluator_dict.keys()
+        if task == 'vis':
+            kwargs = {
+                "num_eval_workers": cfg.TEST.NUM_EVAL_WORKERS,
+                "sharded_eval": cfg.TEST.SHARDED_EVAL,
+            }
+        else:
+            kwargs = {
+                "num_writer_threads": cfg.TEST.NUM_WRITER_THREADS,
+                "max_pending_writes": cfg.TEST.MAX_PENDING_WRITES,
+            }
+            if task == 'vss':
+                kwargs["save_pred_png"] = cfg.TEST.SAVE_PRED_PNG
+        return evaluator_dict[task](dataset_name, cfg, True, output_folder, **kwargs)
 
     @classmethod
     def build_train_loader(cls, cfg):
@@ -105,16 +121,34 @@ class Trainer(DefaultTrainer):
             )
         assert len(mappers) > 0, "No dataset is chosen!"
 
+        telemetry = LoaderTelemetry(cfg.MODEL.DEVICE) if cfg.DATALOADER.TELEMETRY.ENABLED else None
         if len(mappers) == 1:
             mapper = mappers[0]
-            return build_detection_train_loader(cfg, mapper=mapper, dataset_name=cfg.DATASETS.TRAIN[0])
+            data_loader = build_detection_train_loader(cfg, mapper=mapper, dataset_name=cfg.DATASETS.TRAIN[0])
         else:
             loaders = [
                 build_detection_train_loader(cfg, mapper=mapper, dataset_name=dataset_name)
                 for mapper, dataset_name in zip(mappers, cfg.DATASETS.TRAIN)
             ]
-            combined_data_loader = build_combined_loader(cfg, loaders, cfg.DATASETS.DATASET_RATIO)
-            return combined_data_loader
+            if telemetry is not None:
+                # the wait of the training loop broken down by dataset
+                loaders = [
+                    telemetry.wrap(loader, "data_wait/{}".format(dataset_name))
+                    for loader, dataset_name in zip(loaders, cfg.DATASETS.TRAIN)
+                ]
+            data_loader = build_combined_loader(cfg, loaders, cfg.DATASETS.DATASET_RATIO)
+        if telemetry is not None:
+            data_loader = telemetry.wrap(data_loader, to_device=True)
+        return data_loader
+
+    def build_hooks(self):
+        ret = super().build_hooks()
+        telemetry = getattr(self._trainer.data_loader, "telemetry", None)
+        if telemetry is not None:
+            # before the writers, so that the metrics of an iteration are written with it
+            writers = [i for i, hook in enumerate(ret) if isinstance(hook, hooks.PeriodicWriter)]
+            ret.insert(writers[0] if writers else len(ret), DataTelemetryHook(telemetry))
+        return ret
 
     @classmethod
     def build_test_loader(cls, cfg, dataset_name, dataset_type):